@@ -0,0 +1,250 @@
+"""
+Caches of statistics computed from answers. The statistics are stored in a
+cache with the interface of the Django cache (``get_many`` and
+``set_many``) split to many small values, so a lookup transfers only the
+values of the requested items and the size of the cached values does not
+grow with the number of users.
+"""
+
+from collections import defaultdict
+import random
+
+
+class HasAnswerCache:
+
+    """
+    Flags telling whether users have answered items. The flags of one user
+    are split to buckets by items and each bucket has its own key.
+
+    Only positive flags are cached. Answers are never removed, so a cached
+    flag can't get stale and a new answer does not have to invalidate
+    anything, the flag is cached when it is looked up for the first time.
+
+    Args:
+        cache: cache with the interface of the Django cache
+        prefix (str): prefix of the cache keys
+        bucket_size (int): number of consecutive item ids in one bucket
+        expiration (int): expiration of buckets in seconds, the default of
+            the cache by default
+    """
+
+    def __init__(self, cache, prefix='has_answer', bucket_size=1000, expiration=None):
+        self._cache = cache
+        self._prefix = prefix
+        self._bucket_size = bucket_size
+        self._expiration = expiration
+
+    def answered(self, items, user=None):
+        """
+        Args:
+            items (list): ids of items
+            user (int): id of user, None stands for any user
+
+        Returns:
+            set: items known to be answered by the user
+        """
+        buckets = self._buckets(items, user)
+        found = self._cache.get_many(list(buckets.keys()))
+        return {i for key, bucket_items in buckets.items() for i in bucket_items if i in found.get(key, ())}
+
+    def add(self, items, user=None):
+        """
+        Remember that the user has answered the given items.
+        """
+        buckets = self._buckets(items, user)
+        if len(buckets) == 0:
+            return
+        found = self._cache.get_many(list(buckets.keys()))
+        values = {key: frozenset(found.get(key, frozenset()) | bucket_items) for key, bucket_items in buckets.items()}
+        _set_many(self._cache, values, self._expiration)
+
+    def _buckets(self, items, user):
+        buckets = defaultdict(set)
+        for item in items:
+            buckets['{}__{}__{}'.format(self._prefix, user, item // self._bucket_size)].add(item)
+        return buckets
+
+
+class ItemShardCache:
+
+    """
+    Values for pairs of items (e.g. confusing factors). The values of one
+    (primary) item and user are stored together under one key, a shard. A
+    shard is a dict containing the values for secondary items under the key
+    ``entries`` and the flag ``complete`` telling that the missing entries
+    are known to have the default value, other keys can be used by the user
+    of the cache.
+
+    The shards are updated by read-modify-write which is not atomic, so each
+    shard has a version counter kept under its own key and incremented
+    atomically by every update. A shard is valid only if it was written with
+    the current version, an update lost by a concurrent write leaves the
+    shard invalid and it is computed again instead of drifting away from
+    the data it was computed from.
+
+    Args:
+        cache: cache with the interface of the Django cache
+        prefix (str): prefix of the cache keys
+        expiration (int): expiration of shards in seconds, the default of
+            the cache by default
+    """
+
+    def __init__(self, cache, prefix, expiration=None):
+        self._cache = cache
+        self._prefix = prefix
+        self._expiration = expiration
+
+    @staticmethod
+    def shard(entries, complete=False, **kwargs):
+        return dict(kwargs, entries=entries, complete=complete)
+
+    @staticmethod
+    def contains(shard, item_secondary):
+        """
+        Check whether the value for the given secondary item is known from the
+        given shard (None stands for a missing shard).
+        """
+        return shard is not None and (shard['complete'] or item_secondary in shard['entries'])
+
+    def get_many(self, items, user=None):
+        """
+        Returns:
+            dict: item -> shard, only for cached valid shards
+        """
+        keys = {self._key(item, user): item for item in items}
+        found = self._cache.get_many(list(keys.keys()) + [self._version_key(key) for key in keys.keys()])
+        return {
+            item: self._without_version(found[key])
+            for key, item in keys.items()
+            if self._is_valid(found.get(key), found.get(self._version_key(key)))
+        }
+
+    def versions(self, items, user=None):
+        """
+        Get the current versions of shards of the given items. The versions
+        have to be read before the shards are computed from the data, so the
+        updates made during the computation invalidate the computed shards.
+
+        Returns:
+            dict: item -> version
+        """
+        keys = {self._version_key(self._key(item, user)): item for item in items}
+        found = self._cache.get_many(list(keys.keys()))
+        for key in keys.keys():
+            if key not in found:
+                # a shard can outlive its version, the new version must not
+                # match the versions the shard could have been written with
+                _add(self._cache, key, random.randrange(1 << 31), self._expiration)
+                found[key] = self._cache.get(key)
+        return {item: found[key] for key, item in keys.items()}
+
+    def set_many(self, shards, versions, user=None):
+        """
+        Replace the shards of the given items (dict item -> shard) computed
+        with the given versions (see :meth:`versions`).
+        """
+        _set_many(self._cache, {
+            self._key(item, user): self._with_version(shard, versions[item])
+            for item, shard in shards.items()
+        }, self._expiration)
+
+    def add(self, shards, versions, user=None):
+        """
+        Add the entries of the given shards (dict item -> shard) computed
+        with the given versions (see :meth:`versions`) to the cached ones,
+        the cached entries are kept.
+
+        Returns:
+            dict: item -> resulting shard
+        """
+        keys = {self._key(item, user): item for item in shards.keys()}
+        found = self._cache.get_many(list(keys.keys()))
+        result = {}
+        to_set = {}
+        for key, item in keys.items():
+            shard = shards[item]
+            cached = found.get(key)
+            if cached is not None and cached['version'] == versions[item]:
+                if cached['complete']:
+                    result[item] = self._without_version(cached)
+                    continue
+                merged = dict(shard)
+                merged.update(self._without_version(cached))
+                merged['entries'] = dict(shard['entries'])
+                merged['entries'].update(cached['entries'])
+                shard = merged
+            result[item] = shard
+            to_set[key] = self._with_version(shard, versions[item])
+        if len(to_set) > 0:
+            _set_many(self._cache, to_set, self._expiration)
+        return result
+
+    def update(self, keys, fun):
+        """
+        Update the cached shards of the given (item, user) pairs by the given
+        function. The function is called with the item, the user and the
+        cached shard and it returns the new shard, or None if the shard
+        should not be changed. Shards which are not cached (or are not
+        valid) are left to be computed when they are needed.
+
+        Returns:
+            dict: (item, user) -> resulting shard, only for cached shards
+        """
+        cache_keys = {self._key(item, user): (item, user) for item, user in keys}
+        found = self._cache.get_many(list(cache_keys.keys()) + [self._version_key(key) for key in cache_keys.keys()])
+        result = {}
+        to_set = {}
+        for key, (item, user) in cache_keys.items():
+            cached = found.get(key)
+            if not self._is_valid(cached, found.get(self._version_key(key))):
+                continue
+            cached = self._without_version(cached)
+            shard = fun(item, user, cached)
+            if shard is None:
+                result[item, user] = cached
+                continue
+            try:
+                version = self._cache.incr(self._version_key(key))
+            except ValueError:
+                continue
+            # another update or computation has written the shard since it
+            # was read, the shard stays invalid after the version has been
+            # incremented
+            if version != found[self._version_key(key)] + 1:
+                continue
+            result[item, user] = shard
+            to_set[key] = self._with_version(shard, version)
+        if len(to_set) > 0:
+            _set_many(self._cache, to_set, self._expiration)
+        return result
+
+    def _is_valid(self, shard, version):
+        return shard is not None and version is not None and shard.get('version') == version
+
+    def _with_version(self, shard, version):
+        return dict(shard, version=version)
+
+    def _without_version(self, shard):
+        shard = dict(shard)
+        shard.pop('version', None)
+        return shard
+
+    def _key(self, item, user):
+        return '{}__{}__{}'.format(self._prefix, user, item)
+
+    def _version_key(self, key):
+        return key + '__version'
+
+
+def _add(cache, key, value, expiration):
+    if expiration is None:
+        cache.add(key, value)
+    else:
+        cache.add(key, value, expiration)
+
+
+def _set_many(cache, values, expiration):
+    if expiration is None:
+        cache.set_many(values)
+    else:
+        cache.set_many(values, expiration)
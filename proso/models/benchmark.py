@@ -0,0 +1,280 @@
+"""
+Microbenchmarks for hot paths of the modelling code. They do not touch the
+database, so they can be run without Django:
+
+.. code-block:: bash
+
+    python -m proso.models.benchmark [benchmark_name ...]
+"""
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from proso.models.answer_cache import HasAnswerCache
+from proso.models.environment import InMemoryEnvironment
+from proso.models.item_selection import ScoreItemSelection
+from proso.models.replay import AnswerBatch
+import numpy
+import pickle
+import proso.models.metrics as metrics
+import proso.models.prediction as prediction
+import proso.rand
+import proso.sampling
+import random
+import sys
+import timeit
+
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(fun):
+    BENCHMARKS[fun.__name__] = fun
+    return fun
+
+
+def measure(fun, repeat=5, number=1):
+    """
+    Return the best time (in milliseconds) of the given function.
+    """
+    return 1000 * min(timeit.repeat(fun, repeat=repeat, number=number)) / number
+
+
+def print_row(*columns):
+    print(''.join(['{:>20}'.format(c) for c in columns]))
+
+
+@benchmark
+def predict_phase_more_items(sizes=(100, 1000, 10000)):
+    """
+    Compare the item by item and the vectorized prediction of
+    :class:`proso.models.prediction.PriorCurrentPredictiveModel`.
+    """
+    model = prediction.PriorCurrentPredictiveModel()
+    time = datetime(2017, 1, 1)
+    print_row('items', 'one by one [ms]', 'vectorized [ms]', 'speedup')
+    for size in sizes:
+        random.seed(size)
+        items = list(range(size))
+        data = {
+            'prior_skill': random.gauss(0, 1),
+            'difficulties': {i: random.gauss(0, 1) for i in items},
+            'current_skills': {i: random.gauss(0, 1) if random.random() < 0.5 else None for i in items},
+            'last_times': {i: time - timedelta(seconds=random.randint(1, 10 ** 6)) for i in items},
+        }
+
+        def _one_by_one():
+            return [
+                model.predict_phase({
+                    'prior_skill': data['prior_skill'],
+                    'difficulty': data['difficulties'][i],
+                    'current_skill': data['current_skills'][i],
+                    'last_time': data['last_times'][i],
+                }, None, i, time)
+                for i in items
+            ]
+
+        scalar = measure(_one_by_one)
+        vectorized = measure(lambda: model.predict_phase_more_items(data, None, items, time))
+        print_row(size, '{:.3f}'.format(scalar), '{:.3f}'.format(vectorized), '{:.1f}x'.format(scalar / vectorized))
+
+
+@benchmark
+def score_item_selection(pool_size=5000, parents_number=100, ns=(1, 10, 50)):
+    """
+    Selection of items from a large pool by
+    :class:`proso.models.item_selection.ScoreItemSelection`, with and without
+    recomputing the parent score after each pick.
+    """
+    random.seed(pool_size)
+    time = datetime(2017, 1, 1)
+    items = list(range(1, pool_size + 1))
+    environment = InMemoryEnvironment()
+    model = prediction.PriorCurrentPredictiveModel()
+    for item in items:
+        for parent in random.sample(range(pool_size + 1, pool_size + parents_number + 1), random.randint(1, 3)):
+            environment.write('parent', 1, item=item, item_secondary=parent, symmetric=False, permanent=True)
+    for answer_id, item in enumerate(random.sample(items, pool_size // 5)):
+        answer_time = time - timedelta(seconds=random.randint(1, 10 ** 5))
+        model.predict_and_update(environment, 1, item, True, answer_time, answer_id)
+        environment.process_answer(1, item, item, item, answer_time, answer_id, 1000, 0)
+    print_row('items', 'n', 'recompute [ms]', 'no recompute [ms]')
+    for n in ns:
+        results = []
+        for recompute_parent_score in [True, False]:
+            def _select():
+                item_selector = ScoreItemSelection(model, history_adjustment=False, recompute_parent_score=recompute_parent_score)
+                return item_selector.select(environment, 1, items, time, None, n)
+            results.append(measure(_select, repeat=3))
+        print_row(pool_size, n, *['{:.1f}'.format(r) for r in results])
+
+
+def _original_roulette(weights, n):
+    """
+    :func:`proso.rand.roulette` before it was backed by :mod:`proso.sampling`,
+    kept as the reference.
+    """
+    items = weights.items()
+    chosen = set()
+    for i in range(n):
+        total = sum(list(zip(*items))[1])
+        dice = random.random() * total
+        running_weight = 0
+        chosen_item = None
+        for item, weight in items:
+            if dice < running_weight + weight:
+                chosen_item = item
+                break
+            running_weight += weight
+        chosen.add(chosen_item)
+        items = [(i, w) for (i, w) in items if i != chosen_item]
+    return list(chosen)
+
+
+@benchmark
+def weighted_sampling(sizes=(5, 10, 20, 50, 100, 1000, 10000), n=6):
+    """
+    Choose distractors from pools of options by the original
+    :func:`proso.rand.roulette`, by the current one and by the engines from
+    :mod:`proso.sampling`.
+    """
+    engines = [
+        ('original', lambda weights: _original_roulette(weights, min(n, len(weights)))),
+        ('roulette', lambda weights: proso.rand.roulette(weights, min(n, len(weights)))),
+        ('sequential', lambda weights: proso.sampling.sample_sequential(weights, min(n, len(weights)))),
+        ('keys', lambda weights: proso.sampling.sample_keys(weights, min(n, len(weights)))),
+        ('keys numpy', lambda weights: proso.sampling.sample_keys_numpy(weights, min(n, len(weights)))),
+    ]
+    print_row('options', *['{} [ms]'.format(name) for name, _ in engines])
+    for size in sizes:
+        random.seed(size)
+        weights = {i: random.random() + 1 for i in range(size)}
+        print_row(size, *['{:.4f}'.format(measure(lambda: engine(weights), number=100)) for _, engine in engines])
+
+
+@benchmark
+def replay(answers_number=20000, users_number=100, items_number=100):
+    """
+    Replay of answers by the generic predict and update path and by the
+    replay kernels of the built-in predictive models.
+    """
+    random.seed(answers_number)
+    time = datetime(2017, 1, 1)
+    items = list(range(1, items_number + 1))
+    rows = []
+    for answer_id in range(1, answers_number + 1):
+        item = random.choice(items)
+        answered = item if random.random() < 0.7 else None
+        rows.append((answer_id, random.randint(1, users_number), item, item, answered, time + timedelta(seconds=answer_id), 1000, 0))
+
+    def _environment():
+        environment = InMemoryEnvironment()
+        for item in items:
+            environment.write('parent', 1, item=item, item_secondary=items_number + 1 + item % 10, symmetric=False, permanent=True)
+        return environment
+
+    def _generic(model):
+        environment = _environment()
+        for answer_id, user, item, asked, answered, answer_time, response_time, guess in rows:
+            model.predict_and_update(environment, user, item, asked == answered, answer_time, answer_id, guess=guess)
+            environment.process_answer(user, item, asked, answered, answer_time, answer_id, response_time, guess)
+
+    def _kernel(model):
+        environment = _environment()
+        model.replay_kernel(environment).replay(AnswerBatch.from_rows(rows))
+
+    print_row('model', 'answers', 'generic [ms]', 'kernel [ms]', 'speedup')
+    for model in [prediction.AveragePredictiveModel(), prediction.PriorCurrentPredictiveModel(), prediction.AlwaysLearningPredictiveModel()]:
+        generic = measure(lambda: _generic(model), repeat=1)
+        kernel = measure(lambda: _kernel(model), repeat=1)
+        print_row(model.__class__.__name__[:18], answers_number, '{:.0f}'.format(generic), '{:.0f}'.format(kernel), '{:.1f}x'.format(generic / kernel))
+
+
+@benchmark
+def brier(sizes=(10000, 100000, 1000000), bins=20):
+    """
+    Fill the bins of Brier score decomposition prediction by prediction and
+    by :mod:`proso.models.metrics`.
+    """
+    def _loop(predictions, real):
+        counts = numpy.zeros(bins)
+        correct = numpy.zeros(bins)
+        prediction = numpy.zeros(bins)
+        for p, r in zip(predictions, real):
+            b = min(int(p * bins), bins - 1)
+            counts[b] += 1
+            correct[b] += r
+            prediction[b] += p
+
+    print_row('predictions', 'loop [ms]', 'metrics [ms]', 'speedup')
+    for size in sizes:
+        random_state = numpy.random.RandomState(size)
+        predictions = random_state.random_sample(size)
+        real = (random_state.random_sample(size) < predictions).astype(float)
+        loop = measure(lambda: _loop(predictions, real), repeat=1)
+        vectorized = measure(lambda: metrics.report(predictions, real))
+        print_row(size, '{:.1f}'.format(loop), '{:.1f}'.format(vectorized), '{:.0f}x'.format(loop / vectorized))
+
+
+@benchmark
+def has_answer_cache(users_numbers=(100, 1000, 10000), items_number=1000, answered_number=20, n=50):
+    """
+    Look up whether a user has answered items in the cache with all flags
+    under one key and in :class:`proso.models.answer_cache.HasAnswerCache`.
+    The values are pickled as a cache server would do.
+    """
+    print_row('users', 'one key [ms]', 'per user [ms]', 'one key [kB]')
+    for users_number in users_numbers:
+        random.seed(users_number)
+        items = list(range(1, items_number + 1))
+        answered = {user: random.sample(items, answered_number) for user in range(users_number)}
+        one_key = _PicklingCache()
+        one_key.set('has_answer', {'{}_{}'.format(item, user): True for user, user_items in answered.items() for item in user_items})
+        per_user = HasAnswerCache(_PicklingCache())
+        for user, user_items in answered.items():
+            per_user.add(user_items, user=user)
+        user = random.randrange(users_number)
+        asked = random.sample(items, n)
+
+        def _one_key():
+            found = one_key.get('has_answer', {})
+            return {item: found.get('{}_{}'.format(item, user), False) for item in asked}
+
+        print_row(
+            users_number,
+            '{:.3f}'.format(measure(_one_key, number=10)),
+            '{:.3f}'.format(measure(lambda: per_user.answered(asked, user=user), number=10)),
+            len(one_key.data['has_answer']) // 1000)
+
+
+class _PicklingCache:
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key, default=None):
+        found = self.data.get(key)
+        return default if found is None else pickle.loads(found)
+
+    def set(self, key, value, timeout=None):
+        self.data[key] = pickle.dumps(value)
+
+    def get_many(self, keys):
+        return {key: pickle.loads(self.data[key]) for key in keys if key in self.data}
+
+    def set_many(self, data, timeout=None):
+        for key, value in data.items():
+            self.set(key, value)
+
+
+def main(names):
+    for name in names if names else BENCHMARKS.keys():
+        if name not in BENCHMARKS:
+            raise Exception('There is no benchmark "{}", available: {}'.format(name, ', '.join(BENCHMARKS.keys())))
+        print('-' * 80)
+        print(name)
+        print('-' * 80)
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
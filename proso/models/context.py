@@ -10,12 +10,27 @@ except (ImproperlyConfigured, ImportError):
     pass
 
 
+def reachable_parents(all_items):
+    """
+    Resolve parents of the given items, so they can be shared by more
+    :class:`selected_item_context` instances.
+
+    Returns:
+        dict: item -> list of reachable parents, None if Django is not ready
+    """
+    if DJANGO_READY:
+        return Item.objects.get_reachable_parents(all_items)
+    return None
+
+
 class selected_item_context:
 
-    def __init__(self, item, all_items):
+    def __init__(self, item, all_items, all_parents=None):
         global DJANGO_READY
         if DJANGO_READY:
-            parents = Item.objects.get_reachable_parents(all_items)[item]
+            if all_parents is None:
+                all_parents = Item.objects.get_reachable_parents(all_items)
+            parents = all_parents[item]
 
             def _custom_config_filter(key, value):
                 if key != 'selected_item_has_parent':
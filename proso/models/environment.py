@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 import abc
+import array
 import unittest
 import datetime
+import numpy
 from collections import defaultdict
 
 
@@ -57,6 +59,21 @@ class Environment(metaclass=abc.ABCMeta):
     def read_more_keys(self, keys, user=None, item=None, item_secondary=None, default=None, symmetric=True):
         pass
 
+    def read_more_keys_more_items(self, queries):
+        """
+        Read values of more keys for more items at once, it is used to load
+        variables needed for prediction in one round trip. Each query is
+        processed as by :meth:`read_more_items`, the item None stands for the
+        variable without an item.
+
+        Args:
+            queries (list): tuples (key, items, user, default)
+
+        Returns:
+            list: dictionaries item -> value for the given queries
+        """
+        return [self.read_more_items(key, items, user=user, default=default) for key, items, user, default in queries]
+
     @abc.abstractmethod
     def read_all_with_key(self, key):
         pass
@@ -100,6 +117,9 @@ class Environment(metaclass=abc.ABCMeta):
     def add_write_hook(self, write_hook):
         pass
 
+    def has_write_hooks(self):
+        return False
+
     def __repr__(self):
         return str(self.__class__)
 
@@ -164,11 +184,31 @@ class CommonEnvironment(Environment):
     def confusing_factor_more_items(self, item, items, user=None):
         pass
 
-        pass
+    def confusing_factor_more_pairs(self, items_with_options, user=None):
+        """
+        Get confusing factors of more items and their options at once. The
+        environments backed by a database should override this method to
+        avoid a round trip for each item.
+
+        Args:
+            items_with_options (dict): item -> list of options
+            user (int): identifier of the user, None for all users
+
+        Returns:
+            dict: item -> list of confusing factors in the order of the
+            given options
+        """
+        return {
+            item: self.confusing_factor_more_items(item, options, user=user)
+            for item, options in items_with_options.items()
+        }
 
     def add_write_hook(self, write_hook):
         self._write_hooks.append(write_hook)
 
+    def has_write_hooks(self):
+        return len(self._write_hooks) > 0
+
     def call_write_hooks(self, key, value, user, item, item_secondary, time, previous_value, answer):
         for hook in self._write_hooks:
             hook.event(key, value, user, item, item_secondary, time, previous_value, answer)
@@ -334,6 +374,29 @@ class InMemoryEnvironment(CommonEnvironment):
                         permanent, time, answer, value = values
                         yield (key, user, item_primary, item_secondary, permanent, time, answer, value)
 
+    def save(self, file):
+        """
+        Save all values to the given file (or file name) in the compressed
+        NumPy format, the environment can be restored by :meth:`load`.
+        """
+        numpy.savez_compressed(file, **self._save_arrays())
+
+    def load(self, file):
+        """
+        Load values saved by :meth:`save` to the environment.
+        """
+        with numpy.load(file) as arrays:
+            self._load_arrays(arrays)
+
+    def _save_arrays(self):
+        return encode_rows(list(self.export_values()), _VALUE_COLUMNS, 'values_')
+
+    def _load_arrays(self, arrays):
+        for key, user, item_primary, item_secondary, permanent, time, answer, value in decode_rows(arrays, _VALUE_COLUMNS, 'values_'):
+            self.write(
+                key, value, user=user, item=item_primary, item_secondary=item_secondary,
+                time=time, symmetric=False, permanent=permanent, answer=answer)
+
     def _get(self, key, user=None, item=None, item_secondary=None, symmetric=True):
         items = [item_secondary, item]
         if symmetric and item is not None and item_secondary is not None:
@@ -341,6 +404,329 @@ class InMemoryEnvironment(CommonEnvironment):
         return self._data[key][user][items[1]].get(items[0])
 
 
+class ArrayInMemoryEnvironment(InMemoryEnvironment):
+
+    """
+    In-memory environment suitable for replaying a large number of answers.
+    Users and items are mapped to dense indices and values, times and answer
+    ids of each key are kept in growable NumPy arrays. Variables related to
+    pairs of items are stored in a sparse side table.
+    """
+
+    def __init__(self):
+        CommonEnvironment.__init__(self)
+        self._user_index = {None: 0}
+        self._user_ids = [None]
+        self._item_index = {None: 0}
+        self._item_ids = [None]
+        # key -> columns with (permanent, time, answer, value)
+        self._columns = {}
+        # key -> user << 32 | item_primary -> slot
+        self._slots = defaultdict(dict)
+        # key -> user << 32 | item_primary -> item_secondary -> slot
+        self._pairs = defaultdict(lambda: defaultdict(dict))
+
+    def get_items_with_values(self, key, item, user=None):
+        code = self._code(user, item)
+        if code is None or key not in self._columns:
+            return []
+        result = []
+        slot = self._slots[key].get(code)
+        if slot is not None:
+            result.append((None, slot))
+        result += [(self._item_ids[s], slot) for s, slot in self._pairs[key].get(code, {}).items()]
+        if len(result) == 0:
+            return []
+        values = self._columns[key].take('values', [slot for _, slot in result]).tolist()
+        return [(i, v) for (i, _), v in zip(result, values)]
+
+    def read(self, key, user=None, item=None, item_secondary=None, default=None, symmetric=True):
+        slot = self._slot(key, user, item, item_secondary, symmetric)
+        if slot < 0:
+            return default
+        return self._columns[key].values[slot]
+
+    def read_more_items(self, key, items, user=None, item=None, default=None, symmetric=True):
+        slots = self._slots_more_items(key, items, user, item, symmetric)
+        found = slots >= 0
+        result = {i: default for i in items}
+        if found.any():
+            values = self._columns[key].take('values', slots[found]).tolist()
+            result.update(zip([i for i, f in zip(items, found) if f], values))
+        return result
+
+    def read_all_with_key(self, key):
+        if key not in self._columns:
+            return []
+        return [(u, i_p, i_s, v) for (u, i_p, i_s, _, _, _, v) in self._export_key(key)]
+
+    def write(self, key, value, user=None, item=None, item_secondary=None, time=None, symmetric=True, permanent=False, answer=None):
+        value = float(value)
+        if time is None:
+            time = datetime.datetime.now()
+        primary, secondary = _normalize_items(item, item_secondary, symmetric)
+        code = self._index_user(user) << 32 | self._index_item(primary)
+        if secondary is None:
+            table, table_key = self._slots[key], code
+        else:
+            table, table_key = self._pairs[key][code], self._index_item(secondary)
+        columns = self._columns.get(key)
+        if columns is None:
+            columns = _Columns()
+            self._columns[key] = columns
+        slot = table.get(table_key)
+        previous_value = None
+        if slot is None:
+            table[table_key] = columns.append(permanent, time, answer, value)
+        else:
+            if bool(columns.permanent[slot]) != permanent:
+                raise Exception("The variable %s for items %s, %s and user %s changed permamency from %s to %s" % (
+                    key, item, item_secondary, user, bool(columns.permanent[slot]), permanent
+                ))
+            previous_value = columns.values[slot]
+            columns.set(slot, permanent, time, answer, value)
+        self.call_write_hooks(key, value, user, item, item_secondary, time, previous_value, answer)
+
+    def delete(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        slot = self._slot(key, user, item, item_secondary, symmetric)
+        if slot < 0:
+            return
+        if not self._columns[key].permanent[slot]:
+            raise Exception("Can't delete variable %s which is not permanent." % key)
+        primary, secondary = _normalize_items(item, item_secondary, symmetric)
+        code = self._code(user, primary)
+        if secondary is None:
+            del self._slots[key][code]
+        else:
+            del self._pairs[key][code][self._item_index[secondary]]
+            if len(self._pairs[key][code]) == 0:
+                del self._pairs[key][code]
+
+    def time(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        slot = self._slot(key, user, item, item_secondary, symmetric)
+        if slot < 0:
+            return None
+        return self._columns[key].get_time(slot)
+
+    def time_more_items(self, key, items, user=None, item=None, symmetric=True):
+        slots = self._slots_more_items(key, items, user, item, symmetric)
+        found = slots >= 0
+        result = {i: None for i in items}
+        if found.any():
+            times = self._columns[key].take_times(slots[found])
+            result.update(zip([i for i, f in zip(items, found) if f], times))
+        return result
+
+    def export_values(self):
+        for key in self._columns:
+            for (user, item_primary, item_secondary, permanent, time, answer, value) in self._export_key(key):
+                yield (key, user, item_primary, item_secondary, permanent, time, answer, value)
+
+    def _export_key(self, key):
+        columns = self._columns[key]
+        found = [(code, None, slot) for code, slot in self._slots[key].items()]
+        found += [(code, s, slot) for code, secondaries in self._pairs[key].items() for s, slot in secondaries.items()]
+        if len(found) == 0:
+            return
+        slots = [slot for _, _, slot in found]
+        permanents = columns.take('permanent', slots).tolist()
+        times = columns.take_times(slots)
+        answers = columns.take('answers', slots).tolist()
+        values = columns.take('values', slots).tolist()
+        for (code, s, _), p, t, a, v in zip(found, permanents, times, answers, values):
+            yield (
+                self._user_ids[code >> 32], self._item_ids[code & 0xFFFFFFFF],
+                None if s is None else self._item_ids[s], bool(p), t, None if a < 0 else a, v
+            )
+
+    def _slot(self, key, user, item, item_secondary, symmetric):
+        primary, secondary = _normalize_items(item, item_secondary, symmetric)
+        code = self._code(user, primary)
+        if code is None:
+            return -1
+        if secondary is None:
+            return self._slots[key].get(code, -1) if key in self._slots else -1
+        secondary_index = self._item_index.get(secondary)
+        if secondary_index is None or key not in self._pairs:
+            return -1
+        return self._pairs[key].get(code, {}).get(secondary_index, -1)
+
+    def _slots_more_items(self, key, items, user, item, symmetric):
+        user_index = self._user_index.get(user)
+        if user_index is None or key not in self._columns:
+            return numpy.full(len(items), -1, dtype=numpy.int64)
+        item_index = self._item_index
+        if item is None:
+            slots = self._slots[key]
+            user_code = user_index << 32
+            return numpy.fromiter(
+                (slots.get(user_code | item_index[i], -1) if i in item_index else -1 for i in items),
+                dtype=numpy.int64, count=len(items))
+        pairs = self._pairs[key]
+
+        def _pair_slot(i):
+            primary, secondary = _normalize_items(i, item, symmetric)
+            if primary not in item_index or secondary not in item_index:
+                return -1
+            return pairs.get(user_index << 32 | item_index[primary], {}).get(item_index[secondary], -1)
+        return numpy.fromiter((_pair_slot(i) for i in items), dtype=numpy.int64, count=len(items))
+
+    def _code(self, user, item):
+        user_index = self._user_index.get(user)
+        item_index = self._item_index.get(item)
+        if user_index is None or item_index is None:
+            return None
+        return user_index << 32 | item_index
+
+    def _index_user(self, user):
+        index = self._user_index.get(user)
+        if index is None:
+            index = len(self._user_ids)
+            self._user_index[user] = index
+            self._user_ids.append(user)
+        return index
+
+    def _index_item(self, item):
+        index = self._item_index.get(item)
+        if index is None:
+            index = len(self._item_ids)
+            self._item_index[item] = index
+            self._item_ids.append(item)
+        return index
+
+
+class _Columns:
+
+    EPOCH = datetime.datetime(1970, 1, 1)
+    MICROSECOND = datetime.timedelta(microseconds=1)
+    DTYPES = {
+        'permanent': numpy.int8,
+        'times': numpy.int64,
+        'aware': numpy.int8,
+        'answers': numpy.int64,
+        'values': numpy.float64,
+    }
+
+    def __init__(self):
+        self.permanent = array.array('b')
+        self.times = array.array('q')
+        self.aware = array.array('b')
+        self.answers = array.array('q')
+        self.values = array.array('d')
+
+    def append(self, permanent, time, answer, value):
+        self.permanent.append(permanent)
+        self.times.append(self.encode_time(time))
+        self.aware.append(self.is_aware(time))
+        self.answers.append(-1 if answer is None else answer)
+        self.values.append(value)
+        return len(self.values) - 1
+
+    def set(self, slot, permanent, time, answer, value):
+        self.permanent[slot] = permanent
+        self.times[slot] = self.encode_time(time)
+        self.aware[slot] = self.is_aware(time)
+        self.answers[slot] = -1 if answer is None else answer
+        self.values[slot] = value
+
+    def take(self, name, slots):
+        return numpy.frombuffer(getattr(self, name), dtype=self.DTYPES[name])[slots]
+
+    def take_times(self, slots):
+        return [self.decode_time(t, a) for t, a in zip(self.take('times', slots).tolist(), self.take('aware', slots).tolist())]
+
+    def get_time(self, slot):
+        return self.decode_time(self.times[slot], self.aware[slot])
+
+    @classmethod
+    def encode_time(cls, time):
+        """
+        Microseconds since the epoch, aware times are normalized to UTC and
+        naive times are taken as they are.
+        """
+        if cls.is_aware(time):
+            time = time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return (time - cls.EPOCH) // cls.MICROSECOND
+
+    @classmethod
+    def decode_time(cls, time, aware=False):
+        result = cls.EPOCH + time * cls.MICROSECOND
+        return result.replace(tzinfo=datetime.timezone.utc) if aware else result
+
+    @staticmethod
+    def is_aware(time):
+        return time.tzinfo is not None and time.utcoffset() is not None
+
+
+_VALUE_COLUMNS = [
+    ('keys', 'str'),
+    ('users', 'id'),
+    ('items_primary', 'id'),
+    ('items_secondary', 'id'),
+    ('permanent', 'bool'),
+    ('times', 'time'),
+    ('answers', 'id'),
+    ('values', 'float'),
+]
+
+_NO_TIME = numpy.iinfo(numpy.int64).min
+
+_ENCODERS = {
+    'str': lambda xs: numpy.array(xs, dtype=str),
+    'id': lambda xs: numpy.array([-1 if x is None else x for x in xs], dtype=numpy.int64),
+    'bool': lambda xs: numpy.array(xs, dtype=bool),
+    'time': lambda xs: numpy.array([_NO_TIME if x is None else _Columns.encode_time(x) for x in xs], dtype=numpy.int64),
+    'float': lambda xs: numpy.array(xs, dtype=numpy.float64),
+}
+
+_DECODERS = {
+    'str': lambda xs: xs.tolist(),
+    'id': lambda xs: [None if x < 0 else x for x in xs.tolist()],
+    'bool': lambda xs: xs.tolist(),
+    'time': lambda xs, aware: [None if x == _NO_TIME else _Columns.decode_time(x, a) for x, a in zip(xs.tolist(), aware)],
+    'float': lambda xs: xs.tolist(),
+}
+
+
+def encode_rows(rows, columns, prefix):
+    """
+    Encode rows of values to a dictionary of arrays, the columns are given as
+    a list of (name, type) pairs, None is allowed for ids and times. Times are
+    stored in UTC, the array '<name>_aware' marks the times which were aware
+    and are restored as aware (UTC) times.
+    """
+    transposed = list(zip(*rows)) if len(rows) > 0 else [[] for _ in columns]
+    result = {}
+    for (name, kind), values in zip(columns, transposed):
+        result[prefix + name] = _ENCODERS[kind](values)
+        if kind == 'time':
+            result[prefix + name + '_aware'] = numpy.array([x is not None and _Columns.is_aware(x) for x in values], dtype=bool)
+    return result
+
+
+def decode_rows(arrays, columns, prefix):
+    """
+    Decode rows encoded by :func:`encode_rows`.
+    """
+    decoded = []
+    for name, kind in columns:
+        values = arrays[prefix + name]
+        if kind == 'time':
+            # files saved before the awareness was stored contain naive times
+            aware_name = prefix + name + '_aware'
+            aware = arrays[aware_name].tolist() if aware_name in arrays else [False] * len(values)
+            decoded.append(_DECODERS[kind](values, aware))
+        else:
+            decoded.append(_DECODERS[kind](values))
+    return list(zip(*decoded))
+
+
+def _normalize_items(item, item_secondary, symmetric):
+    if symmetric and item is not None and item_secondary is not None and item_secondary > item:
+        return item_secondary, item
+    return item, item_secondary
+
+
 ################################################################################
 # Tests
 ################################################################################
@@ -444,6 +830,28 @@ class TestEnvironment(unittest.TestCase, metaclass=abc.ABCMeta):
         self.assertDictEqual({i: v + 5 for v, i in enumerate(items)}, env.read_more_items('key', items, user=user))
         self.assertDictEqual({i: v + 10 for v, i in enumerate(items)}, env.read_more_items('key', items=items, user=user, item=item))
 
+    def test_read_more_keys_more_items(self):
+        env = self.generate_environment()
+        items = [self.generate_item() for i in range(3)]
+        user = self.generate_user()
+        env.write('k1', 1, user=user)
+        for v, i in enumerate(items):
+            env.write('k1', v, item=i)
+            env.write('k1', v + 10, user=user, item=i)
+            env.write('k2', v + 20, item=i)
+        env.write('k2', 30, user=user, item=items[0], item_secondary=items[1])
+        self.assertEqual([
+            {i: v for v, i in enumerate(items)},
+            {items[0]: 10, None: 1},
+            {i: v + 20 for v, i in enumerate(items[1:], start=1)},
+            {i: -1 for i in items},
+        ], env.read_more_keys_more_items([
+            ('k1', items, None, None),
+            ('k1', [items[0], None], user, None),
+            ('k2', items[1:], None, None),
+            ('k2', items, user, -1),
+        ]))
+
     def test_read_more_keys(self):
         env = self.generate_environment()
         item = self.generate_item()
@@ -1,4 +1,5 @@
 import abc
+import heapq
 import random
 import math
 import logging
@@ -141,8 +142,9 @@ class ScoreItemSelection(ItemSelection):
         answers_num = environment.number_of_answers_more_items(user=user, items=related_items)
         last_answer_time = environment.last_answer_time_more_items(user=user, items=related_items)
         probability = self.get_predictions(environment, user, items, time)
-        last_answer_time_parents = self._last_answer_time_for_parents(environment, parents, last_answer_time)
-        answers_num_parents = self._answers_num_for_parents(environment, parents, answers_num)
+        parent_index = ParentIndex(parents)
+        last_answer_time_parents = self._last_answer_time_for_parents(environment, parent_index, last_answer_time, time)
+        answers_num_parents = self._answers_num_for_parents(environment, parent_index, answers_num)
         prob_target = self.get_target_probability(environment, user, practice_context=practice_context)
 
         if proso.django.log.is_active():
@@ -150,67 +152,140 @@ class ScoreItemSelection(ItemSelection):
                 if len(parents.get(item, [])) == 0:
                     LOGGER.warn("The item %s has no parent" % item)
 
-        def _score(item):
-            return (
-                self._weight_probability * self._score_probability(prob_target, probability[item]) +
-                self._weight_time_ago * self._score_last_answer_time(last_answer_time[item], time) +
-                self._weight_number_of_answers * self._score_answers_num(answers_num[item]),
-                random.random()
-            )
+        base_scores = (
+            self._weight_probability * self._score_probability_more_items(
+                prob_target, numpy.array([probability[i] for i in items], dtype=float)) +
+            self._weight_time_ago * self._score_last_answer_time_more_items(
+                _seconds_ago([last_answer_time[i] for i in items], time)) +
+            self._weight_number_of_answers * self._score_answers_num_more_items(
+                numpy.array([answers_num[i] for i in items], dtype=float))
+        )
+        randoms = [random.random() for _ in items]
+
+        def _log_chosen(chosen, score):
+            if proso.django.log:
+                LOGGER.debug(
+                    'selecting %s (total_score %.2f, prob: %.4f, prob score %.2f, time: %s, time_score %.2f, answers: %s, answers score %.2f, parents %s)' %
+                    (
+                        chosen, score[0],
+                        probability[chosen],
+                        self._weight_probability * self._score_probability(prob_target, probability[chosen]),
+                        last_answer_time[chosen],
+                        self._weight_time_ago * self._score_last_answer_time(last_answer_time[chosen], time),
+                        answers_num[chosen],
+                        self._weight_number_of_answers * self._score_answers_num(answers_num[chosen]),
+                        [x[0] for x in parents[chosen]])
+                )
 
-        def _finish_score(xxx_todo_changeme):
-            ((score, r), i) = xxx_todo_changeme
-            total = 0.0
-            parent_time_score = 0.0
-            parent_answers_num_score = 0.0
-            for p, v in parents[i]:
-                parent_time_score += v * self._score_last_answer_time(last_answer_time_parents[p], time)
-                parent_answers_num_score += v * self._score_answers_num(answers_num_parents[p])
-                total += 1
-            if total > 0:
-                parent_time_score = parent_time_score / total
-                parent_answers_num_score = parent_answers_num_score / total
-            score += self._weight_parent_time_ago * parent_time_score
-            score += self._weight_parent_number_of_answers * parent_answers_num_score
-            return (score, r), i
-
-        scored = [(_score(item), item) for item in items]
         if self._recompute_parent_score:
-            candidates = []
-            while len(candidates) < n and len(scored) > 0:
-                finished = list(map(_finish_score, scored))
-                score, chosen = max(finished)
-                if proso.django.log:
-                    LOGGER.debug(
-                        'selecting %s (total_score %.2f, prob: %.4f, prob score %.2f, time: %s, time_score %.2f, answers: %s, answers score %.2f, parents %s)' %
-                        (
-                            chosen, score[0],
-                            probability[chosen],
-                            self._weight_probability * self._score_probability(prob_target, probability[chosen]),
-                            last_answer_time[chosen],
-                            self._weight_time_ago * self._score_last_answer_time(last_answer_time[chosen], time),
-                            answers_num[chosen],
-                            self._weight_number_of_answers * self._score_answers_num(answers_num[chosen]),
-                            [x[0] for x in parents[chosen]])
-                    )
-                candidates.append(chosen)
-                for p, v in parents[chosen]:
-                    last_answer_time_parents[p] = time
-                scored = [score_i for score_i in scored if score_i[1] != chosen]
+            candidates = self._select_recomputing_parent_score(
+                items, n, base_scores, randoms, parents, parent_index,
+                last_answer_time_parents, answers_num_parents, _log_chosen)
         else:
+            scored = [((score, r), item) for score, r, item in zip(base_scores.tolist(), randoms, items)]
             candidates = [score_r_i[1] for score_r_i in sorted(scored, reverse=True)[:min(len(scored), n)]]
 
         return candidates, [None for _ in candidates]
 
+    def _select_recomputing_parent_score(self, items, n, base_scores, randoms, parents, parent_index, last_answer_time_parents, answers_num_parents, log_chosen):
+        """
+        Choose items one by one, each chosen item changes the last answer
+        time of its parents, so the items sharing a parent with the chosen
+        one are rescored. The candidates are kept in a heap and only the
+        rescored ones are pushed again, outdated entries are skipped when
+        popped. An item given more times is chosen at most once (by its best
+        scored copy), the other copies are dropped.
+        """
+        edges = parent_index.edges(items, parents)
+        children, parent_positions, weights = edges
+        parent_time_scores = self._score_last_answer_time_more_items(last_answer_time_parents)
+        parent_answers_num_scores = self._score_answers_num_more_items(answers_num_parents)
+        parent_answers_num_component = self._parent_component(edges, parent_answers_num_scores, len(items))
+        finished = (
+            base_scores +
+            self._weight_parent_time_ago * self._parent_component(edges, parent_time_scores, len(items)) +
+            self._weight_parent_number_of_answers * parent_answers_num_component
+        )
+        counts = numpy.bincount(children, minlength=len(items))
+        child_edges = _EdgeGroups(children, len(items))
+        parent_edges = _EdgeGroups(parent_positions, len(parent_index.parents))
+
+        def _finish_scores(rescored):
+            # the edges are taken in the original order, so the sums are the
+            # same as the sums by bincount over all edges
+            found = numpy.sort(child_edges.edges(rescored))
+            totals = numpy.bincount(
+                numpy.searchsorted(rescored, children[found]),
+                weights=weights[found] * parent_time_scores[parent_positions[found]],
+                minlength=len(rescored))
+            return (
+                base_scores[rescored] +
+                self._weight_parent_time_ago * (totals / counts[rescored]) +
+                self._weight_parent_number_of_answers * parent_answers_num_component[rescored]
+            )
+
+        # the heap is ordered in ascending way, so the rank of the greatest
+        # item is the lowest one
+        by_rank = sorted(range(len(items)), key=lambda j: items[j], reverse=True)
+        rank = numpy.empty(len(items), dtype=int)
+        rank[by_rank] = numpy.arange(len(items))
+        rank = rank.tolist()
+        current = {}
+        copies = defaultdict(list)
+        for j, score in enumerate(finished.tolist()):
+            current[j] = (-score, -randoms[j], rank[j])
+            copies[items[j]].append(j)
+        heap = list(current.values())
+        heapq.heapify(heap)
+        candidates = []
+        while len(candidates) < n and len(heap) > 0:
+            entry = heapq.heappop(heap)
+            chosen = by_rank[entry[2]]
+            if current.get(chosen) is not entry:
+                continue
+            log_chosen(items[chosen], (-entry[0], -entry[1]))
+            candidates.append(items[chosen])
+            for j in copies[items[chosen]]:
+                current.pop(j, None)
+            chosen_parents = numpy.unique([parent_index.index[p] for p, v in parents[items[chosen]]])
+            if len(chosen_parents) == 0:
+                continue
+            # the last answer time of the parents is now, so the score is the lowest one
+            parent_time_scores[chosen_parents] = self._score_last_answer_time_more_items(numpy.zeros(len(chosen_parents)))
+            rescored = numpy.unique(children[parent_edges.edges(chosen_parents)])
+            scores = _finish_scores(rescored)
+            changed = scores != finished[rescored]
+            for j, score in zip(rescored[changed].tolist(), scores[changed].tolist()):
+                if j in current:
+                    current[j] = (-score, -randoms[j], rank[j])
+                    heapq.heappush(heap, current[j])
+            finished[rescored] = scores
+        return candidates
+
+    def _parent_component(self, edges, parent_scores, items_number):
+        children, parent_positions, weights = edges
+        counts = numpy.bincount(children, minlength=items_number)
+        totals = numpy.bincount(children, weights=weights * parent_scores[parent_positions], minlength=items_number)
+        return numpy.divide(totals, counts, out=numpy.zeros(items_number), where=counts > 0)
+
     def _score_answers_num(self, answers_num):
         return 0.5 / max(math.sqrt(answers_num), 0.5)
 
+    def _score_answers_num_more_items(self, answers_num):
+        return 0.5 / numpy.maximum(numpy.sqrt(answers_num), 0.5)
+
     def _score_probability(self, target_probability, probability):
         diff = target_probability - probability
         sign = 1 if diff > 0 else -1
         normed_diff = abs(diff) / max(0.001, abs(target_probability - 0.5 + sign * 0.5))
         return 1 - normed_diff ** 2
 
+    def _score_probability_more_items(self, target_probability, probability):
+        diff = target_probability - probability
+        sign = numpy.where(diff > 0, 1, -1)
+        normed_diff = numpy.abs(diff) / numpy.maximum(0.001, numpy.abs(target_probability - 0.5 + sign * 0.5))
+        return 1 - normed_diff ** 2
+
     def _score_last_answer_time(self, last_answer_time, time):
         if last_answer_time is None:
             return 0.0
@@ -219,32 +294,113 @@ class ScoreItemSelection(ItemSelection):
             return -1.0
         return -1 + numpy.log2(min(seconds_ago, self._time_ago_max)) / numpy.log2(self._time_ago_max)
 
-    def _answers_num_for_parents(self, environment, parents, answers_num):
-        children = defaultdict(list)
-        for i, ps in parents.items():
-            for p, v in ps:
-                children[p].append(i)
+    def _score_last_answer_time_more_items(self, seconds_ago):
+        """
+        Args:
+            seconds_ago (numpy.ndarray): seconds since the last answer, NaN
+                if there is no answer
+        """
+        result = numpy.zeros(len(seconds_ago))
+        answered = ~numpy.isnan(seconds_ago)
+        positive = answered & (seconds_ago > 0)
+        result[answered] = -1.0
+        result[positive] = -1 + numpy.log2(numpy.minimum(seconds_ago[positive], self._time_ago_max)) / numpy.log2(self._time_ago_max)
+        return result
+
+    def _answers_num_for_parents(self, environment, parent_index, answers_num):
+        """
+        Returns:
+            numpy.ndarray: the number of answers for each parent in the given
+                parent index
+        """
+        children, parent_positions, _ = parent_index.all_edges
+        values = numpy.array([answers_num[ch] for ch in parent_index.children], dtype=float)
+        return numpy.bincount(parent_positions, weights=values[children], minlength=len(parent_index.parents))
 
-        return dict([(p_chs[0], sum([answers_num[ch] for ch in p_chs[1]])) for p_chs in list(children.items())])
+    def _last_answer_time_for_parents(self, environment, parent_index, last_answer_time, time):
+        """
+        Returns:
+            numpy.ndarray: seconds since the last answer of any child for
+                each parent in the given parent index, NaN if there is no
+                answer
+        """
+        children, parent_positions, _ = parent_index.all_edges
+        seconds_ago = _seconds_ago([last_answer_time[ch] for ch in parent_index.children], time)
+        result = numpy.full(len(parent_index.parents), numpy.inf)
+        numpy.minimum.at(result, parent_positions, numpy.where(numpy.isnan(seconds_ago), numpy.inf, seconds_ago)[children])
+        result[numpy.isinf(result)] = numpy.nan
+        return result
+
+    def __str__(self):
+        return 'SCORE BASED ITEM SELECTION: target probability {0:.2f}, weight probability {1:.2f}, weight time {2:.2f}, weight answers {3:.2f}'.format(
+            self._target_probability, self._weight_probability, self._weight_time_ago, self._weight_number_of_answers)
 
-    def _last_answer_time_for_parents(self, environment, parents, last_answer_time):
-        children = defaultdict(list)
-        for i, ps in parents.items():
+
+class ParentIndex:
+
+    """
+    Dense index of parents taken from the item -> [(parent, weight)] mapping.
+    All (child, parent, weight) relations are available as arrays of
+    positions, so values of parents can be aggregated by vectorized
+    operations.
+    """
+
+    def __init__(self, parents):
+        self.parents = []
+        self.index = {}
+        self.children = []
+        children_index = {}
+        edge_children, edge_parents, edge_weights = [], [], []
+        for child, ps in parents.items():
             for p, v in ps:
-                children[p].append(i)
+                if p not in self.index:
+                    self.index[p] = len(self.parents)
+                    self.parents.append(p)
+                if child not in children_index:
+                    children_index[child] = len(self.children)
+                    self.children.append(child)
+                edge_children.append(children_index[child])
+                edge_parents.append(self.index[p])
+                edge_weights.append(v)
+        self.all_edges = (
+            numpy.array(edge_children, dtype=int),
+            numpy.array(edge_parents, dtype=int),
+            numpy.array(edge_weights, dtype=float),
+        )
+
+    def edges(self, items, parents):
+        """
+        Returns:
+            tuple: arrays of positions of the given items, positions of their
+                parents and weights of the relations
+        """
+        found = [(j, self.index[p], v) for j, i in enumerate(items) for p, v in parents[i]]
+        if len(found) == 0:
+            return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int), numpy.zeros(0)
+        children, parent_positions, weights = zip(*found)
+        return numpy.array(children, dtype=int), numpy.array(parent_positions, dtype=int), numpy.array(weights, dtype=float)
 
-        def _max_time_from_items(xs):
-            times = [x for x in [last_answer_time[x] for x in xs] if x is not None]
-            if len(times) > 0:
-                return max(times)
-            else:
-                return None
 
-        return dict([(p_chs1[0], _max_time_from_items(p_chs1[1])) for p_chs1 in list(children.items())])
+class _EdgeGroups:
 
-    def __str__(self):
-        return 'SCORE BASED ITEM SELECTION: target probability {0:.2f}, weight probability {1:.2f}, weight time {2:.2f}, weight answers {3:.2f}'.format(
-            self._target_probability, self._weight_probability, self._weight_time_ago, self._weight_number_of_answers)
+    """
+    Positions of edges grouped by the given keys (positions of children or
+    parents), the positions in a group keep the order of edges.
+    """
+
+    def __init__(self, keys, keys_number):
+        self._order = numpy.argsort(keys, kind='stable')
+        self._starts = numpy.concatenate([[0], numpy.cumsum(numpy.bincount(keys, minlength=keys_number))])
+
+    def edges(self, keys):
+        starts = self._starts[keys]
+        lengths = self._starts[keys + 1] - starts
+        offsets = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+        return self._order[numpy.repeat(starts, lengths) + offsets]
+
+
+def _seconds_ago(times, time):
+    return numpy.array([numpy.nan if t is None else (time - t).total_seconds() for t in times], dtype=float)
 
 
 def adjust_target_probability(target_probability, rolling_success):
@@ -0,0 +1,180 @@
+"""
+Metrics evaluating predictions of a predictive model. The metrics can be
+computed incrementally, predictions can be added in chunks while the answers
+are replayed, so they do not have to be kept in memory.
+
+.. testsetup::
+
+    from proso.models.metrics import Metrics
+    import numpy
+
+.. testcode::
+
+    metrics = Metrics()
+    metrics.update(numpy.array([0.9, 0.2]), numpy.array([1, 0]))
+    metrics.update(numpy.array([0.6]), numpy.array([0]))
+    print(round(metrics.rmse(), 3), metrics.auc())
+
+.. testoutput::
+
+    0.37 1.0
+"""
+
+import math
+import numpy
+
+
+class Metrics:
+
+    """
+    Streaming computation of RMSE, log-loss, AUC and Brier score
+    decomposition. Predictions are assigned to the given number of bins of
+    the same width, AUC is computed from a histogram of predictions with the
+    given (finer) resolution, predictions in the same AUC bin are considered
+    as ties.
+
+    Args:
+        bins (int): number of bins for Brier score decomposition
+        auc_bins (int): number of bins for AUC
+        eps (float): predictions are clipped to [eps, 1 - eps] to compute
+            log-loss
+    """
+
+    def __init__(self, bins=20, auc_bins=10000, eps=1e-15):
+        self._bins = bins
+        self._auc_bins = auc_bins
+        self._eps = eps
+        self._counts = numpy.zeros(bins)
+        self._correct = numpy.zeros(bins)
+        self._prediction = numpy.zeros(bins)
+        self._log_loss = numpy.zeros(bins)
+        self._squared_error = 0.0
+        self._auc_correct = numpy.zeros(auc_bins)
+        self._auc_counts = numpy.zeros(auc_bins)
+
+    def update(self, predictions, real):
+        """
+        Add a chunk of predictions.
+
+        Args:
+            predictions (numpy.ndarray): predicted probabilities
+            real (numpy.ndarray): real outcomes (0 or 1)
+        """
+        predictions = numpy.asarray(predictions, dtype=float)
+        real = numpy.asarray(real, dtype=float)
+        if len(predictions) != len(real):
+            raise Exception("The number of predictions ({}) and real outcomes ({}) differs.".format(len(predictions), len(real)))
+        bins = _bin_indexes(predictions, self._bins)
+        self._counts += numpy.bincount(bins, minlength=self._bins)
+        self._correct += numpy.bincount(bins, weights=real, minlength=self._bins)
+        self._prediction += numpy.bincount(bins, weights=predictions, minlength=self._bins)
+        clipped = numpy.clip(predictions, self._eps, 1 - self._eps)
+        log_loss = -(real * numpy.log(clipped) + (1 - real) * numpy.log(1 - clipped))
+        self._log_loss += numpy.bincount(bins, weights=log_loss, minlength=self._bins)
+        self._squared_error += float(numpy.sum((predictions - real) ** 2))
+        auc_bins = _bin_indexes(predictions, self._auc_bins)
+        self._auc_counts += numpy.bincount(auc_bins, minlength=self._auc_bins)
+        self._auc_correct += numpy.bincount(auc_bins, weights=real, minlength=self._auc_bins)
+
+    def size(self):
+        return int(self._counts.sum())
+
+    def rmse(self):
+        """
+        Returns:
+            float: root mean squared error, NaN if there are no predictions
+        """
+        if self.size() == 0:
+            return float('nan')
+        return math.sqrt(self._squared_error / self.size())
+
+    def log_loss(self):
+        """
+        Returns:
+            float: mean log-loss, NaN if there are no predictions
+        """
+        if self.size() == 0:
+            return float('nan')
+        return float(self._log_loss.sum() / self.size())
+
+    def auc(self):
+        """
+        Returns:
+            float: area under the ROC curve, None if all outcomes are the same
+        """
+        positives = self._auc_correct
+        negatives = self._auc_counts - self._auc_correct
+        total = positives.sum() * negatives.sum()
+        if total == 0:
+            return None
+        negatives_below = numpy.cumsum(negatives) - negatives
+        return float(numpy.sum(positives * (negatives_below + 0.5 * negatives)) / total)
+
+    def brier(self):
+        """
+        Returns:
+            dict: Brier score decomposition, the components are NaN if there
+            are no predictions
+        """
+        counts = self._counts
+        size = self.size()
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            prediction_means = self._prediction / counts
+            correct_means = self._correct / counts
+            log_loss_means = self._log_loss / counts
+            answer_mean = self._correct.sum() / size if size > 0 else float('nan')
+            size = size if size > 0 else float('nan')
+        empty = counts == 0
+        prediction_means[empty] = ((numpy.arange(self._bins) + 0.5) / self._bins)[empty]
+        correct_means[empty] = 0
+        log_loss_means[empty] = 0
+        return {
+            "reliability": float(numpy.sum(counts * (correct_means - prediction_means) ** 2) / size),
+            "resolution": float(numpy.sum(counts * (correct_means - answer_mean) ** 2) / size),
+            "uncertainty": float(answer_mean * (1 - answer_mean)),
+            "detail": {
+                "bin_count": self._bins,
+                "bin_counts": counts.tolist(),
+                "bin_prediction_means": prediction_means.tolist(),
+                "bin_correct_means": correct_means.tolist(),
+                "bin_log_loss": log_loss_means.tolist(),
+            }
+        }
+
+    def report(self):
+        return {
+            'rmse': self.rmse(),
+            'log_loss': self.log_loss(),
+            'auc': self.auc(),
+            'brier': self.brier(),
+        }
+
+
+def report(predictions, real, **kwargs):
+    return _metrics(predictions, real, **kwargs).report()
+
+
+def rmse(predictions, real):
+    return _metrics(predictions, real).rmse()
+
+
+def log_loss(predictions, real, **kwargs):
+    return _metrics(predictions, real, **kwargs).log_loss()
+
+
+def auc(predictions, real, **kwargs):
+    return _metrics(predictions, real, **kwargs).auc()
+
+
+def brier(predictions, real, bins=20):
+    return _metrics(predictions, real, bins=bins).brier()
+
+
+def _metrics(predictions, real, **kwargs):
+    metrics = Metrics(**kwargs)
+    metrics.update(predictions, real)
+    return metrics
+
+
+def _bin_indexes(predictions, bins):
+    return numpy.clip((predictions * bins).astype(int), 0, bins - 1)
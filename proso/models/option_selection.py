@@ -1,7 +1,7 @@
 from collections import defaultdict
 from mock import MagicMock
 from proso.func import get_maybe_lazy
-from proso.models.context import selected_item_context
+from proso.models.context import reachable_parents, selected_item_context
 import abc
 import logging
 import math
@@ -40,19 +40,28 @@ class OptionSelection(metaclass=abc.ABCMeta):
             allow_zero_options = defaultdict(lambda: True)
         predictions = self._item_selector.get_predictions(environment)
         target_probability = self._item_selector.get_target_probability(environment, user, None)
-        result = []
+        all_parents = reachable_parents(items)
+        numbers_of_options = {}
+        items_with_options = {}
         for item in items:
-            with selected_item_context(item, items):
+            with selected_item_context(item, items, all_parents=all_parents):
                 prediction = predictions[item]
                 item_options = [o for o in options[item] if o != item]
                 if prediction is None:
                     raise ValueError("Prediction for item {} is missing.".format(item))
-                number_of_options = self.options_number().get_number_of_options(target_probability, prediction, allow_zero_options[item], len(item_options))
-                if number_of_options == 0:
-                    result.append([])
-                    continue
-                confusing_factors = dict(zip(item_options, environment.confusing_factor_more_items(item, item_options)))
-                result_options = self.compute_options(target_probability, prediction, number_of_options, confusing_factors)
+                numbers_of_options[item] = self.options_number().get_number_of_options(target_probability, prediction, allow_zero_options[item], len(item_options))
+                if numbers_of_options[item] != 0:
+                    items_with_options[item] = item_options
+        all_confusing_factors = environment.confusing_factor_more_pairs(items_with_options) if len(items_with_options) > 0 else {}
+        result = []
+        for item in items:
+            number_of_options = numbers_of_options[item]
+            if number_of_options == 0:
+                result.append([])
+                continue
+            with selected_item_context(item, items, all_parents=all_parents):
+                confusing_factors = dict(zip(items_with_options[item], all_confusing_factors[item]))
+                result_options = self.compute_options(target_probability, predictions[item], number_of_options, confusing_factors)
                 if len(result_options) != number_of_options:
                     raise Exception('There is a wrong number of options for multiple-choice question! Number of options set to: {}, confusing factors {}'.format(number_of_options, confusing_factors))
                 if len(set(result_options)) != number_of_options:
@@ -1,6 +1,12 @@
 from math import exp
 from proso.time import timeit
 import abc
+import numpy
+import proso.models.replay as replay
+
+
+# used as the time since the last answer when the answer is missing
+LONG_AGO_SECONDS = 315460000
 
 
 class PredictiveModel(metaclass=abc.ABCMeta):
@@ -87,6 +93,34 @@ class PredictiveModel(metaclass=abc.ABCMeta):
     def predict_phase_more_items(self, data, user, items, time, **kwargs):
         pass
 
+    def replay_kernel(self, environment):
+        """
+        Optional fast path for replaying a large number of answers, see
+        :mod:`proso.models.replay`.
+
+        Args:
+            environment (proso.models.environment.Environment):
+                environment the answers are replayed in
+
+        Returns:
+            proso.models.replay.ReplayKernel: kernel processing batches of
+            answers, or None if the model or the environment does not
+            support it
+        """
+        return None
+
+    def variable_keys(self):
+        """
+        Keys of the variables the model reads from the environment, the
+        variables maintained by the environment itself (number of answers,
+        last answer time, etc.) are not included. They are used to load only
+        the necessary variables from the database.
+
+        Returns:
+            set: keys of the variables, or None if they are not known
+        """
+        return None
+
     @abc.abstractmethod
     def update_phase(self, environment, data, prediction, user, item, correct, time, answer_id, **kwargs):
         """
@@ -117,6 +151,9 @@ class SimplePredictiveModel(PredictiveModel):
     def prepare_phase(self, environment, user, item, time, **kwargs):
         return None
 
+    def variable_keys(self):
+        return set()
+
     def prepare_phase_more_items(self, environment, user, items, time, **kwargs):
         return None
 
@@ -160,6 +197,14 @@ class AveragePredictiveModel(PredictiveModel):
     def update_phase(self, environment, data, prediction, user, item, correct, time, answer_id, **kwargs):
         environment.update('total_sum', 0, lambda x: x + correct, item=item, answer=answer_id)
 
+    def variable_keys(self):
+        return {'total_sum'}
+
+    def replay_kernel(self, environment):
+        if not replay.is_supported(environment):
+            return None
+        return AverageReplayKernel(self, environment)
+
 
 class PriorCurrentPredictiveModel(PredictiveModel):
 
@@ -185,9 +230,12 @@ class PriorCurrentPredictiveModel(PredictiveModel):
 
     def prepare_phase_more_items(self, environment, user, items, time, **kwargs):
         result = {}
-        result['prior_skill'] = environment.read('prior_skill', user=user, default=0)
-        result['difficulties'] = environment.read_more_items('difficulty', items=items, default=0)
-        result['current_skills'] = environment.read_more_items('current_skill', user=user, items=items)
+        prior_skill, result['difficulties'], result['current_skills'] = environment.read_more_keys_more_items([
+            ('prior_skill', [None], user, 0),
+            ('difficulty', items, None, 0),
+            ('current_skill', items, user, None),
+        ])
+        result['prior_skill'] = prior_skill[None]
         result['last_times'] = environment.last_answer_time_more_items(user=user, items=items)
         return result
 
@@ -195,7 +243,7 @@ class PriorCurrentPredictiveModel(PredictiveModel):
         if data['current_skill'] is None:
             skill = data['prior_skill'] - data['difficulty']
         else:
-            seconds_ago = _total_seconds_diff(time, data['last_time']) if data['last_time'] and time else 315460000
+            seconds_ago = _total_seconds_diff(time, data['last_time']) if data['last_time'] and time else LONG_AGO_SECONDS
             skill = data['current_skill'] + self._time_shift / max(seconds_ago, 0.001)
         return predict_simple(
             skill,
@@ -203,17 +251,43 @@ class PriorCurrentPredictiveModel(PredictiveModel):
             guess=kwargs.get('guess'))[0]
 
     def predict_phase_more_items(self, data, user, items, time, **kwargs):
-        preds = []
-        for i in items:
-            preds.append(self.predict_phase({
-                'prior_skill': data['prior_skill'],
-                'difficulty': data['difficulties'][i],
-                'current_skill': data['current_skills'][i],
-                'last_time': data['last_times'][i],
-            }, user, i, time, **kwargs))
-        return preds
+        if len(items) == 0:
+            return []
+        current_skills = [data['current_skills'][i] for i in items]
+        use_prior = numpy.array([s is None for s in current_skills])
+        current_skills = numpy.array([0.0 if s is None else s for s in current_skills], dtype=float)
+        difficulties = numpy.array([data['difficulties'][i] for i in items], dtype=float)
+        seconds_ago = _total_seconds_diff_more_items(time, [data['last_times'][i] for i in items])
+        skills = numpy.where(
+            use_prior,
+            data['prior_skill'] - difficulties,
+            current_skills + self._time_shift / numpy.maximum(seconds_ago, 0.001))
+        return predict_simple_more_items(
+            skills,
+            number_of_options=len(kwargs['options']) if 'options' in kwargs else 0,
+            guess=kwargs.get('guess')).tolist()
 
     def update_phase(self, environment, data, prediction, user, item, correct, time, answer_id, **kwargs):
+        current_skill, prior_skill, difficulty = self._update_data(data, prediction, correct)
+        environment.write('current_skill', current_skill, user=user, item=item, time=time, answer=answer_id)
+        if data['use_prior']:
+            environment.write('prior_skill', prior_skill, user=user, time=time, answer=answer_id)
+            environment.write('difficulty', difficulty, item=item, time=time, answer=answer_id)
+
+    def variable_keys(self):
+        return {'prior_skill', 'difficulty', 'current_skill'}
+
+    def replay_kernel(self, environment):
+        if not replay.is_supported(environment):
+            return None
+        return PriorCurrentReplayKernel(self, environment)
+
+    def _update_data(self, data, prediction, correct):
+        """
+        Returns:
+            tuple: the new current skill, prior skill and difficulty, the
+            last two are None if the prior is not used
+        """
         result = correct
         if data['current_skill'] is None:
             current_skill = data['prior_skill'] - data['difficulty']
@@ -223,17 +297,16 @@ class PriorCurrentPredictiveModel(PredictiveModel):
             current_skill = current_skill + self._pfae_good * (result - prediction)
         else:
             current_skill = current_skill + self._pfae_bad * (result - prediction)
-        environment.write('current_skill', current_skill, user=user, item=item, time=time, answer=answer_id)
-        if data['use_prior']:
-            alpha_fun = lambda n: self._elo_alpha / (1 + self._elo_dynamic_alpha * n)
-            prior_skill_alpha = alpha_fun(data['user_first_answers'])
-            difficulty_alpha = alpha_fun(data['item_first_answers'])
-            environment.write(
-                'prior_skill', data['prior_skill'] + prior_skill_alpha * (result - prediction),
-                user=user, time=time, answer=answer_id)
-            environment.write(
-                'difficulty', data['difficulty'] - difficulty_alpha * (result - prediction),
-                item=item, time=time, answer=answer_id)
+        if not data['use_prior']:
+            return current_skill, None, None
+        alpha_fun = lambda n: self._elo_alpha / (1 + self._elo_dynamic_alpha * n)
+        prior_skill_alpha = alpha_fun(data['user_first_answers'])
+        difficulty_alpha = alpha_fun(data['item_first_answers'])
+        return (
+            current_skill,
+            data['prior_skill'] + prior_skill_alpha * (result - prediction),
+            data['difficulty'] - difficulty_alpha * (result - prediction),
+        )
 
 
 class AlwaysLearningPredictiveModel(PredictiveModel):
@@ -250,12 +323,19 @@ class AlwaysLearningPredictiveModel(PredictiveModel):
     def prepare_phase_more_items(self, environment, user, items, time, **kwargs):
         parents = self._load_parents(environment, items, user)
         all_items = list(set(items + [i for ps in list(parents.values()) for (i, v) in ps]))
+        graph = CompiledParents(parents)
+        skills, difficulties = environment.read_more_keys_more_items([
+            ('skill', all_items, user, 0),
+            ('difficulty', items, None, 0),
+        ])
         return {
-            'skills': environment.read_more_items('skill', items=all_items, user=user, default=0),
+            'skills': skills,
+            'skills_vector': graph.vector(skills),
             'first_answers': environment.number_of_first_answers_more_items(items=items),
-            'difficulties': environment.read_more_items('difficulty', items=items, default=0),
+            'difficulties': difficulties,
             'last_times': environment.last_answer_time_more_items(items=items, user=user),
             'parents': parents,
+            'graph': graph,
         }
 
     def predict_phase(self, data, user, item, time, **kwargs):
@@ -267,16 +347,48 @@ class AlwaysLearningPredictiveModel(PredictiveModel):
             guess=kwargs.get('guess'))[0]
 
     def predict_phase_more_items(self, data, user, items, time, **kwargs):
-        return [self.predict_phase(data, user, i, time, **kwargs) for i in items]
+        if len(items) == 0:
+            return []
+        graph = data['graph']
+        skills = graph.skills([graph.index[i] for i in items], data['skills_vector'])
+        difficulties = numpy.array([data['difficulties'][i] for i in items], dtype=float)
+        return predict_simple_more_items(
+            skills - difficulties,
+            number_of_options=len(kwargs['options']) if 'options' in kwargs else 0,
+            guess=kwargs.get('guess')).tolist()
 
     def update_phase(self, environment, data, prediction, user, item, correct, time, answer_id, **kwargs):
-        if data['last_times'][item] is None:
+        difficulty_updated, updated_skills = self._update_data(data, prediction, item, correct, **kwargs)
+        if difficulty_updated:
+            environment.write('difficulty', data['difficulties'][item], item=item, time=time, answer=answer_id)
+        for parent, skill in updated_skills:
+            environment.write('skill', skill, item=parent, user=user, time=time, answer=answer_id)
+
+    def variable_keys(self):
+        return {'skill', 'difficulty', 'parent'}
+
+    def replay_kernel(self, environment):
+        if not replay.is_supported(environment):
+            return None
+        return AlwaysLearningReplayKernel(self, environment)
+
+    def _update_data(self, data, prediction, item, correct, **kwargs):
+        """
+        Update the difficulty and skills in the data from the prepare phase.
+
+        Returns:
+            tuple: flag whether the difficulty has been updated and the list
+            of (parent, skill) pairs in the order of updates
+        """
+        difficulty_updated = data['last_times'][item] is None
+        if difficulty_updated:
             alpha_fun = lambda n: self._elo_alpha / (1 + self._elo_dynamic_alpha * n)
             difficulty_alpha = alpha_fun(data['first_answers'][item])
             data['difficulties'][item] -= difficulty_alpha * (correct - prediction)
-            environment.write('difficulty', data['difficulties'][item], item=item, time=time, answer=answer_id)
-        parents_per_level = [
-            list(set([i_w[0] for i_w in parents])) for parents in self._iterate_parents_per_level(item, data)]
+        updated_skills = []
+        graph = data['graph']
+        skills_vector = data['skills_vector']
+        parents_per_level = [list(set(parents)) for parents in graph.parents_per_level(graph.index[item])]
         parents_per_level = list(zip(list(range(len(parents_per_level))), parents_per_level))
         parents_per_level.reverse()
         level_decay = lambda level: 1.0 / 3 ** level
@@ -284,12 +396,15 @@ class AlwaysLearningPredictiveModel(PredictiveModel):
         difficulty = data['difficulties'][item]
         for level, parents in parents_per_level:
             for parent in parents:
+                parent_index = graph.index[parent]
                 parent_prediction = predict_simple(
-                    self._load_skill(parent, data) - difficulty,
+                    graph.skill(parent_index, skills_vector) - difficulty,
                     number_of_options=len(kwargs['options']) if 'options' in kwargs else 0,
                     guess=kwargs.get('guess'))[0]
                 data['skills'][parent] += level_decay(level) * update_const * (correct - parent_prediction)
-                environment.write('skill', data['skills'][parent], item=parent, user=user, time=time, answer=answer_id)
+                skills_vector[parent_index] = data['skills'][parent]
+                updated_skills.append((parent, data['skills'][parent]))
+        return difficulty_updated, updated_skills
 
     def _load_parents(self, environment, items, user):
         parents = {}
@@ -305,17 +420,78 @@ class AlwaysLearningPredictiveModel(PredictiveModel):
         return parents
 
     def _load_skill(self, item, data):
-        skill = 0
-        for skill_items in self._iterate_parents_per_level(item, data):
-            weights = float(sum([i_w1[1] for i_w1 in skill_items]))
-            skill += sum([data['skills'][i_w3[0]] * i_w3[1] / weights for i_w3 in skill_items])
-        return skill
+        graph = data['graph']
+        return graph.skill(graph.index[item], data['skills_vector'])
+
+
+class CompiledParents:
 
-    def _iterate_parents_per_level(self, item, data):
-        to_find = [(item, 1)]
-        while len(to_find) > 0:
-            yield to_find
-            to_find = [iw for ps in [[] if i_w2[0] is None else data['parents'][i_w2[0]] for i_w2 in to_find] for iw in ps]
+    """
+    The parent relation (item -> [(parent, weight)]) compiled into a sparse
+    matrix for each level of the hierarchy. The row of the matrix on the
+    level L contains normalized weights of the item's ancestors which are L
+    steps far from the item. The skill of the item is the sum of products of
+    these matrices and the vector of skills.
+
+    Items without parents have the parent None, which is the root of the
+    hierarchy. The matrices are stored in CSR format (indptr, indices,
+    weights) using plain NumPy arrays.
+    """
+
+    def __init__(self, parents):
+        self.nodes = list(set(parents.keys()) | {p for ps in parents.values() for p, _ in ps})
+        self.index = {n: j for j, n in enumerate(self.nodes)}
+        levels = []
+        for row, node in enumerate(self.nodes):
+            for level, skill_items in enumerate(_iterate_parents_per_level(node, parents)):
+                if level == len(levels):
+                    levels.append(([], [], []))
+                rows, indices, weights = levels[level]
+                total = float(sum([w for _, w in skill_items]))
+                rows.extend([row] * len(skill_items))
+                indices.extend([self.index[i] for i, _ in skill_items])
+                weights.extend([w / total for _, w in skill_items])
+        self.levels = []
+        for rows, indices, weights in levels:
+            rows = numpy.array(rows, dtype=int)
+            self.levels.append((
+                numpy.searchsorted(rows, numpy.arange(len(self.nodes) + 1)),
+                numpy.array(indices, dtype=int),
+                numpy.array(weights, dtype=float),
+                rows,
+            ))
+
+    def vector(self, skills):
+        return numpy.array([skills[n] for n in self.nodes], dtype=float)
+
+    def skills(self, rows, skills_vector):
+        result = numpy.zeros(len(self.nodes))
+        for _, indices, weights, level_rows in self.levels:
+            result += numpy.bincount(level_rows, weights=skills_vector[indices] * weights, minlength=len(self.nodes))
+        return result[rows]
+
+    def skill(self, row, skills_vector):
+        result = 0.0
+        for indptr, indices, weights, _ in self.levels:
+            start, end = indptr[row], indptr[row + 1]
+            if start == end:
+                break
+            result += numpy.dot(skills_vector[indices[start:end]], weights[start:end])
+        return result
+
+    def parents_per_level(self, row):
+        for indptr, indices, _, _ in self.levels:
+            start, end = indptr[row], indptr[row + 1]
+            if start == end:
+                break
+            yield [self.nodes[j] for j in indices[start:end]]
+
+
+def _iterate_parents_per_level(item, parents):
+    to_find = [(item, 1)]
+    while len(to_find) > 0:
+        yield to_find
+        to_find = [iw for ps in [[] if i_w2[0] is None else parents[i_w2[0]] for i_w2 in to_find] for iw in ps]
 
 
 class ShiftedPredictiveModel(PredictiveModel):
@@ -350,6 +526,88 @@ class ShiftedPredictiveModel(PredictiveModel):
         return [min(1.0, max(0.0, p + self._prediction_shift)) for p in super(ShiftedPredictiveModel, self).predict_more_items(environment, user, items, time, **kwargs)]
 
 
+class AverageReplayKernel(replay.ReplayKernel):
+
+    def predict_and_update(self, state, user, item, correct, time, answer_id, guess):
+        total_sum = state.variables('total_sum', default=0)
+        slot = total_sum.slot(None, item)
+        data = (total_sum.get(slot), state.number_of_answers(None, item))
+        prediction = self._predictive_model.predict_phase(data, user, item, time, guess=guess)
+        # the generic path writes the sum without the time of the answer
+        total_sum.set(slot, data[0] + correct, None, answer_id)
+        return prediction
+
+
+class PriorCurrentReplayKernel(replay.ReplayKernel):
+
+    def predict_and_update(self, state, user, item, correct, time, answer_id, guess):
+        prior_skills = state.variables('prior_skill', default=0)
+        difficulties = state.variables('difficulty', default=0)
+        current_skills = state.variables('current_skill')
+        prior_skill_slot = prior_skills.slot(user, None)
+        difficulty_slot = difficulties.slot(None, item)
+        current_skill_slot = current_skills.slot(user, item)
+        data = {
+            'prior_skill': prior_skills.get(prior_skill_slot),
+            'difficulty': difficulties.get(difficulty_slot),
+            'current_skill': current_skills.get(current_skill_slot),
+        }
+        data['use_prior'] = data['current_skill'] is None
+        if data['use_prior']:
+            data['user_first_answers'] = state.number_of_first_answers(user, None)
+            data['item_first_answers'] = state.number_of_first_answers(None, item)
+        else:
+            data['last_time'] = state.last_answer_time(user, item)
+        prediction = self._predictive_model.predict_phase(data, user, item, time, guess=guess)
+        current_skill, prior_skill, difficulty = self._predictive_model._update_data(data, prediction, correct)
+        current_skills.set(current_skill_slot, current_skill, time, answer_id)
+        if data['use_prior']:
+            prior_skills.set(prior_skill_slot, prior_skill, time, answer_id)
+            difficulties.set(difficulty_slot, difficulty, time, answer_id)
+        return prediction
+
+
+class AlwaysLearningReplayKernel(replay.ReplayKernel):
+
+    def __init__(self, predictive_model, environment):
+        replay.ReplayKernel.__init__(self, predictive_model, environment)
+        # item -> (parents, compiled parents), the parent relation is not
+        # changed by answers
+        self._graphs = {}
+
+    def predict_and_update(self, state, user, item, correct, time, answer_id, guess):
+        skills = state.variables('skill', default=0)
+        difficulties = state.variables('difficulty', default=0)
+        parents, graph = self._graph(item)
+        skill_slots = [skills.slot(user, node) for node in graph.nodes]
+        node_skills = {node: skills.get(slot) for node, slot in zip(graph.nodes, skill_slots)}
+        difficulty_slot = difficulties.slot(None, item)
+        data = {
+            'skills': node_skills,
+            'skills_vector': graph.vector(node_skills),
+            'first_answers': {item: state.number_of_first_answers(None, item)},
+            'difficulties': {item: difficulties.get(difficulty_slot)},
+            'last_times': {item: state.last_answer_time(user, item)},
+            'parents': parents,
+            'graph': graph,
+        }
+        prediction = self._predictive_model.predict_phase(data, user, item, time, guess=guess)
+        difficulty_updated, updated_skills = self._predictive_model._update_data(data, prediction, item, correct, guess=guess)
+        if difficulty_updated:
+            difficulties.set(difficulty_slot, data['difficulties'][item], time, answer_id)
+        for parent, skill in updated_skills:
+            skills.set(skill_slots[graph.index[parent]], skill, time, answer_id)
+        return prediction
+
+    def _graph(self, item):
+        found = self._graphs.get(item)
+        if found is None:
+            parents = self._predictive_model._load_parents(self._environment, [item], None)
+            found = parents, CompiledParents(parents)
+            self._graphs[item] = found
+        return found
+
+
 def predict_simple(skill_asked, number_of_options=None, guess=None):
     if guess is None and number_of_options is None:
         raise Exception('Either guess parameter or number of options has to be specified.')
@@ -360,12 +618,38 @@ def predict_simple(skill_asked, number_of_options=None, guess=None):
     return (guess + (1 - guess) * _sigmoid(skill_asked), [])
 
 
+def predict_simple_more_items(skills_asked, number_of_options=None, guess=None):
+    """
+    Vectorized version of :func:`predict_simple` taking an array of skills
+    and returning an array of predictions.
+    """
+    if guess is None and number_of_options is None:
+        raise Exception('Either guess parameter or number of options has to be specified.')
+    if guess is None:
+        guess = 0.0
+        if number_of_options:
+            guess = 1.0 / number_of_options
+    return guess + (1 - guess) * _sigmoid_more_items(skills_asked)
+
+
 def _sigmoid(x):
     return 1.0 / (1 + exp(-x))
 
 
+def _sigmoid_more_items(xs):
+    return 1.0 / (1 + numpy.exp(-numpy.asarray(xs, dtype=float)))
+
+
 def _total_seconds_diff(a, b):
     if a.tzinfo != b.tzinfo:
         a = a if a.tzinfo is None else a.replace(tzinfo=None)
         b = b if b.tzinfo is None else b.replace(tzinfo=None)
     return (a - b).total_seconds()
+
+
+def _total_seconds_diff_more_items(a, bs):
+    if a is None:
+        return numpy.full(len(bs), float(LONG_AGO_SECONDS))
+    return numpy.fromiter(
+        (LONG_AGO_SECONDS if b is None else (a - b).total_seconds() if a.tzinfo is b.tzinfo else _total_seconds_diff(a, b) for b in bs),
+        dtype=float, count=len(bs))
@@ -0,0 +1,268 @@
+"""
+Fast replay of answers for the built-in predictive models. The generic
+:meth:`proso.models.prediction.PredictiveModel.predict_and_update` and
+:meth:`proso.models.environment.InMemoryEnvironment.process_answer` read and
+write each variable through the environment. A replay kernel loads the
+variables touched by a batch of answers from the environment only once,
+keeps them in typed arrays while the batch is processed and writes the
+modified ones back at the end. The results are the same as the results of
+the generic path.
+
+.. code-block:: python
+
+    kernel = predictive_model.replay_kernel(environment)
+    if kernel is None:
+        for answer in rows:
+            ...
+    else:
+        predictions = kernel.replay(AnswerBatch.from_rows(rows))
+
+The kernel processes the answers in the environment as well, so it is
+available only for environments processing answers by
+:meth:`proso.models.environment.InMemoryEnvironment.process_answer`
+without write hooks, see :func:`is_supported`.
+"""
+
+from datetime import datetime
+from proso.models.environment import InMemoryEnvironment
+import abc
+import array
+import numpy
+
+
+class AnswerBatch:
+
+    """
+    Columnar batch of answers ordered by time.
+    """
+
+    def __init__(self, answer_ids, users, items, asked, answered, times, response_times, guesses):
+        self.answer_ids = array.array('q', answer_ids)
+        self.users = array.array('q', users)
+        self.items = array.array('q', items)
+        self.asked = list(asked)
+        self.answered = list(answered)
+        self.times = list(times)
+        self.response_times = list(response_times)
+        self.guesses = array.array('d', guesses)
+        self.correct = array.array('b', [a == b for a, b in zip(self.asked, self.answered)])
+
+    @staticmethod
+    def from_rows(rows):
+        """
+        Args:
+            rows (list): tuples (answer id, user, item, asked item, answered
+                item, time, response time, guess)
+        """
+        columns = list(zip(*rows))
+        if len(columns) == 0:
+            columns = [[] for _ in range(8)]
+        return AnswerBatch(*columns)
+
+    def rows(self):
+        """
+        Returns:
+            iterator: tuples (user, item, asked item, answered item, time,
+            answer id, response time, guess) suitable for
+            :meth:`proso.models.environment.Environment.process_answer`
+        """
+        return zip(
+            self.users, self.items, self.asked, self.answered, self.times,
+            self.answer_ids, self.response_times, self.guesses)
+
+    def slice(self, start, stop):
+        return AnswerBatch(
+            self.answer_ids[start:stop], self.users[start:stop], self.items[start:stop],
+            self.asked[start:stop], self.answered[start:stop], self.times[start:stop],
+            self.response_times[start:stop], self.guesses[start:stop])
+
+    def user_ids(self):
+        return set(self.users)
+
+    def item_ids(self):
+        """
+        Returns:
+            set: practiced, asked and answered items
+        """
+        return (set(self.items) | set(self.asked) | set(self.answered)) - {None}
+
+    def __len__(self):
+        return len(self.answer_ids)
+
+
+def is_supported(environment):
+    """
+    Check whether the answers can be replayed in the given environment by a
+    replay kernel.
+    """
+    return (
+        isinstance(environment, InMemoryEnvironment) and
+        type(environment).process_answer is InMemoryEnvironment.process_answer and
+        not environment.has_write_hooks()
+    )
+
+
+class ReplayKernel(metaclass=abc.ABCMeta):
+
+    def __init__(self, predictive_model, environment):
+        self._predictive_model = predictive_model
+        self._environment = environment
+
+    def replay(self, batch):
+        """
+        Predict and update the model for all answers in the batch and
+        process them in the environment.
+
+        Args:
+            batch (AnswerBatch): answers to replay
+
+        Returns:
+            numpy.ndarray: predictions of the given answers
+        """
+        state = _State(self._environment)
+        predictions = numpy.empty(len(batch))
+        for j, (user, item, asked, answered, time, answer_id, response_time, guess) in enumerate(batch.rows()):
+            predictions[j] = self.predict_and_update(state, user, item, asked == answered, time, answer_id, guess)
+            state.process_answer(user, item, asked, answered, time, answer_id, guess)
+        state.flush()
+        return predictions
+
+    @abc.abstractmethod
+    def predict_and_update(self, state, user, item, correct, time, answer_id, guess):
+        pass
+
+
+class _State:
+
+    """
+    Variables touched by the replayed batch, the answers are processed in the
+    same way as :meth:`proso.models.environment.InMemoryEnvironment.process_answer`
+    does.
+    """
+
+    def __init__(self, environment):
+        self._environment = environment
+        self._variables = {}
+        self.answers = self.variables(InMemoryEnvironment.NUMBER_OF_ANSWERS, default=0, with_times=True)
+        self.first_answers = self.variables(InMemoryEnvironment.NUMBER_OF_FIRST_ANSWERS, default=0)
+        self.correct_answers = self.variables(InMemoryEnvironment.NUMBER_OF_CORRECT_ANSWERS, default=0)
+        self.last_correctness = self.variables(InMemoryEnvironment.LAST_CORRECTNESS)
+        self.confusing_factors = self.variables(InMemoryEnvironment.CONFUSING_FACTOR, default=0)
+
+    def variables(self, key, default=None, with_times=False):
+        found = self._variables.get(key)
+        if found is None:
+            found = _Variables(self._environment, key, default, with_times)
+            self._variables[key] = found
+        return found
+
+    def number_of_answers(self, user, item):
+        return self.answers.get(self.answers.slot(user, item))
+
+    def number_of_first_answers(self, user, item):
+        return self.first_answers.get(self.first_answers.slot(user, item))
+
+    def last_answer_time(self, user, item):
+        return self.answers.time(self.answers.slot(user, item))
+
+    def process_answer(self, user, item, asked, answered, time, answer_id, guess):
+        if time is None:
+            time = datetime.now()
+        answers = self.answers
+        slots = answers.answer_slots(user, item)
+        if answers.get(slots[3]) == 0:
+            self.first_answers.increment(self.first_answers.answer_slots(user, item), time, answer_id)
+        answers.increment(slots, time, answer_id)
+        if asked == answered:
+            self.correct_answers.increment(self.correct_answers.answer_slots(user, item), time, answer_id)
+        self.last_correctness.set(self.last_correctness.slot(user, None), asked == answered, None, answer_id)
+        if guess == 0 and asked != answered and answered is not None:
+            confusing_factors = self.confusing_factors
+            confusing_factors.increment([confusing_factors.slot(None, asked, answered), confusing_factors.slot(user, asked, answered)], None, answer_id)
+
+    def flush(self):
+        for variables in self._variables.values():
+            variables.flush()
+
+
+class _Variables:
+
+    """
+    Values of one key kept in a typed array, NaN stands for a missing value.
+    Variables of two items are symmetric.
+    """
+
+    def __init__(self, environment, key, default, with_times):
+        self._environment = environment
+        self._key = key
+        self._default = default
+        self._with_times = with_times
+        # (user, item, item_secondary) -> slot
+        self._slots = {}
+        self._keys = []
+        self._values = array.array('d')
+        self._times = []
+        # slot -> (time, answer id) of the last update
+        self._updates = {}
+        # (user, item) -> slots of the variables updated by the answer
+        self._answer_slots = {}
+
+    def slot(self, user, item, item_secondary=None):
+        if item_secondary is not None and item is not None and item_secondary < item:
+            item, item_secondary = item_secondary, item
+        found = self._slots.get((user, item, item_secondary))
+        if found is None:
+            value = self._environment.read(self._key, user=user, item=item, item_secondary=item_secondary)
+            found = len(self._values)
+            self._slots[user, item, item_secondary] = found
+            self._keys.append((user, item, item_secondary))
+            self._values.append(float('nan') if value is None else value)
+            if self._with_times:
+                self._times.append(self._environment.time(self._key, user=user, item=item, item_secondary=item_secondary))
+        return found
+
+    def answer_slots(self, user, item):
+        """
+        Slots of the variables for no one, the user, the item and both,
+        :meth:`proso.models.environment.InMemoryEnvironment.process_answer`
+        updates all of them.
+        """
+        found = self._answer_slots.get((user, item))
+        if found is None:
+            found = [self.slot(None, None), self.slot(user, None), self.slot(None, item), self.slot(user, item)]
+            self._answer_slots[user, item] = found
+        return found
+
+    def increment(self, slots, time, answer_id):
+        values = self._values
+        updates = self._updates
+        default = self._default
+        for slot in slots:
+            value = values[slot]
+            values[slot] = (default if value != value else value) + 1
+            updates[slot] = (time, answer_id)
+        if self._with_times:
+            for slot in slots:
+                self._times[slot] = time
+
+    def get(self, slot):
+        value = self._values[slot]
+        return self._default if value != value else value
+
+    def time(self, slot):
+        return self._times[slot]
+
+    def set(self, slot, value, time, answer_id):
+        self._values[slot] = value
+        self._updates[slot] = (time, answer_id)
+        if self._with_times:
+            self._times[slot] = time
+
+    def flush(self):
+        for slot in sorted(self._updates):
+            time, answer_id = self._updates[slot]
+            user, item, item_secondary = self._keys[slot]
+            self._environment.write(
+                self._key, self._values[slot], user=user, item=item, item_secondary=item_secondary,
+                time=time, answer=answer_id)
+        self._updates = {}
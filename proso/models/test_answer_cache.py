@@ -0,0 +1,99 @@
+from proso.models.answer_cache import HasAnswerCache, ItemShardCache
+import unittest
+
+
+class DictCache:
+
+    def __init__(self):
+        self.data = {}
+
+    def get_many(self, keys):
+        return {key: self.data[key] for key in keys if key in self.data}
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def add(self, key, value, timeout=None):
+        if key in self.data:
+            return False
+        self.data[key] = value
+        return True
+
+    def incr(self, key, delta=1):
+        if key not in self.data:
+            raise ValueError("Key '%s' not found" % key)
+        self.data[key] += delta
+        return self.data[key]
+
+    def set_many(self, data, timeout=None):
+        self.data.update(data)
+
+
+class HasAnswerCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._cache = DictCache()
+        self._answer_cache = HasAnswerCache(self._cache, bucket_size=10)
+
+    def test_answered(self):
+        self.assertEqual(set(), self._answer_cache.answered([1, 2, 15]))
+        self._answer_cache.add([1, 15], user=1)
+        self._answer_cache.add([2], user=1)
+        self._answer_cache.add([3], user=2)
+        self.assertEqual({1, 2, 15}, self._answer_cache.answered([1, 2, 3, 15, 16], user=1))
+        self.assertEqual({3}, self._answer_cache.answered([1, 2, 3, 15, 16], user=2))
+        self.assertEqual(set(), self._answer_cache.answered([1, 2, 3, 15, 16]))
+
+    def test_buckets(self):
+        self._answer_cache.add([1, 2, 15, 31], user=1)
+        self._answer_cache.add([3], user=2)
+        self.assertEqual(4, len(self._cache.data))
+        self.assertEqual({1, 2}, self._cache.data['has_answer__1__0'])
+
+
+class ItemShardCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._cache = ItemShardCache(DictCache(), 'confusing_factor')
+
+    def test_add(self):
+        self._cache.add({1: ItemShardCache.shard({2: 1, 3: 0})}, self._cache.versions([1], user=1), user=1)
+        shards = self._cache.add({1: ItemShardCache.shard({2: 5, 4: 2}), 2: ItemShardCache.shard({1: 1})}, self._cache.versions([1, 2], user=1), user=1)
+        self.assertEqual({2: 1, 3: 0, 4: 2}, shards[1]['entries'])
+        self.assertEqual(shards, self._cache.get_many([1, 2, 3], user=1))
+        self.assertEqual({}, self._cache.get_many([1, 2, 3]))
+
+    def test_contains(self):
+        self.assertFalse(ItemShardCache.contains(None, 2))
+        self.assertTrue(ItemShardCache.contains(ItemShardCache.shard({2: 1}), 2))
+        self.assertFalse(ItemShardCache.contains(ItemShardCache.shard({2: 1}), 3))
+        self.assertTrue(ItemShardCache.contains(ItemShardCache.shard({2: 1}, complete=True), 3))
+
+    def test_update(self):
+        self._cache.set_many({1: ItemShardCache.shard({2: 1})}, self._cache.versions([1]))
+        self.assertEqual({(1, None): ItemShardCache.shard({2: 2})}, self._cache.update([(1, None), (1, 1)], self._increment))
+        self.assertEqual({1: ItemShardCache.shard({2: 2})}, self._cache.get_many([1]))
+        self.assertEqual({}, self._cache.get_many([1], user=1))
+
+    def test_concurrent_update(self):
+        self._cache.set_many({1: ItemShardCache.shard({2: 1})}, self._cache.versions([1]))
+
+        def _concurrent_increment(item, user, shard):
+            # the other update reads the same shard and writes first
+            self._cache.update([(1, None)], self._increment)
+            return self._increment(item, user, shard)
+        self._cache.update([(1, None)], _concurrent_increment)
+        self.assertEqual({}, self._cache.get_many([1]))
+
+    def test_update_while_computing(self):
+        versions = self._cache.versions([1])
+        self._cache.set_many({1: ItemShardCache.shard({2: 1})}, versions)
+        versions = self._cache.versions([1])
+        self._cache.update([(1, None)], self._increment)
+        # the shard computed before the update does not contain it
+        self._cache.set_many({1: ItemShardCache.shard({2: 1})}, versions)
+        self.assertEqual({}, self._cache.get_many([1]))
+
+    def _increment(self, item, user, shard):
+        shard['entries'][2] += 1
+        return shard
@@ -1,5 +1,7 @@
 #  -*- coding: utf-8 -*-
 from . import environment as environment
+from datetime import datetime, timedelta, timezone
+import io
 
 
 class InMemoryEnvironmentTest(environment.TestCommonEnvironment):
@@ -22,3 +24,47 @@ class InMemoryEnvironmentTest(environment.TestCommonEnvironment):
 
     def generate_environment(self):
         return environment.InMemoryEnvironment()
+
+    def test_save_and_load(self):
+        env = self.generate_environment()
+        user = self.generate_user()
+        items = [self.generate_item() for _ in range(3)]
+        for i, item in enumerate(items):
+            env.process_answer(user, item, item, items[0], datetime(2017, 1, 1, 12, i), self.generate_answer_id(), 1000, 0)
+        env.write('parent', 2, item=items[1], item_secondary=items[0], symmetric=False, permanent=True)
+        env.write('difficulty', 0.5, item=items[2], time=datetime(2017, 1, 2, 8, 30, 0, 15))
+        saved = io.BytesIO()
+        env.save(saved)
+        saved.seek(0)
+        loaded = self.generate_environment()
+        loaded.load(saved)
+        self.assertEqual(sorted(env.export_values(), key=str), sorted(loaded.export_values(), key=str))
+        self.assertEqual(env.read('parent', item=items[1], item_secondary=items[0], symmetric=False), loaded.read('parent', item=items[1], item_secondary=items[0], symmetric=False))
+        self.assertIsNone(loaded.read('parent', item=items[0], item_secondary=items[1], symmetric=False))
+        self.assertEqual(env.confusing_factor(items[1], items[0]), loaded.confusing_factor(items[0], items[1]))
+
+    def test_save_and_load_aware_times(self):
+        env = self.generate_environment()
+        items = [self.generate_item() for _ in range(2)]
+        aware = datetime(2017, 1, 1, 12, 30, tzinfo=timezone(timedelta(hours=2)))
+        naive = datetime(2017, 1, 1, 12, 30)
+        env.write('difficulty', 0.5, item=items[0], time=aware)
+        env.write('difficulty', 0.7, item=items[1], time=naive)
+        self.assertEqual(aware, env.time('difficulty', item=items[0]))
+        self.assertEqual(naive, env.time('difficulty', item=items[1]))
+        saved = io.BytesIO()
+        env.save(saved)
+        saved.seek(0)
+        loaded = self.generate_environment()
+        loaded.load(saved)
+        found = loaded.time_more_items('difficulty', items)
+        self.assertEqual(aware, found[items[0]])
+        self.assertEqual(timedelta(0), found[items[0]].utcoffset())
+        self.assertEqual(naive, found[items[1]])
+        self.assertIsNone(found[items[1]].tzinfo)
+
+
+class ArrayInMemoryEnvironmentTest(InMemoryEnvironmentTest):
+
+    def generate_environment(self):
+        return environment.ArrayInMemoryEnvironment()
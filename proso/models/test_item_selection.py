@@ -0,0 +1,159 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+from proso.models.environment import InMemoryEnvironment
+from proso.models.item_selection import ScoreItemSelection
+from proso.models.prediction import PriorCurrentPredictiveModel
+import random
+import unittest
+
+
+class ScoreItemSelectionTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)
+        self._time = datetime(2017, 1, 1, 12)
+        self._items = list(range(1, 201))
+        self._environment = InMemoryEnvironment()
+        for item in self._items:
+            for parent in random.sample(range(1001, 1021), random.randint(0, 3)):
+                weight = random.choice([1, 2])
+                self._environment.write('parent', weight, item=item, item_secondary=parent, symmetric=False, permanent=True)
+                self._environment.write('child', weight, item=parent, item_secondary=item, symmetric=False, permanent=True)
+        model = PriorCurrentPredictiveModel()
+        for answer_id in range(1, 2000):
+            user = random.randint(1, 3)
+            item = random.choice(self._items)
+            correct = random.random() < 0.7
+            time = self._time - timedelta(seconds=random.randint(1, 10000))
+            model.predict_and_update(self._environment, user, item, correct, time, answer_id)
+            self._environment.process_answer(user, item, item, item if correct else None, time, answer_id, 1000, 0)
+
+    def test_select_recomputing_parent_score(self):
+        self._test_select(recompute_parent_score=True)
+
+    def test_select_without_recomputing_parent_score(self):
+        self._test_select(recompute_parent_score=False)
+
+    def test_select_without_estimating_parent_factors(self):
+        # without estimating parent factors only the children of parents are
+        # loaded, so the items have to have a parent
+        parents = self._environment.get_items_with_values_more_items('parent', items=self._items)
+        self._test_select([i for i in self._items if len(parents[i]) > 0], estimate_parent_factors=False)
+
+    def test_select_duplicate_items(self):
+        items = self._items[:50] + self._items[25:75] + self._items[:10]
+        for recompute_parent_score in [True, False]:
+            for n in [10, 50, 250]:
+                random.seed(n)
+                expected = self._item_selector(NaiveScoreItemSelection, recompute_parent_score=recompute_parent_score).select(self._environment, 1, items, self._time, None, n)
+                random.seed(n)
+                found = self._item_selector(ScoreItemSelection, recompute_parent_score=recompute_parent_score).select(self._environment, 1, items, self._time, None, n)
+                self.assertEqual(expected, found)
+                if recompute_parent_score:
+                    self.assertEqual(min(n, len(set(items))), len(found[0]))
+                    self.assertEqual(len(set(found[0])), len(found[0]))
+
+    def _test_select(self, items=None, **kwargs):
+        items = self._items if items is None else items
+        for user in [1, 2, 4]:
+            for n in [1, 10, 50, 250]:
+                for seed in range(3):
+                    random.seed(seed)
+                    expected = self._item_selector(NaiveScoreItemSelection, **kwargs).select(self._environment, user, items, self._time, None, n)
+                    random.seed(seed)
+                    found = self._item_selector(ScoreItemSelection, **kwargs).select(self._environment, user, items, self._time, None, n)
+                    self.assertEqual(expected, found)
+                    self.assertEqual(min(n, len(items)), len(found[0]))
+
+    def _item_selector(self, item_selector_class, **kwargs):
+        return item_selector_class(PriorCurrentPredictiveModel(), history_adjustment=False, **kwargs)
+
+
+class NaiveScoreItemSelection(ScoreItemSelection):
+
+    """
+    The original implementation scoring items one by one and rescoring all
+    candidates after each pick.
+    """
+
+    def select(self, environment, user, items, time, practice_context, n, **kwargs):
+        parents = environment.get_items_with_values_more_items('parent', items=items)
+        if self._estimate_parent_factors:
+            related_items = items
+        else:
+            parent_ids = set(sum([[p for p, v in ps] for ps in list(parents.values())], []))
+            children = environment.get_items_with_values_more_items('child', items=parent_ids)
+            related_items = sum([[i for i, v in c] for c in list(children.values())], [])
+            parents = defaultdict(lambda: [])
+            for parent, childs in list(children.items()):
+                for child, v in childs:
+                    parents[child].append((parent, v))
+
+        answers_num = environment.number_of_answers_more_items(user=user, items=related_items)
+        last_answer_time = environment.last_answer_time_more_items(user=user, items=related_items)
+        probability = self.get_predictions(environment, user, items, time)
+        last_answer_time_parents = self._last_answer_time_for_parents(environment, parents, last_answer_time)
+        answers_num_parents = self._answers_num_for_parents(environment, parents, answers_num)
+        prob_target = self.get_target_probability(environment, user, practice_context=practice_context)
+
+        def _score(item):
+            return (
+                self._weight_probability * self._score_probability(prob_target, probability[item]) +
+                self._weight_time_ago * self._score_last_answer_time(last_answer_time[item], time) +
+                self._weight_number_of_answers * self._score_answers_num(answers_num[item]),
+                random.random()
+            )
+
+        def _finish_score(xxx_todo_changeme):
+            ((score, r), i) = xxx_todo_changeme
+            total = 0.0
+            parent_time_score = 0.0
+            parent_answers_num_score = 0.0
+            for p, v in parents[i]:
+                parent_time_score += v * self._score_last_answer_time(last_answer_time_parents[p], time)
+                parent_answers_num_score += v * self._score_answers_num(answers_num_parents[p])
+                total += 1
+            if total > 0:
+                parent_time_score = parent_time_score / total
+                parent_answers_num_score = parent_answers_num_score / total
+            score += self._weight_parent_time_ago * parent_time_score
+            score += self._weight_parent_number_of_answers * parent_answers_num_score
+            return (score, r), i
+
+        scored = [(_score(item), item) for item in items]
+        if self._recompute_parent_score:
+            candidates = []
+            while len(candidates) < n and len(scored) > 0:
+                finished = list(map(_finish_score, scored))
+                score, chosen = max(finished)
+                candidates.append(chosen)
+                for p, v in parents[chosen]:
+                    last_answer_time_parents[p] = time
+                scored = [score_i for score_i in scored if score_i[1] != chosen]
+        else:
+            candidates = [score_r_i[1] for score_r_i in sorted(scored, reverse=True)[:min(len(scored), n)]]
+
+        return candidates, [None for _ in candidates]
+
+    def _answers_num_for_parents(self, environment, parents, answers_num):
+        children = defaultdict(list)
+        for i, ps in parents.items():
+            for p, v in ps:
+                children[p].append(i)
+
+        return dict([(p_chs[0], sum([answers_num[ch] for ch in p_chs[1]])) for p_chs in list(children.items())])
+
+    def _last_answer_time_for_parents(self, environment, parents, last_answer_time):
+        children = defaultdict(list)
+        for i, ps in parents.items():
+            for p, v in ps:
+                children[p].append(i)
+
+        def _max_time_from_items(xs):
+            times = [x for x in [last_answer_time[x] for x in xs] if x is not None]
+            if len(times) > 0:
+                return max(times)
+            else:
+                return None
+
+        return dict([(p_chs1[0], _max_time_from_items(p_chs1[1])) for p_chs1 in list(children.items())])
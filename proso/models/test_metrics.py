@@ -0,0 +1,97 @@
+from proso.models.metrics import Metrics
+import math
+import numpy
+import proso.models.metrics as metrics
+import unittest
+
+
+def original_brier(predictions, real, bins=20):
+    counts = numpy.zeros(bins)
+    correct = numpy.zeros(bins)
+    prediction = numpy.zeros(bins)
+    for p, r in zip(predictions, real):
+        bin = min(int(p * bins), bins - 1)
+        counts[bin] += 1
+        correct[bin] += r
+        prediction[bin] += p
+    prediction_means = prediction / counts
+    prediction_means[numpy.isnan(prediction_means)] = ((numpy.arange(bins) + 0.5) / bins)[numpy.isnan(prediction_means)]
+    correct_means = correct / counts
+    correct_means[numpy.isnan(correct_means)] = 0
+    size = len(predictions)
+    answer_mean = sum(correct) / size
+    return {
+        "reliability": sum(counts * (correct_means - prediction_means) ** 2) / size,
+        "resolution": sum(counts * (correct_means - answer_mean) ** 2) / size,
+        "uncertainty": answer_mean * (1 - answer_mean),
+        "detail": {
+            "bin_count": bins,
+            "bin_counts": list(counts),
+            "bin_prediction_means": list(prediction_means),
+            "bin_correct_means": list(correct_means),
+        }
+    }
+
+
+def exact_auc(predictions, real):
+    positives = [p for p, r in zip(predictions, real) if r]
+    negatives = [p for p, r in zip(predictions, real) if not r]
+    total = 0.0
+    for p in positives:
+        for n in negatives:
+            total += 1.0 if p > n else (0.5 if p == n else 0.0)
+    return total / (len(positives) * len(negatives))
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = numpy.random.RandomState(1)
+        # predictions with a gap in [0.4, 0.5) to cover empty bins
+        self._predictions = numpy.round(random_state.beta(2, 2, 2000), 3)
+        self._predictions[(self._predictions >= 0.4) & (self._predictions < 0.5)] = 0.6
+        self._real = (random_state.random_sample(2000) < self._predictions).astype(float)
+
+    def test_brier(self):
+        expected = original_brier(self._predictions, self._real)
+        found = metrics.brier(self._predictions, self._real)
+        for key in ['reliability', 'resolution', 'uncertainty']:
+            self.assertAlmostEqual(expected[key], found[key])
+        for key in ['bin_counts', 'bin_prediction_means', 'bin_correct_means']:
+            numpy.testing.assert_allclose(expected['detail'][key], found['detail'][key])
+        self.assertEqual(expected['detail']['bin_count'], found['detail']['bin_count'])
+
+    def test_rmse_and_log_loss(self):
+        self.assertAlmostEqual(math.sqrt(numpy.mean((self._predictions - self._real) ** 2)), metrics.rmse(self._predictions, self._real))
+        clipped = numpy.clip(self._predictions, 1e-15, 1 - 1e-15)
+        expected = -numpy.mean(self._real * numpy.log(clipped) + (1 - self._real) * numpy.log(1 - clipped))
+        self.assertAlmostEqual(expected, metrics.log_loss(self._predictions, self._real))
+        bin_log_loss = metrics.brier(self._predictions, self._real)['detail']['bin_log_loss']
+        bin_counts = metrics.brier(self._predictions, self._real)['detail']['bin_counts']
+        self.assertAlmostEqual(expected, numpy.dot(bin_log_loss, bin_counts) / len(self._real))
+
+    def test_auc(self):
+        self.assertAlmostEqual(exact_auc(self._predictions, self._real), metrics.auc(self._predictions, self._real))
+        self.assertEqual(1.0, metrics.auc([0.9, 0.8, 0.1], [1, 1, 0]))
+        self.assertEqual(0.5, metrics.auc([0.5, 0.5], [1, 0]))
+        self.assertIsNone(metrics.auc([0.5, 0.7], [1, 1]))
+
+    def test_empty(self):
+        found = Metrics().report()
+        self.assertTrue(math.isnan(found['rmse']))
+        self.assertTrue(math.isnan(found['log_loss']))
+        self.assertIsNone(found['auc'])
+        for key in ['reliability', 'resolution', 'uncertainty']:
+            self.assertTrue(math.isnan(found['brier'][key]))
+
+    def test_streaming(self):
+        expected = metrics.report(self._predictions, self._real)
+        streamed = Metrics()
+        for start in range(0, len(self._predictions), 300):
+            streamed.update(self._predictions[start:start + 300], self._real[start:start + 300])
+        found = streamed.report()
+        for key in ['rmse', 'log_loss', 'auc']:
+            self.assertAlmostEqual(expected[key], found[key])
+        for key in ['reliability', 'resolution', 'uncertainty']:
+            self.assertAlmostEqual(expected['brier'][key], found['brier'][key])
+        self.assertEqual(expected['brier']['detail']['bin_counts'], found['brier']['detail']['bin_counts'])
@@ -1,5 +1,9 @@
+from collections import defaultdict
+from mock import MagicMock
+from proso.models.environment import InMemoryEnvironment
 import proso.models.option_selection
 import random
+import unittest
 
 
 class TestFullyRandomOptionsNumber(proso.models.option_selection.TestOptionsNumber):
@@ -59,3 +63,48 @@ class TestAdjustedOptionSelection(proso.models.option_selection.TestOptionSelect
 
     def get_option_selector(self, item_selector, options_number):
         return proso.models.option_selection.AdjustedOptionSelection(item_selector, options_number)
+
+
+class CountingEnvironment(InMemoryEnvironment):
+
+    def __init__(self):
+        InMemoryEnvironment.__init__(self)
+        self.calls = []
+
+    def confusing_factor_more_pairs(self, items_with_options, user=None):
+        self.calls.append(items_with_options)
+        return InMemoryEnvironment.confusing_factor_more_pairs(self, items_with_options, user=user)
+
+
+class TestSelectOptionsMoreItems(unittest.TestCase):
+
+    def test_confusing_factors_are_fetched_at_once(self):
+        environment = CountingEnvironment()
+        items = list(range(10))
+        options = {i: list(range(100)) for i in items}
+        for i in items:
+            for o in range(100):
+                environment.write('confusing_factor', i * o, item=i, item_secondary=o)
+        item_selector = MagicMock()
+        item_selector.get_target_probability.return_value = 0.75
+        item_selector.get_predictions.return_value = defaultdict(lambda: 0.5)
+        option_selector = proso.models.option_selection.CompetitiveOptionSelection(
+            item_selector, proso.models.option_selection.ConstantOptionsNumber(3))
+        result = option_selector.select_options_more_items(environment, 1, items, None, options)
+        self.assertEqual(1, len(environment.calls))
+        self.assertEqual(set(items), set(environment.calls[0].keys()))
+        for item, item_options in zip(items, result):
+            self.assertEqual(item, item_options[-1])
+            self.assertEqual(4, len(set(item_options)))
+            self.assertTrue(set(item_options) <= set(options[item]))
+
+    def test_zero_options(self):
+        environment = CountingEnvironment()
+        item_selector = MagicMock()
+        item_selector.get_target_probability.return_value = 0.75
+        item_selector.get_predictions.return_value = defaultdict(lambda: 0.5)
+        option_selector = proso.models.option_selection.CompetitiveOptionSelection(
+            item_selector, proso.models.option_selection.ZeroOptionsNumber())
+        result = option_selector.select_options_more_items(environment, 1, [1, 2], None, {1: [1, 2], 2: [1, 2]})
+        self.assertEqual([[], []], result)
+        self.assertEqual(0, len(environment.calls))
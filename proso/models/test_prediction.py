@@ -0,0 +1,206 @@
+from datetime import datetime, timedelta
+from proso.models.environment import InMemoryEnvironment
+from proso.models.replay import AnswerBatch
+import proso.models.prediction as prediction
+import random
+import unittest
+
+
+class PriorCurrentPredictiveModelTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)
+        self._time = datetime(2017, 1, 1, 12)
+        self._model = prediction.PriorCurrentPredictiveModel()
+        self._environment = InMemoryEnvironment()
+        self._items = list(range(1, 51))
+        for answer_id in range(1, 500):
+            user = random.randint(1, 5)
+            item = random.choice(self._items[:40])
+            correct = random.random() < 0.7
+            time = self._time - timedelta(seconds=random.randint(1, 100000))
+            self._model.predict_and_update(self._environment, user, item, correct, time, answer_id)
+            self._environment.process_answer(user, item, item, item if correct else None, time, answer_id, 1000, 0)
+
+    def test_predict_phase_more_items(self):
+        for kwargs in [{}, {'guess': 0.25}, {'options': [1, 2, 3]}]:
+            for user in range(1, 7):
+                data = self._model.prepare_phase_more_items(self._environment, user, self._items, self._time)
+                expected = self._predict_phase_one_by_one(data, user, self._items, self._time, **kwargs)
+                found = self._model.predict_phase_more_items(data, user, self._items, self._time, **kwargs)
+                self.assertEqual(len(expected), len(found))
+                for e, f in zip(expected, found):
+                    self.assertAlmostEqual(e, f, delta=1e-12)
+
+    def test_predict_phase_more_items_without_time(self):
+        data = self._model.prepare_phase_more_items(self._environment, 1, self._items, self._time)
+        expected = self._predict_phase_one_by_one(data, 1, self._items, None)
+        found = self._model.predict_phase_more_items(data, 1, self._items, None)
+        for e, f in zip(expected, found):
+            self.assertAlmostEqual(e, f, delta=1e-12)
+
+    def test_predict_phase_more_items_empty(self):
+        data = self._model.prepare_phase_more_items(self._environment, 1, [], self._time)
+        self.assertEqual(self._model.predict_phase_more_items(data, 1, [], self._time), [])
+
+    def _predict_phase_one_by_one(self, data, user, items, time, **kwargs):
+        return [
+            self._model.predict_phase({
+                'prior_skill': data['prior_skill'],
+                'difficulty': data['difficulties'][i],
+                'current_skill': data['current_skills'][i],
+                'last_time': data['last_times'][i],
+            }, user, i, time, **kwargs)
+            for i in items
+        ]
+
+
+class AlwaysLearningPredictiveModelTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(2)
+        self._time = datetime(2017, 1, 1, 12)
+        self._items = list(range(1, 31))
+        # two levels of concepts (31-35, 36-37) above the leaves, some of
+        # the items have more parents and some have none
+        self._relations = []
+        for item in self._items[:25]:
+            for parent in random.sample(range(31, 36), random.randint(1, 2)):
+                self._relations.append((item, parent, random.choice([1, 2])))
+        for concept in range(31, 35):
+            self._relations.append((concept, random.choice([36, 37]), 1))
+        self._relations.append((36, 37, 1))
+
+    def test_predict_and_update(self):
+        model = prediction.AlwaysLearningPredictiveModel()
+        reference = LegacyAlwaysLearningPredictiveModel()
+        environment = self._environment()
+        reference_environment = self._environment()
+        for answer_id in range(1, 300):
+            user = random.randint(1, 3)
+            item = random.choice(self._items)
+            correct = random.random() < 0.7
+            time = self._time + timedelta(seconds=answer_id)
+            found = model.predict_and_update(environment, user, item, correct, time, answer_id)
+            expected = reference.predict_and_update(reference_environment, user, item, correct, time, answer_id)
+            self.assertAlmostEqual(expected, found, delta=1e-12)
+            environment.process_answer(user, item, item, item if correct else None, time, answer_id, 1000, 0)
+            reference_environment.process_answer(user, item, item, item if correct else None, time, answer_id, 1000, 0)
+        for user in range(1, 5):
+            data = model.prepare_phase_more_items(environment, user, self._items, self._time)
+            found = model.predict_phase_more_items(data, user, self._items, self._time, guess=0.1)
+            reference_data = reference.prepare_phase_more_items(reference_environment, user, self._items, self._time)
+            expected = [reference.predict_phase(reference_data, user, i, self._time, guess=0.1) for i in self._items]
+            for e, f in zip(expected, found):
+                self.assertAlmostEqual(e, f, delta=1e-12)
+
+    def _environment(self):
+        environment = InMemoryEnvironment()
+        for child, parent, weight in self._relations:
+            environment.write('parent', weight, item=child, item_secondary=parent, symmetric=False, permanent=True)
+        return environment
+
+
+class ReplayKernelTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(3)
+        self._time = datetime(2017, 1, 1, 12)
+        self._items = list(range(1, 31))
+        self._relations = [(item, random.choice([31, 32, 33]), random.choice([1, 2])) for item in self._items[:20]]
+        self._relations += [(31, 34, 1), (32, 34, 1)]
+        self._answers = []
+        for answer_id in range(1, 1000):
+            item = random.choice(self._items)
+            answered = item if random.random() < 0.7 else random.choice([None, item + 1])
+            time = self._time + timedelta(seconds=10 * answer_id + random.randint(0, 5))
+            self._answers.append((answer_id, random.randint(1, 5), item, item, answered, time, 1000, random.choice([0, 0.25])))
+
+    def test_average(self):
+        self._test_replay(prediction.AveragePredictiveModel())
+
+    def test_prior_current(self):
+        self._test_replay(prediction.PriorCurrentPredictiveModel())
+
+    def test_always_learning(self):
+        self._test_replay(prediction.AlwaysLearningPredictiveModel())
+
+    def test_not_supported(self):
+        environment = InMemoryEnvironment()
+        environment.add_write_hook(None)
+        self.assertIsNone(prediction.PriorCurrentPredictiveModel().replay_kernel(environment))
+
+    def _test_replay(self, model):
+        expected_environment = self._environment()
+        expected = []
+        for answer_id, user, item, asked, answered, time, response_time, guess in self._answers:
+            expected.append(model.predict_and_update(
+                expected_environment, user, item, asked == answered, time,
+                item_answered=answered, item_asked=asked, guess=guess, answer_id=answer_id, response_time=response_time))
+            expected_environment.process_answer(user, item, asked, answered, time, answer_id, response_time, guess)
+        found_environment = self._environment()
+        found = []
+        kernel = model.replay_kernel(found_environment)
+        bounds = [0, 1, 10, 200, 600, len(self._answers)]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            found += kernel.replay(AnswerBatch.from_rows(self._answers[start:end])).tolist()
+        self.assertEqual(expected, found)
+        self.assertEqual(self._values(expected_environment), self._values(found_environment))
+
+    def _values(self, environment):
+        # some variables are written without the time of the answer, so the
+        # times can't be compared
+        return sorted([
+            (key, user, item_primary, item_secondary, permanent, answer, value)
+            for key, user, item_primary, item_secondary, permanent, time, answer, value in environment.export_values()
+        ], key=str)
+
+    def _environment(self):
+        environment = InMemoryEnvironment()
+        for child, parent, weight in self._relations:
+            environment.write('parent', weight, item=child, item_secondary=parent, symmetric=False, permanent=True)
+        return environment
+
+
+class LegacyAlwaysLearningPredictiveModel(prediction.AlwaysLearningPredictiveModel):
+
+    """
+    The original implementation walking the hierarchy for each item.
+    """
+
+    def update_phase(self, environment, data, prediction, user, item, correct, time, answer_id, **kwargs):
+        if data['last_times'][item] is None:
+            alpha_fun = lambda n: self._elo_alpha / (1 + self._elo_dynamic_alpha * n)
+            difficulty_alpha = alpha_fun(data['first_answers'][item])
+            data['difficulties'][item] -= difficulty_alpha * (correct - prediction)
+            environment.write('difficulty', data['difficulties'][item], item=item, time=time, answer=answer_id)
+        parents_per_level = [
+            list(set([i_w[0] for i_w in parents])) for parents in self._iterate_parents_per_level(item, data)]
+        parents_per_level = list(zip(list(range(len(parents_per_level))), parents_per_level))
+        parents_per_level.reverse()
+        level_decay = lambda level: 1.0 / 3 ** level
+        update_const = self._pfae_good if correct else self._pfae_bad
+        difficulty = data['difficulties'][item]
+        for level, parents in parents_per_level:
+            for parent in parents:
+                parent_prediction = _predict_simple(
+                    self._load_skill(parent, data) - difficulty, guess=kwargs.get('guess'))
+                data['skills'][parent] += level_decay(level) * update_const * (correct - parent_prediction)
+                environment.write('skill', data['skills'][parent], item=parent, user=user, time=time, answer=answer_id)
+
+    def _load_skill(self, item, data):
+        skill = 0
+        for skill_items in self._iterate_parents_per_level(item, data):
+            weights = float(sum([i_w1[1] for i_w1 in skill_items]))
+            skill += sum([data['skills'][i_w3[0]] * i_w3[1] / weights for i_w3 in skill_items])
+        return skill
+
+    def _iterate_parents_per_level(self, item, data):
+        to_find = [(item, 1)]
+        while len(to_find) > 0:
+            yield to_find
+            to_find = [iw for ps in [[] if i_w2[0] is None else data['parents'][i_w2[0]] for i_w2 in to_find] for iw in ps]
+
+
+def _predict_simple(skill, guess=None):
+    return prediction.predict_simple(skill, number_of_options=0, guess=guess)[0]
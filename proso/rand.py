@@ -1,4 +1,5 @@
 from string import ascii_lowercase, digits
+import proso.sampling
 import random
 
 
@@ -6,10 +7,18 @@ def random_string(n):
     return ''.join(random.choice(ascii_lowercase + digits) for _ in range(n))
 
 
+# up to this number of scanned weights (the number of chosen items times the
+# number of items) the linear scan is faster than the Fenwick tree of
+# proso.sampling.sample_sequential (see the weighted_sampling benchmark)
+ROULETTE_SCAN_LIMIT = 48
+
+
 def roulette(weights, n):
     """
     Choose randomly the given number of items. The probability the item is
-    chosen is proportionate to its weight.
+    chosen is proportionate to its weight. The items are drawn one by one,
+    small pools are scanned linearly, otherwise see
+    :func:`proso.sampling.sample_sequential`.
 
     .. testsetup::
 
@@ -31,17 +40,21 @@ def roulette(weights, n):
         n (int): number of chosen items
 
     Returns:
-        list: randomly chosen items
+        list: randomly chosen items in the order they have been drawn
     """
-    if n > len(weights):
-        raise Exception("Can't choose {} samples from {} items".format(n, len(weights)))
-    if any(map(lambda w: w <= 0, weights.values())):
-        raise Exception("The weight can't be a non-positive number.")
-    items = weights.items()
-    chosen = set()
+    if n == 1 or n * len(weights) <= ROULETTE_SCAN_LIMIT:
+        # the scan keeps the arithmetic of the original implementation, so
+        # users seeded by their id stay in the same experiment setups
+        # (see proso_configab.assignment)
+        proso.sampling.check_weights(weights, n)
+        return _roulette_scan(list(weights.items()), n)
+    return proso.sampling.sample_sequential(weights, n)
+
+
+def _roulette_scan(items, n):
+    chosen = []
     for i in range(n):
-        total = sum(list(zip(*items))[1])
-        dice = random.random() * total
+        dice = random.random() * sum(weight for _, weight in items)
         running_weight = 0
         chosen_item = None
         for item, weight in items:
@@ -49,6 +62,6 @@ def roulette(weights, n):
                 chosen_item = item
                 break
             running_weight += weight
-        chosen.add(chosen_item)
+        chosen.append(chosen_item)
         items = [(i, w) for (i, w) in items if i != chosen_item]
-    return list(chosen)
+    return chosen
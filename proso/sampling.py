@@ -0,0 +1,232 @@
+"""
+Weighted sampling without replacement. The probability an item is drawn is
+proportionate to its weight among the items which have not been drawn yet.
+
+There are two engines:
+
+- sequential draws backed by a Fenwick tree, they consume one random number
+  per draw, exactly like :func:`proso.rand.roulette`, and take
+  O(|weights| + n log |weights|) time;
+- exponential keys (Efraimidis and Spirakis), each item gets the key
+  ``log(u) / weight`` and the items with the ``n`` greatest keys are chosen,
+  it takes O(|weights| log n) time, the NumPy variant is meant for large
+  pools.
+
+All functions take an optional source of randomness, so the results can be
+reproduced.
+"""
+
+import heapq
+import math
+import numpy
+import random
+
+
+class FenwickTree:
+
+    """
+    Binary indexed tree of weights supporting prefix sums and updates in
+    O(log n) time.
+    """
+
+    def __init__(self, weights):
+        self._size = len(weights)
+        self._tree = [0.0] + [float(w) for w in weights]
+        for i in range(1, self._size + 1):
+            parent = i + (i & -i)
+            if parent <= self._size:
+                self._tree[parent] += self._tree[i]
+        self._total = float(sum(weights))
+        self._mask = 1
+        while self._mask * 2 <= self._size:
+            self._mask *= 2
+
+    def __len__(self):
+        return self._size
+
+    def total(self):
+        return self._total
+
+    def add(self, index, delta):
+        self._total += delta
+        i = index + 1
+        while i <= self._size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def prefix(self, index):
+        """
+        Returns:
+            float: sum of weights of items with a position lower than the
+                given one
+        """
+        result = 0.0
+        i = index
+        while i > 0:
+            result += self._tree[i]
+            i -= i & -i
+        return result
+
+    def find(self, value):
+        """
+        Find the position of the item where the running sum of weights
+        exceeds the given value.
+
+        Args:
+            value (float): number from [0, total)
+
+        Returns:
+            int: position of the item
+        """
+        position = 0
+        mask = self._mask
+        while mask > 0:
+            following = position + mask
+            if following <= self._size and self._tree[following] <= value:
+                position = following
+                value -= self._tree[following]
+            mask //= 2
+        return min(position, self._size - 1)
+
+
+def sample_sequential(weights, n, rng=None):
+    """
+    Draw the given number of items one by one.
+
+    .. testsetup::
+
+        from proso.sampling import sample_sequential
+
+    .. testcode::
+
+        print(sample_sequential({'cat': 2, 'dog': 1000}, 1, rng=1))
+
+    .. testoutput::
+
+        ['dog']
+
+    Args:
+        weights (dict): item -> weight mapping, non-positive weights are forbidden
+        n (int): number of chosen items
+        rng (random.Random|int): source of randomness or seed, the
+            :mod:`random` module is used by default
+
+    Returns:
+        list: chosen items in the order they have been drawn
+    """
+    check_weights(weights, n)
+    rng = _python_random(rng)
+    items, values = _items_and_values(weights)
+    tree = FenwickTree(values)
+    chosen = []
+    for _ in range(n):
+        position = tree.find(rng.random() * tree.total())
+        # rounding errors of the running sums can point to an item which
+        # has already been drawn
+        while values[position] == 0.0:
+            position = tree.find(rng.random() * tree.total())
+        chosen.append(items[position])
+        tree.add(position, -values[position])
+        values[position] = 0.0
+    return chosen
+
+
+def sample_keys(weights, n, rng=None):
+    """
+    Choose the given number of items by exponential keys.
+
+    .. testsetup::
+
+        from proso.sampling import sample_keys
+
+    .. testcode::
+
+        print(sample_keys({'cat': 2, 'dog': 1000}, 1, rng=1))
+
+    .. testoutput::
+
+        ['dog']
+
+    Args:
+        weights (dict): item -> weight mapping, non-positive weights are forbidden
+        n (int): number of chosen items
+        rng (random.Random|int): source of randomness or seed, the
+            :mod:`random` module is used by default
+
+    Returns:
+        list: chosen items ordered by their keys, the order has the same
+            distribution as the order of sequential draws
+    """
+    check_weights(weights, n)
+    rng = _python_random(rng)
+    # 1 - random() is from (0, 1], so the logarithm is always defined
+    keyed = [(math.log(1.0 - rng.random()) / weight, position, item) for position, (item, weight) in enumerate(weights.items())]
+    return [item for _, _, item in heapq.nlargest(n, keyed)]
+
+
+def sample_keys_numpy(weights, n, random_state=None):
+    """
+    Vectorized variant of :func:`sample_keys`.
+
+    Args:
+        weights (dict|numpy.ndarray): item -> weight mapping or an array of
+            weights, non-positive weights are forbidden
+        n (int): number of chosen items
+        random_state (numpy.random.RandomState|int): source of randomness or
+            seed, the global NumPy generator is used by default
+
+    Returns:
+        list|numpy.ndarray: chosen items ordered by their keys, positions of
+            chosen items if the weights are given as an array
+    """
+    if isinstance(weights, dict):
+        items, values = _items_and_values(weights)
+        values = numpy.array(values, dtype=float)
+    else:
+        items, values = None, numpy.asarray(weights, dtype=float)
+    if n > len(values):
+        raise Exception("Can't choose {} samples from {} items".format(n, len(values)))
+    if (values <= 0).any():
+        raise Exception("The weight can't be a non-positive number.")
+    random_state = _numpy_random(random_state)
+    keys = numpy.log(1.0 - random_state.random_sample(len(values))) / values
+    if n == 0:
+        chosen = numpy.zeros(0, dtype=int)
+    else:
+        chosen = numpy.argpartition(-keys, n - 1)[:n]
+        chosen = chosen[numpy.argsort(-keys[chosen], kind='mergesort')]
+    if items is None:
+        return chosen
+    return [items[position] for position in chosen.tolist()]
+
+
+def check_weights(weights, n):
+    """
+    Raise an exception if the given number of items can not be chosen from
+    the given weights.
+    """
+    if n > len(weights):
+        raise Exception("Can't choose {} samples from {} items".format(n, len(weights)))
+    if any(map(lambda w: w <= 0, weights.values())):
+        raise Exception("The weight can't be a non-positive number.")
+
+
+def _items_and_values(weights):
+    items = list(weights.keys())
+    return items, [weights[i] for i in items]
+
+
+def _python_random(rng):
+    if rng is None:
+        return random
+    if isinstance(rng, int):
+        return random.Random(rng)
+    return rng
+
+
+def _numpy_random(random_state):
+    if random_state is None:
+        return numpy.random
+    if isinstance(random_state, int):
+        return numpy.random.RandomState(random_state)
+    return random_state
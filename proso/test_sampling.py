@@ -0,0 +1,108 @@
+from collections import Counter
+from proso.rand import roulette
+import numpy
+import proso.sampling as sampling
+import random
+import unittest
+
+
+WEIGHTS = {'a': 1, 'b': 2, 'c': 3.5, 'd': 0.5, 'e': 10, 'f': 4}
+
+
+def original_roulette(weights, n):
+    items = weights.items()
+    chosen = []
+    for i in range(n):
+        total = sum(list(zip(*items))[1])
+        dice = random.random() * total
+        running_weight = 0
+        chosen_item = None
+        for item, weight in items:
+            if dice < running_weight + weight:
+                chosen_item = item
+                break
+            running_weight += weight
+        chosen.append(chosen_item)
+        items = [(i, w) for (i, w) in items if i != chosen_item]
+    return chosen
+
+
+class FenwickTreeTest(unittest.TestCase):
+
+    def test_find(self):
+        weights = [1, 0.5, 2, 3, 0.25, 4, 1.5]
+        tree = sampling.FenwickTree(weights)
+        self.assertEqual(sum(weights), tree.total())
+        for position in range(len(weights)):
+            self.assertEqual(sum(weights[:position]), tree.prefix(position))
+            self.assertEqual(position, tree.find(sum(weights[:position])))
+            self.assertEqual(position, tree.find(sum(weights[:position + 1]) - 0.01))
+        tree.add(2, -2)
+        self.assertEqual(3, tree.find(1.5))
+        self.assertEqual(sum(weights) - 2, tree.total())
+
+
+class SamplingTest(unittest.TestCase):
+
+    SAMPLES = 20000
+
+    def test_equivalence(self):
+        for n in [1, 2, 4]:
+            random.seed(n)
+            expected = self._frequencies(lambda: original_roulette(WEIGHTS, n))
+            samplers = [
+                lambda: roulette(WEIGHTS, n),
+                lambda: sampling.sample_sequential(WEIGHTS, n),
+                lambda: sampling.sample_keys(WEIGHTS, n),
+                lambda: sampling.sample_keys_numpy(WEIGHTS, n),
+            ]
+            for sampler in samplers:
+                found = self._frequencies(sampler)
+                for key, frequency in expected.items():
+                    self.assertAlmostEqual(frequency, found[key], delta=0.02)
+
+    def test_single_draw_is_unchanged(self):
+        for seed in range(100):
+            random.seed(seed)
+            expected = original_roulette(WEIGHTS, 1)
+            random.seed(seed)
+            self.assertEqual(expected, roulette(WEIGHTS, 1))
+
+    def test_small_pool_is_unchanged(self):
+        for seed in range(100):
+            for n in range(len(WEIGHTS) + 1):
+                random.seed(seed)
+                expected = original_roulette(WEIGHTS, n)
+                random.seed(seed)
+                self.assertEqual(expected, roulette(WEIGHTS, n))
+
+    def test_seed(self):
+        for n in range(len(WEIGHTS) + 1):
+            self.assertEqual(sampling.sample_sequential(WEIGHTS, n, rng=n), sampling.sample_sequential(WEIGHTS, n, rng=random.Random(n)))
+            self.assertEqual(sampling.sample_keys(WEIGHTS, n, rng=n), sampling.sample_keys(WEIGHTS, n, rng=random.Random(n)))
+            self.assertEqual(sampling.sample_keys_numpy(WEIGHTS, n, random_state=n), sampling.sample_keys_numpy(WEIGHTS, n, random_state=numpy.random.RandomState(n)))
+
+    def test_without_replacement(self):
+        for n in range(len(WEIGHTS) + 1):
+            for chosen in [roulette(WEIGHTS, n), sampling.sample_sequential(WEIGHTS, n), sampling.sample_keys(WEIGHTS, n), sampling.sample_keys_numpy(WEIGHTS, n)]:
+                self.assertEqual(n, len(chosen))
+                self.assertEqual(n, len(set(chosen)))
+        positions = sampling.sample_keys_numpy(numpy.arange(1, 101), 10)
+        self.assertEqual(10, len(set(positions.tolist())))
+
+    def test_invalid_weights(self):
+        for sampler in [roulette, sampling.sample_sequential, sampling.sample_keys, sampling.sample_keys_numpy]:
+            with self.assertRaises(Exception):
+                sampler(WEIGHTS, len(WEIGHTS) + 1)
+            with self.assertRaises(Exception):
+                sampler({'a': 1, 'b': 0}, 1)
+
+    def _frequencies(self, sampler):
+        """
+        Relative frequencies of (position of the draw, item) pairs.
+        """
+        counts = Counter()
+        for _ in range(self.SAMPLES):
+            for position, item in enumerate(sampler()):
+                counts[position, item] += 1
+        return Counter({key: count / self.SAMPLES for key, count in counts.items()})
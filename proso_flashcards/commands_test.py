@@ -1,6 +1,7 @@
+from django.contrib.auth.models import User
 from django.core.management import call_command
 from proso.django.test import TestCase
-from proso_flashcards.models import Category, Context, Flashcard, Term
+from proso_flashcards.models import Category, Confusion, Context, Flashcard, FlashcardAnswer, Term
 from proso_models.models import Item
 
 
@@ -111,3 +112,32 @@ class TestFlashcardsLoading(TestCase):
             self.assertTrue(flashcard.term.item_id in parents)
             self.assertTrue(flashcard.context.item_id in parents)
             self.assertEqual(len(parents), 2 + (flashcard.term_secondary is not None))
+
+
+class TestBackfillConfusions(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestBackfillConfusions, cls).setUpClass()
+        call_command('find_item_types')
+
+    def test_backfill_confusions(self):
+        for name in ['categories', 'contexts', 'terms', 'flashcards']:
+            call_command('load_flashcards', 'testproject/test_data/flashcards/{}.json'.format(name))
+        user = User.objects.create(username='user')
+        flashcards = list(Flashcard.objects.filter(lang='en').order_by('id')[:3])
+        items = [fc.item_id for fc in flashcards]
+        for answered, options in [(flashcards[1], flashcards[1:]), (None, []), (flashcards[0], [])]:
+            answer = FlashcardAnswer.objects.create(
+                user=user, item_id=items[0], item_asked_id=items[0],
+                item_answered_id=None if answered is None else answered.item_id,
+                response_time=1000, guess=1. / (len(options) + 1) if options else 0)
+            answer.options.add(*options)
+        expected = sorted([(items[0], items[0], 0, 0, 2), (items[0], items[1], 1, 1, 0), (items[0], items[2], 0, 1, 0)])
+        self.assertEqual(expected, self._confusions())
+        call_command('backfill_confusions')
+        self.assertEqual(expected, self._confusions())
+
+    def _confusions(self):
+        return sorted(Confusion.objects.values_list(
+            'item_asked_id', 'item_secondary_id', 'number_of_wrong_answers', 'number_of_options', 'number_of_open_answers'))
@@ -1,92 +1,236 @@
 from collections import defaultdict
 from contextlib import closing
-from django.core.cache import cache
 from django.db import connection
+from proso.models.answer_cache import ItemShardCache
 from proso_common.models import get_config
 from proso_models.environment import DatabaseEnvironment as ODatabaseEnvironment
-import logging
 
 
-LOGGER = logging.getLogger('django.request')
+# items of flashcards and identifiers of the contexts the terms of the
+# flashcards are used in
+CONTEXTS = '''
+    SELECT DISTINCT main.item_id, c.identifier
+    FROM proso_flashcards_flashcard AS main
+    INNER JOIN proso_flashcards_flashcard AS fc
+        ON (
+            main.term_id = fc.term_id OR
+            main.term_secondary_id = fc.term_id
+        )
+    INNER JOIN proso_flashcards_context AS c
+        ON c.id = fc.context_id
+    WHERE
+        fc.term_secondary_id IS NULL AND
+        fc.active AND
+        main.item_id IS NOT NULL
+'''
 
 
 class DatabaseEnvironment(ODatabaseEnvironment):
 
-    def confusing_factor_more_items(self, item, items, user=None):
-        cached_all = {}
-        confusing_factor_cache = cache.get('database_environment__confusing_factor', {})
-        for item_secondary in items:
-            cache_key = '{}_{}_{}'.format(item, item_secondary, user)
-            cached_item = confusing_factor_cache.get(cache_key)
-            if cached_item:
-                cached_all[item_secondary] = int(cached_item)
-        to_find = [i for i in items if i not in list(cached_all.keys())]
-        if len(cached_all) != 0:
-            LOGGER.debug('cache hit for confusing factor, item {}, {} other items and user {}'.format(item, len(cached_all), user))
-        if len(to_find) != 0:
-            LOGGER.debug('cache miss for confusing factor, item {}, {} other items and user {}'.format(item, len(to_find), user))
-            user_where, user_params = self._column_comparison('user_id', user, force_null=False)
-            with closing(connection.cursor()) as cursor:
-                cursor.execute(
-                    '''
-                    SELECT DISTINCT main.item_id, c.identifier
-                    FROM proso_flashcards_flashcard AS main
-                    INNER JOIN proso_flashcards_flashcard AS fc
-                        ON (
-                            main.term_id = fc.term_id OR
-                            main.term_secondary_id = fc.term_id
-                        )
-                    INNER JOIN proso_flashcards_context AS c
-                        ON c.id = fc.context_id
-                    WHERE
-                        fc.term_secondary_id IS NULL AND
-                        fc.active AND
-                        main.item_id IN (''' + ','.join('%s' for _ in [item] + to_find) + ')',
-                    [item] + to_find
-                )
-                context_mapping = defaultdict(set)
-                for i, c in cursor:
-                    context_mapping[i].add(c)
-            with closing(connection.cursor()) as cursor:
-                cursor.execute(
-                    '''
-                    SELECT
-                        main.item_answered_id,
-                        COUNT(main.id)::float / (open.count + closed.count) as confusing_factor
-                    FROM
-                        proso_models_answer as main
-                    INNER JOIN (
-                        SELECT item_asked_id as item, COUNT(*) as count
-                        FROM proso_models_answer
-                        WHERE item_asked_id = %s AND guess = 0 AND ''' + user_where + '''
-                        GROUP BY 1
-                    ) AS open ON open.item = main.item_asked_id
-                    INNER JOIN (
-                        SELECT proso_models_answer.item_asked_id, fc.item_id as item_option_id, COUNT(*) as count
-                        FROM proso_models_answer
-                        INNER JOIN proso_flashcards_flashcardanswer_options AS options ON proso_models_answer.id = options.flashcardanswer_id
-                        INNER JOIN proso_flashcards_flashcard AS fc on fc.id = options.flashcard_id
-                        WHERE proso_models_answer.item_asked_id = %s AND ''' + user_where + '''
-                        GROUP BY 1, 2
-                    ) AS closed ON main.item_asked_id = closed.item_asked_id AND main.item_answered_id = closed.item_option_id
-                    WHERE
-                        main.item_asked_id = %s
-                    AND main.item_answered_id IS NOT NULL
-                    AND main.item_asked_id != main.item_answered_id
-                    AND ''' + user_where + '''
-                    GROUP BY 1, open.count, closed.count
-                    ''', [item] + user_params + [item] + user_params + [item] + user_params)
-                found = {}
-                for item_answered, count in cursor:
-                    found[item_answered] = count
-                for i in to_find:
-                    found[i] = 1000 * (found.get(i, 0.05) + 0 if len(context_mapping[item]) == 0 else (len(context_mapping[i] & context_mapping[item]) / len(context_mapping[i] | context_mapping[item])))
-                cache_expiration = get_config('proso_models', 'confusing_factor.cache_expiration', default=24 * 60 * 60)
-                # trying to decrease probability of race condition
-                confusing_factor_cache = cache.get('database_environment__confusing_factor', {})
-                for item_secondary, count in found.items():
-                    cache_key = '{}_{}_{}'.format(item, item_secondary, user)
-                    confusing_factor_cache[cache_key] = count
-                    cached_all[item_secondary] = count
-                cache.set('database_environment__confusing_factor', confusing_factor_cache, cache_expiration)
-        return [cached_all[i] for i in items]
+    """
+    The confusing factor of items with contexts is given by the similarity of
+    their contexts, otherwise it is computed from answers. The shards of the
+    confusing factor cache contain the similarities of contexts, or the
+    numbers of answers the confusing factors are computed from (the number
+    of open answers and for each secondary item the number of wrong answers
+    and of answers with the item as an option), so they can be updated by
+    new answers.
+    """
+
+    CONFUSING_FACTOR_CACHE_PREFIX = 'flashcards_environment__confusing_factor'
+
+    def update_confusing_factors(self, answer):
+        asked = answer.item_asked_id
+        answered = answer.item_answered_id
+        wrong = answered is not None and answered != asked
+        if answer.guess != 0 and not wrong:
+            return
+
+        def _update(item, user, shard):
+            if shard['contexts']:
+                return None
+            if answer.guess == 0:
+                shard['open'] += 1
+            if wrong and ItemShardCache.contains(shard, answered):
+                shard['entries'].setdefault(answered, [0, 0])[0] += 1
+            return shard
+        self._confusing_factor_cache().update([(asked, None), (asked, answer.user_id)], _update)
+
+    def update_confusing_factor_options(self, answer, option_items):
+        """
+        Update the cached confusing factors by the options of the given
+        answer, the options are added after the answer is saved.
+        """
+        def _update(item, user, shard):
+            if shard['contexts']:
+                return None
+            for option in option_items:
+                if ItemShardCache.contains(shard, option):
+                    shard['entries'].setdefault(option, [0, 0])[1] += 1
+            return shard
+        self._confusing_factor_cache().update([(answer.item_asked_id, None), (answer.item_asked_id, answer.user_id)], _update)
+
+    def warm_up_confusing_factors(self, user=None):
+        confusing_factor_cache = self._confusing_factor_cache()
+        context_mapping = self._contexts()
+        # the shards of items with contexts are not updated by answers
+        versions = confusing_factor_cache.versions(set(context_mapping.keys()) | set(self._asked_items(user)), user=user)
+        by_context = defaultdict(set)
+        for item, contexts in context_mapping.items():
+            for context in contexts:
+                by_context[context].add(item)
+        shards = {}
+        for item, contexts in context_mapping.items():
+            similar = set.union(*[by_context[context] for context in contexts])
+            shards[item] = ItemShardCache.shard(
+                {i: self._context_similarity(context_mapping[i], contexts) for i in similar},
+                complete=True, contexts=True)
+        opened, pairs = self._confusing_factor_components(user)
+        for item in (set(opened.keys()) | set(pairs.keys())) & set(versions.keys()):
+            shards[item] = ItemShardCache.shard(pairs.get(item, {}), complete=True, contexts=False, open=opened.get(item, 0))
+        confusing_factor_cache.set_many(shards, versions, user=user)
+        return len(shards)
+
+    def _find_confusing_factors(self, to_find, user):
+        context_mapping = self._contexts(list(set(to_find.keys()) | {i for items in to_find.values() for i in items}))
+        without_contexts = [item for item in to_find.keys() if len(context_mapping[item]) == 0]
+        opened, pairs = {}, {}
+        if len(without_contexts) > 0:
+            opened, pairs = self._confusing_factor_components(
+                user, asked=without_contexts, secondaries=list({i for item in without_contexts for i in to_find[item]}))
+        shards = {}
+        for item, items in to_find.items():
+            contexts = context_mapping[item]
+            if len(contexts) > 0:
+                shards[item] = ItemShardCache.shard(
+                    {i: self._context_similarity(context_mapping[i], contexts) for i in items}, contexts=True)
+            else:
+                item_pairs = pairs.get(item, {})
+                shards[item] = ItemShardCache.shard(
+                    {i: item_pairs.get(i, [0, 0]) for i in items}, contexts=False, open=opened.get(item, 0))
+        return shards
+
+    def _confusing_factor_from_shard(self, shard, item_secondary):
+        entry = shard['entries'].get(item_secondary)
+        if shard['contexts']:
+            return 1000 * (0 if entry is None else entry)
+        wrong, closed = (0, 0) if entry is None else entry
+        if wrong == 0 or closed == 0 or shard['open'] == 0:
+            return 1000 * 0.05
+        return 1000 * wrong / (shard['open'] + closed)
+
+    def _context_similarity(self, contexts, other_contexts):
+        return len(contexts & other_contexts) / len(contexts | other_contexts)
+
+    def _contexts(self, items=None):
+        """
+        Returns:
+            dict: item -> set of identifiers of contexts
+        """
+        params = []
+        sql = CONTEXTS
+        if items is not None:
+            sql += ' AND main.item_id IN (' + ','.join('%s' for _ in items) + ')'
+            params = items
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(sql, params)
+            context_mapping = defaultdict(set)
+            for i, c in cursor:
+                context_mapping[i].add(c)
+        return context_mapping
+
+    def _confusing_factor_components(self, user, asked=None, secondaries=None):
+        """
+        Count the answers the confusing factors are computed from. The
+        answers of all users are read from
+        :class:`proso_flashcards.models.Confusion` when
+        'proso_flashcards.confusions.enabled' is set.
+
+        Args:
+            user (int): user, all users by default
+            asked (list): asked items, all items without contexts by default
+            secondaries (list): secondary items, all items by default
+
+        Returns:
+            tuple: number of open answers (item -> count) and numbers of
+            wrong answers and of answers with the secondary item as an option
+            (item -> secondary item -> [wrong, closed])
+        """
+        if user is None and get_config('proso_flashcards', 'confusions.enabled', default=False):
+            return self._confusions(asked, secondaries)
+        user_where, user_params = self._column_comparison('user_id', user, force_null=False)
+        if asked is None:
+            asked_where, asked_params = 'NOT IN (SELECT item_id FROM (' + CONTEXTS + ') AS contexts)', []
+        else:
+            asked_where, asked_params = 'IN (' + ','.join('%s' for _ in asked) + ')', list(asked)
+
+        def _secondary_where(column):
+            if secondaries is None:
+                return '', []
+            return ' AND ' + column + ' IN (' + ','.join('%s' for _ in secondaries) + ')', list(secondaries)
+        answered_where, answered_params = _secondary_where('item_answered_id')
+        option_where, option_params = _secondary_where('fc.item_id')
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(
+                '''
+                SELECT 0, item_asked_id, NULL, COUNT(*)
+                FROM proso_models_answer
+                WHERE item_asked_id ''' + asked_where + ''' AND guess = 0 AND ''' + user_where + '''
+                GROUP BY item_asked_id
+                UNION ALL
+                SELECT 1, item_asked_id, item_answered_id, COUNT(*)
+                FROM proso_models_answer
+                WHERE item_asked_id ''' + asked_where + '''
+                    AND item_answered_id IS NOT NULL
+                    AND item_asked_id != item_answered_id
+                    AND ''' + user_where + answered_where + '''
+                GROUP BY item_asked_id, item_answered_id
+                UNION ALL
+                SELECT 2, proso_models_answer.item_asked_id, fc.item_id, COUNT(*)
+                FROM proso_models_answer
+                INNER JOIN proso_flashcards_flashcardanswer_options AS options ON proso_models_answer.id = options.flashcardanswer_id
+                INNER JOIN proso_flashcards_flashcard AS fc on fc.id = options.flashcard_id
+                WHERE proso_models_answer.item_asked_id ''' + asked_where + ''' AND ''' + user_where + option_where + '''
+                GROUP BY proso_models_answer.item_asked_id, fc.item_id
+                ''',
+                asked_params + user_params +
+                asked_params + user_params + answered_params +
+                asked_params + user_params + option_params)
+            opened = {}
+            pairs = defaultdict(dict)
+            for component, item, item_secondary, count in cursor:
+                if component == 0:
+                    opened[item] = count
+                else:
+                    pairs[item].setdefault(item_secondary, [0, 0])[component - 1] = count
+        return opened, pairs
+
+    def _confusions(self, asked=None, secondaries=None):
+        """
+        Read the numbers of answers of all users from
+        :class:`proso_flashcards.models.Confusion`, the arguments and the
+        result are the same as for :meth:`_confusing_factor_components`.
+        """
+        where, params = '', []
+        if asked is None:
+            where = 'WHERE item_asked_id NOT IN (SELECT item_id FROM (' + CONTEXTS + ') AS contexts)'
+        else:
+            where = 'WHERE item_asked_id IN (' + ','.join('%s' for _ in asked) + ')'
+            params = list(asked)
+        if secondaries is not None:
+            where += ' AND (item_secondary_id = item_asked_id OR item_secondary_id IN (' + ','.join('%s' for _ in secondaries) + '))'
+            params += list(secondaries)
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(
+                '''
+                SELECT item_asked_id, item_secondary_id, number_of_wrong_answers, number_of_options, number_of_open_answers
+                FROM proso_flashcards_confusion
+                ''' + where, params)
+            opened = {}
+            pairs = defaultdict(dict)
+            for item, item_secondary, wrong, options, open_answers in cursor:
+                if item == item_secondary:
+                    opened[item] = open_answers
+                else:
+                    pairs[item][item_secondary] = [wrong, options]
+        return opened, pairs
@@ -0,0 +1,90 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from proso.django.test import TestCase
+from proso_flashcards.environment import DatabaseEnvironment
+from proso_flashcards.models import Flashcard, FlashcardAnswer
+from proso_models.models import Answer, Item
+import proso.django.config as config
+
+
+class TestConfusingFactor(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestConfusingFactor, cls).setUpClass()
+        call_command('find_item_types')
+
+    def setUp(self):
+        super(TestConfusingFactor, self).setUp()
+        # ids of items are reused by tests
+        cache.clear()
+        config.override('proso_models.environment.class', 'proso_flashcards.environment.DatabaseEnvironment')
+        for name in ['categories', 'contexts', 'terms', 'flashcards']:
+            call_command('load_flashcards', 'testproject/test_data/flashcards/{}.json'.format(name))
+        self._users = [User.objects.create(username=str(i)).id for i in range(2)]
+        self._flashcards = list(Flashcard.objects.filter(lang='en').order_by('id'))
+        # an item without contexts
+        self._item = Item.objects.create().id
+        self._items = [self._item] + sorted({fc.item_id for fc in self._flashcards})
+
+    def tearDown(self):
+        config.reset_overridden()
+
+    def test_confusing_factors(self):
+        self._answer(0, self._item, self._flashcards[1], self._flashcards[:3])
+        self._answer(0, self._item, self._flashcards[0], [])
+        self._answer(1, self._item, None, [])
+        self._answer(1, self._item, self._flashcards[2], self._flashcards[1:3])
+        self._answer(0, self._flashcards[0].item_id, self._flashcards[1], [])
+        self._assert_original_confusing_factors()
+        # the cached confusing factors are updated by new answers
+        self._answer(0, self._item, self._flashcards[2], self._flashcards[1:4])
+        self._answer(1, self._item, self._flashcards[1], [])
+        self._answer(1, self._item, self._flashcards[3], self._flashcards[3:])
+        self._assert_original_confusing_factors()
+        cache.clear()
+        self._assert_original_confusing_factors()
+
+    def _answer(self, user, asked, answered, options):
+        answer = FlashcardAnswer.objects.create(
+            user_id=self._users[user], item_id=asked, item_asked_id=asked,
+            item_answered_id=None if answered is None else answered.item_id,
+            response_time=1000, guess=1. / (len(options) + 1) if options else 0)
+        answer.options.add(*options)
+
+    def _assert_original_confusing_factors(self):
+        pairs = {item: [i for i in self._items if i != item] for item in self._items}
+        for user in [None] + self._users:
+            found = DatabaseEnvironment().confusing_factor_more_pairs(pairs, user=user)
+            for item, items in pairs.items():
+                expected = [self._original_confusing_factor(item, i, user) for i in items]
+                self.assertEqual([round(x, 6) for x in expected], [round(x, 6) for x in found[item]])
+
+    def _original_confusing_factor(self, item, item_secondary, user):
+        """
+        The formula of the confusing factor before the cached shards were
+        introduced.
+        """
+        contexts = self._contexts(item)
+        if len(contexts) > 0:
+            other_contexts = self._contexts(item_secondary)
+            return 1000 * len(contexts & other_contexts) / len(contexts | other_contexts)
+        answers = Answer.objects.filter(item_asked_id=item)
+        if user is not None:
+            answers = answers.filter(user_id=user)
+        opened = answers.filter(guess=0).count()
+        closed = FlashcardAnswer.objects.filter(id__in=answers, options__item_id=item_secondary).count()
+        wrong = answers.filter(item_answered_id=item_secondary).count()
+        if opened == 0 or closed == 0 or wrong == 0:
+            return 1000 * 0.05
+        return 1000 * wrong / (opened + closed)
+
+    def _contexts(self, item):
+        contexts = set()
+        for main in Flashcard.objects.filter(item_id=item):
+            terms = [t for t in [main.term_id, main.term_secondary_id] if t is not None]
+            contexts |= set(Flashcard.objects.filter(
+                term_id__in=terms, term_secondary__isnull=True, active=True
+            ).values_list('context__identifier', flat=True))
+        return contexts
@@ -0,0 +1,49 @@
+from contextlib import closing
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db import transaction
+from proso.django.db import is_on_postgresql
+from proso.time import timer
+
+
+class Command(BaseCommand):
+
+    help = "count answers to flashcards the confusing factors are computed from, the counts are used by the environment when 'proso_flashcards.confusions.enabled' is set"
+
+    def handle(self, *args, **options):
+        timer('backfill_confusions')
+        with transaction.atomic():
+            with closing(connection.cursor()) as cursor:
+                if is_on_postgresql():
+                    # new answers wait until the confusions are counted
+                    cursor.execute('LOCK TABLE proso_models_answer IN SHARE MODE')
+                cursor.execute('DELETE FROM proso_flashcards_confusion')
+                cursor.execute(
+                    '''
+                    INSERT INTO proso_flashcards_confusion
+                        (item_asked_id, item_secondary_id, number_of_wrong_answers, number_of_options, number_of_open_answers)
+                    SELECT item_asked_id, item_secondary_id, SUM(wrong), SUM(options), SUM(open)
+                    FROM (
+                        SELECT item_asked_id, item_asked_id AS item_secondary_id, 0 AS wrong, 0 AS options, COUNT(*) AS open
+                        FROM proso_models_answer
+                        INNER JOIN proso_flashcards_flashcardanswer ON id = answer_ptr_id
+                        WHERE guess = 0
+                        GROUP BY item_asked_id
+                        UNION ALL
+                        SELECT item_asked_id, item_answered_id, COUNT(*), 0, 0
+                        FROM proso_models_answer
+                        INNER JOIN proso_flashcards_flashcardanswer ON id = answer_ptr_id
+                        WHERE item_answered_id IS NOT NULL AND item_asked_id != item_answered_id
+                        GROUP BY item_asked_id, item_answered_id
+                        UNION ALL
+                        SELECT proso_models_answer.item_asked_id, fc.item_id, 0, COUNT(*), 0
+                        FROM proso_models_answer
+                        INNER JOIN proso_flashcards_flashcardanswer_options AS options ON proso_models_answer.id = options.flashcardanswer_id
+                        INNER JOIN proso_flashcards_flashcard AS fc ON fc.id = options.flashcard_id
+                        WHERE fc.item_id IS NOT NULL
+                        GROUP BY proso_models_answer.item_asked_id, fc.item_id
+                    ) AS counts
+                    GROUP BY item_asked_id, item_secondary_id
+                    ''')
+                confusions = cursor.rowcount
+        print(' -- counting confusions, time:', timer('backfill_confusions'), 'seconds,', confusions, 'confusions')
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('proso_flashcards', '0006_auto_flashcard_open_questions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Confusion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number_of_wrong_answers', models.IntegerField(default=0)),
+                ('number_of_options', models.IntegerField(default=0)),
+                ('number_of_open_answers', models.IntegerField(default=0)),
+                ('item_asked', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='flashcard_confusions', to='proso_models.Item')),
+                ('item_secondary', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='flashcard_secondary_confusions', to='proso_models.Item')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='confusion',
+            unique_together=set([('item_asked', 'item_secondary')]),
+        ),
+    ]
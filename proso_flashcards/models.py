@@ -1,12 +1,15 @@
+from contextlib import closing
 from django.conf import settings
+from django.db import connection
 from django.db import models
 from django.db.models import Q
-from django.db.models.signals import pre_save, post_save, pre_delete
+from django.db.models.signals import pre_save, post_save, pre_delete, m2m_changed
 from django.dispatch import receiver
+from proso.django.db import is_on_postgresql
 from proso.django.models import ModelDiffMixin
 from proso.django.models import disable_for_loaddata
 from proso.django.request import get_current_request
-from proso_models.models import Item, ItemRelation, Answer
+from proso_models.models import Item, ItemRelation, Answer, get_environment
 import logging
 
 
@@ -270,6 +273,29 @@ class FlashcardAnswer(Answer):
         return json
 
 
+class Confusion(models.Model):
+
+    """
+    Numbers of answers the confusing factors of flashcards are computed from.
+    For a pair of different items it holds the number of wrong answers to
+    the asked item with the secondary item answered and the number of
+    answers to the asked item with the secondary item as an option, the row
+    of the asked item with itself holds the number of open answers to the
+    item. The numbers are updated when a flashcard answer is saved, the
+    existing answers are counted by the backfill_confusions command. The
+    environment uses them when 'proso_flashcards.confusions.enabled' is set.
+    """
+
+    item_asked = models.ForeignKey(Item, related_name='flashcard_confusions')
+    item_secondary = models.ForeignKey(Item, related_name='flashcard_secondary_confusions')
+    number_of_wrong_answers = models.IntegerField(default=0)
+    number_of_options = models.IntegerField(default=0)
+    number_of_open_answers = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('item_asked', 'item_secondary')
+
+
 PROSO_MODELS_TO_EXPORT = [Category, Flashcard, FlashcardAnswer,
                           settings.PROSO_FLASHCARDS.get("context_extension", Context),
                           settings.PROSO_FLASHCARDS.get("term_extension", Term)]
@@ -406,3 +432,65 @@ def delete_parent(sender, instance, **kwargs):
     relations.
     """
     ItemRelation.objects.filter(child_id=instance.item_id).delete()
+
+
+@receiver(post_save, sender=FlashcardAnswer)
+@disable_for_loaddata
+def update_confusions(sender, instance, **kwargs):
+    if not kwargs['created']:
+        return
+    counts = []
+    if instance.guess == 0:
+        counts.append((instance.item_asked_id, 0, 0, 1))
+    if instance.item_answered_id is not None and instance.item_answered_id != instance.item_asked_id:
+        counts.append((instance.item_answered_id, 1, 0, 0))
+    _increment_confusions(instance.item_asked_id, counts)
+
+
+@receiver(m2m_changed, sender=FlashcardAnswer.options.through)
+@disable_for_loaddata
+def update_confusing_factor_options(sender, instance, action, reverse, pk_set, **kwargs):
+    if action != 'post_add' or reverse or not pk_set:
+        return
+    option_items = [i for i in Flashcard.objects.filter(pk__in=pk_set).values_list('item_id', flat=True) if i is not None]
+    _increment_confusions(instance.item_asked_id, [(i, 0, 1, 0) for i in option_items])
+    # the environment module depends on this one
+    from proso_flashcards.environment import DatabaseEnvironment
+    environment = get_environment()
+    if isinstance(environment, DatabaseEnvironment):
+        environment.update_confusing_factor_options(instance, option_items)
+
+
+def _increment_confusions(item_asked, counts):
+    """
+    Args:
+        item_asked (int): asked item
+        counts (list): tuples (secondary item, wrong answers, options, open
+            answers) to add
+    """
+    with closing(connection.cursor()) as cursor:
+        for item_secondary, wrong, options, opened in counts:
+            if is_on_postgresql():
+                cursor.execute(
+                    '''
+                    INSERT INTO proso_flashcards_confusion
+                        (item_asked_id, item_secondary_id, number_of_wrong_answers, number_of_options, number_of_open_answers)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (item_asked_id, item_secondary_id) DO UPDATE SET
+                        number_of_wrong_answers = proso_flashcards_confusion.number_of_wrong_answers + EXCLUDED.number_of_wrong_answers,
+                        number_of_options = proso_flashcards_confusion.number_of_options + EXCLUDED.number_of_options,
+                        number_of_open_answers = proso_flashcards_confusion.number_of_open_answers + EXCLUDED.number_of_open_answers
+                    ''', [item_asked, item_secondary, wrong, options, opened])
+                continue
+            cursor.execute(
+                '''
+                UPDATE proso_flashcards_confusion SET
+                    number_of_wrong_answers = number_of_wrong_answers + %s,
+                    number_of_options = number_of_options + %s,
+                    number_of_open_answers = number_of_open_answers + %s
+                WHERE item_asked_id = %s AND item_secondary_id = %s
+                ''', [wrong, options, opened, item_asked, item_secondary])
+            if cursor.rowcount == 0:
+                Confusion.objects.create(
+                    item_asked_id=item_asked, item_secondary_id=item_secondary, number_of_wrong_answers=wrong,
+                    number_of_options=options, number_of_open_answers=opened)
@@ -0,0 +1,39 @@
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from mock import patch
+from proso.django.test import TestCase
+from proso_models.management.commands.recompute_model import Command as RecomputeModel
+from proso_models.models import Answer, EnvironmentInfo, Item
+import datetime
+
+
+class TestCatchUp(TestCase):
+
+    def setUp(self):
+        self._user = User.objects.create(username='user')
+        self._item = Item.objects.create()
+
+    def test_answer_committed_late(self):
+        self._answer()
+        call_command('recompute_model', initial=True)
+        self._answer()
+        committed = self._answer()
+        saved = self._answer(committed.id + 2)
+        late = []
+
+        def _committed_answer_id():
+            if len(late) == 0:
+                # the answer between them is still being saved
+                late.append(self._answer(committed.id + 1))
+                return committed.id
+            return saved.id
+        with patch.object(RecomputeModel, 'committed_answer_id', side_effect=_committed_answer_id):
+            call_command('recompute_model', finish=True, catch_up=0)
+        info = EnvironmentInfo.objects.get(status=EnvironmentInfo.STATUS_ACTIVE)
+        self.assertEqual(Answer.objects.count(), info.load_progress)
+        self.assertEqual(saved.id, info.load_last_answer_id)
+
+    def _answer(self, answer_id=None):
+        return Answer.objects.create(
+            id=answer_id, user=self._user, item=self._item, item_asked=self._item, item_answered=self._item,
+            time=datetime.datetime.now(), response_time=1000, guess=0)
@@ -1,26 +1,53 @@
 from .models import Answer, Variable
+from collections import defaultdict, OrderedDict
 from contextlib import closing
-from datetime import datetime
+from datetime import datetime, timedelta
 from django.conf import settings
 from django.core.cache import cache
 from django.db import connection
 from django.db import transaction
+from functools import lru_cache
+from proso.django.cache import is_cache_prepared, get_from_request_permenent_cache, set_to_request_permanent_cache
 from proso.django.db import is_on_postgresql
-from proso.models.environment import CommonEnvironment, InMemoryEnvironment
+from proso.models.answer_cache import HasAnswerCache, ItemShardCache
+from proso.models.environment import CommonEnvironment, InMemoryEnvironment, decode_rows, encode_rows
 from proso_common.models import get_config
 from proso.time import timeit
+import json
 import logging
-import os.path
+import numpy
 import re
+import sqlite3
+import threading
 
 LOGGER = logging.getLogger('django.request')
 
 # This is hack to emulate TRUE value on both psql and sqlite
 DATABASE_TRUE = '1 = 1'
 
+REQUEST_MEMO_KEY = 'database_environment__memo'
+
 
 class InMemoryDatabaseFlushEnvironment(InMemoryEnvironment):
 
+    """
+    In-memory environment used to recompute the model, variables are
+    prefetched from the database and flushed back at the end of the
+    recomputation.
+
+    The memory can be bounded by the maximal number of variables related to
+    users (the variables without a user are always kept in the memory). When
+    the number is exceeded, variables of the least recently used users are
+    spilled to a temporary SQLite database (placed to the directory given by
+    SQLITE_TMPDIR or TMPDIR environment variable) and they are loaded back
+    when the user is accessed again.
+
+    Args:
+        info (proso_models.models.EnvironmentInfo): loaded environment
+        max_variables (int): maximal number of variables related to users
+            kept in the memory, unbounded by default
+    """
+
     DROP_KEYS = [
         InMemoryEnvironment.NUMBER_OF_ANSWERS,
         InMemoryEnvironment.NUMBER_OF_FIRST_ANSWERS,
@@ -29,43 +56,130 @@ class InMemoryDatabaseFlushEnvironment(InMemoryEnvironment):
         InMemoryEnvironment.CONFUSING_FACTOR
     ]
 
-    def __init__(self, info):
-        # key -> user -> item_primary -> item_secondary -> [(time, value)]
+    PREFETCHED_COLUMNS = [
+        ('keys', 'str'),
+        ('users', 'id'),
+        ('items_primary', 'id'),
+        ('items_secondary', 'id'),
+        ('times', 'time'),
+        ('values', 'float'),
+        ('ids', 'id'),
+    ]
+
+    # when the memory is exceeded, users are spilled until the number of
+    # variables drops to this fraction of the maximum
+    SPILL_RATIO = 0.75
+
+    def __init__(self, info, max_variables=None):
         InMemoryEnvironment.__init__(self)
-        self._prefetched = {}
+        # user -> (key, item_primary, item_secondary) -> (time, value, id)
+        self._prefetched = defaultdict(dict)
         self._info_id = info.id
         self._to_delete = []
+        # ids of all variables replaced in the memory, including the ones
+        # already deleted by a flush
+        self._deleted = set()
+        self._max_variables = max_variables
+        self._spill = None
+        # user -> number of variables in the memory, the least recently
+        # used user is the first one
+        self._user_sizes = OrderedDict()
+        self._size = 0
+
+    def prefetch(self, users, items, keys=None):
+        """
+        Load variables of the given users and items from the database.
 
-    def prefetch(self, users, items):
+        Args:
+            users (list): ids of users
+            items (list): ids of items
+            keys (set): keys of the variables read by the predictive model
+                (see :meth:`proso.models.prediction.PredictiveModel.variable_keys`),
+                the variables maintained by the environment itself are
+                loaded as well, all variables are loaded by default
+        """
         if len(users) == 0 and len(items) == 0:
             return
-        users = list(map(str, users))
-        items = list(map(str, items))
-        with closing(connection.cursor()) as cursor:
-            cursor.execute(
-                '''
-                SELECT key, user_id, item_primary_id, item_secondary_id, updated, value, id
-                FROM proso_models_variable
-                WHERE
-                    permanent OR
+        if keys is not None:
+            keys = set(keys) | set(self.DROP_KEYS)
+        for i, row in enumerate(self._read_prefetched(list(users), list(items), keys)):
+            # variables overwritten in the memory since the previous
+            # prefetch are not prefetched again
+            if row[6] in self._deleted:
+                continue
+            self._touch(row[1])
+            user_prefetched = self._prefetched[row[1]]
+            if self._max_variables is not None and (row[0], row[2], row[3]) not in user_prefetched:
+                self._resize(row[1], 1)
+            user_prefetched[row[0], row[2], row[3]] = (row[4].replace(tzinfo=None), row[5], row[6])
+            if i % 10000 == 0:
+                self._check_memory()
+        self._check_memory()
+
+    def _read_prefetched(self, users, items, keys):
+        """
+        Stream the variables to prefetch. On PostgreSQL the ids are passed as
+        arrays and the rows are fetched by a server-side cursor in chunks,
+        elsewhere the ids are loaded to temporary tables.
+        """
+        where = '''
+            ({keys})
+            AND
+            (
+                permanent OR
+                (
+                    (info_id = %s)
+                    AND
+                    ({users} OR user_id IS NULL)
+                    AND
                     (
-                        (info_id = %s)
-                        AND
-                        (user_id IN (''' + ','.join(users) + ''') OR user_id is NULL)
-                        AND
-                        (
-                            item_primary_id IS NULL
-                            OR
-                            item_primary_id IN (''' + ','.join(items) + ''')
-                            OR
-                            item_secondary_id IN (''' + ','.join(items) + ''')
-                        )
+                        item_primary_id IS NULL
+                        OR
+                        {items_primary}
+                        OR
+                        {items_secondary}
                     )
-                ''', [self._info_id])
+                )
+            )
+        '''
+        select = 'SELECT key, user_id, item_primary_id, item_secondary_id, updated, value, id FROM proso_models_variable WHERE '
+        if is_on_postgresql():
+            params = ([] if keys is None else [list(keys)]) + [self._info_id, users, items, items]
+            query = select + where.format(
+                keys=DATABASE_TRUE if keys is None else 'key = ANY(%s)',
+                users='user_id = ANY(%s)',
+                items_primary='item_primary_id = ANY(%s)',
+                items_secondary='item_secondary_id = ANY(%s)')
+            # named cursors live only inside a transaction
+            with transaction.atomic():
+                connection.ensure_connection()
+                with closing(connection.connection.cursor(name='proso_models_prefetch')) as cursor:
+                    cursor.itersize = 10000
+                    cursor.execute(query, params)
+                    for row in cursor:
+                        yield row
+            return
+        tables = [
+            ('proso_models_prefetch_user', users),
+            ('proso_models_prefetch_item', items),
+        ]
+        if keys is not None:
+            tables.append(('proso_models_prefetch_key', list(keys)))
+        with closing(connection.cursor()) as cursor:
+            for table, values in tables:
+                cursor.execute('CREATE TEMPORARY TABLE IF NOT EXISTS {} (value)'.format(table))
+                cursor.execute('DELETE FROM {}'.format(table))
+                cursor.executemany('INSERT INTO {} VALUES (%s)'.format(table), [(v,) for v in values])
+            cursor.execute(select + where.format(
+                keys=DATABASE_TRUE if keys is None else 'key IN (SELECT value FROM proso_models_prefetch_key)',
+                users='user_id IN (SELECT value FROM proso_models_prefetch_user)',
+                items_primary='item_primary_id IN (SELECT value FROM proso_models_prefetch_item)',
+                items_secondary='item_secondary_id IN (SELECT value FROM proso_models_prefetch_item)'), [self._info_id])
             for row in cursor:
-                self._prefetched[row[0], row[1], row[2], row[3]] = (row[4].replace(tzinfo=None), row[5], row[6])
+                yield row
 
     def read(self, key, user=None, item=None, item_secondary=None, default=None, symmetric=True):
+        self._touch(user)
         prefetched = self._get_prefetched(key, user, item, item_secondary, symmetric)
         if prefetched:
             return prefetched[1]
@@ -77,24 +191,47 @@ class InMemoryDatabaseFlushEnvironment(InMemoryEnvironment):
 
     def read_all_with_key(self, key):
         found = []
-        for k, v in self._prefetched.items():
+        for k in self._iter_prefetched():
             if k[0] == key:
-                found.append((k[1], k[2], k[3], v[1]))
-        return found + InMemoryEnvironment.read_all_with_key(self, key)
+                found.append((k[1], k[2], k[3], k[5]))
+        found += InMemoryEnvironment.read_all_with_key(self, key)
+        if self._spill is not None:
+            found += [(u, i_p, i_s, v) for (k, u, i_p, i_s, p, t, a, v) in self._spill.variables() if k == key]
+        return found
+
+    def get_items_with_values(self, key, item, user=None):
+        self._touch(user)
+        return InMemoryEnvironment.get_items_with_values(self, key, item, user=user)
 
     def write(self, key, value, user=None, item=None, item_secondary=None, time=None, symmetric=True, permanent=False, answer=None):
-        prefetched_key = self._prefetched_key(key, user, item, item_secondary, symmetric)
-        prefetched = self._prefetched.get(prefetched_key)
-        if prefetched is not None:
-            self._to_delete.append(prefetched[2])
-            del self._prefetched[prefetched_key]
+        self._touch(user)
+        user_prefetched = self._prefetched.get(user)
+        if user_prefetched is not None:
+            prefetched = user_prefetched.pop(self._prefetched_key(key, item, item_secondary, symmetric), None)
+            if prefetched is not None:
+                self._to_delete.append(prefetched[2])
+                self._deleted.add(prefetched[2])
+                self._resize(user, -1)
+        new = (
+            self._max_variables is not None and user is not None and
+            InMemoryEnvironment._get(self, key, user=user, item=item, item_secondary=item_secondary, symmetric=symmetric) is None
+        )
         InMemoryEnvironment.write(
             self, key, value, user=user, item=item,
             item_secondary=item_secondary, time=time,
             symmetric=symmetric, permanent=permanent, answer=answer
         )
+        if new:
+            self._resize(user, 1)
+            self._check_memory()
+
+    def delete(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        self._touch(user)
+        InMemoryEnvironment.delete(self, key, user=user, item=item, item_secondary=item_secondary, symmetric=symmetric)
+        self._resize(user, -1)
 
     def time(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        self._touch(user)
         prefetched = self._get_prefetched(key, user, item, item_secondary, symmetric)
         if prefetched:
             return prefetched[0]
@@ -104,44 +241,496 @@ class InMemoryDatabaseFlushEnvironment(InMemoryEnvironment):
                 item_secondary=item_secondary, symmetric=symmetric
             )
 
+    def export_values(self):
+        for values in InMemoryEnvironment.export_values(self):
+            yield values
+        if self._spill is not None:
+            for values in self._spill.variables():
+                yield values
+
     def flush(self, clean):
-        filename_variable = os.path.join(settings.DATA_DIR, 'environment_flush_variable.csv')
-        with open(filename_variable, 'w') as file_variable:
-            for (key, u, i_p, i_s, p, t, a, v) in self.export_values():
-                file_variable.write(
-                    '%s,%s,%s,%s,%s,%s,%s,%s,%s\n' % (key, u, i_p, i_s, v, t, a, p, self._info_id))
+        """
+        Write all variables to the database and delete the variables they
+        replace.
+
+        Args:
+            clean (bool): delete the variables related to answers
+                (see DROP_KEYS) afterwards
+        """
+        self._write(self.export_values(), self._to_delete, clean)
+
+    def flush_in_background(self, clean, callback=None):
+        """
+        Write the variables to the database while the environment can be
+        used to replay the following answers. The ids of the written
+        variables are reserved in advance, so the environment continues as if
+        the variables were prefetched from the database after the flush.
+        Only one flush can run at a time, the previous one has to be waited
+        for. On databases other than PostgreSQL the variables are written
+        immediately.
+
+        Args:
+            clean (bool): delete the variables related to answers
+                (see DROP_KEYS) afterwards
+            callback (function): called in the transaction of the flush
+
+        Returns:
+            Flush: the running flush
+        """
+        ids = self._reserve_ids(self._count_values())
+        to_delete = self._to_delete
+        self._to_delete = []
+        values = self._convert_to_prefetched(ids)
+
+        def _flush():
+            self._write(values, to_delete, clean, ids=ids)
+            if callback is not None:
+                callback()
+        return Flush(_flush, background=is_on_postgresql())
+
+    def _write(self, values, to_delete, clean, ids=None):
+        columns = ['key', 'user_id', 'item_primary_id', 'item_secondary_id', 'value', 'updated', 'answer_id', 'permanent', 'info_id']
+        rows = ((key, u, i_p, i_s, v, t, a, p, self._info_id) for (key, u, i_p, i_s, p, t, a, v) in values)
+        if ids is not None:
+            columns = ['id'] + columns
+            rows = ((variable_id,) + row for variable_id, row in zip(ids, rows))
         with transaction.atomic():
             with closing(connection.cursor()) as cursor:
-                cursor.execute('SET CONSTRAINTS ALL DEFERRED')
-                if self._to_delete:
-                    cursor.execute('DELETE FROM proso_models_variable WHERE id IN (' + ','.join(map(str, self._to_delete)) + ')')
-                with open(filename_variable, 'r') as file_variable:
-                    cursor.copy_from(
-                        file_variable,
-                        'proso_models_variable',
-                        sep=',',
-                        null='None',
-                        columns=['key', 'user_id', 'item_primary_id', 'item_secondary_id', 'value', 'updated', 'answer_id', 'permanent', 'info_id']
-                    )
+                if is_on_postgresql():
+                    cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+                    if to_delete:
+                        cursor.execute('DELETE FROM proso_models_variable WHERE id = ANY(%s)', [list(to_delete)])
+                    cursor.copy_from(_CopyBuffer(rows), 'proso_models_variable', sep=',', null='None', columns=columns)
+                else:
+                    cursor.executemany('DELETE FROM proso_models_variable WHERE id = %s', [(variable_id,) for variable_id in to_delete])
+                    cursor.executemany(
+                        'INSERT INTO proso_models_variable (' + ', '.join(columns) + ') VALUES (' + ', '.join(['%s' for c in columns]) + ')',
+                        list(rows))
                 if clean:
                     cursor.execute('DELETE FROM proso_models_variable WHERE key IN (' + ','.join(['%s' for k in self.DROP_KEYS]) + ') AND info_id = %s', self.DROP_KEYS + [self._info_id])
 
+    def _count_values(self):
+        count = sum(len(secondaries) for users in self._data.values() for primaries in users.values() for secondaries in primaries.values())
+        if self._spill is not None:
+            count += self._spill.count_variables()
+        return count
+
+    def _reserve_ids(self, count, chunk_size=100000):
+        with closing(connection.cursor()) as cursor:
+            if is_on_postgresql():
+                ids = numpy.empty(count, dtype=numpy.int64)
+                for start in range(0, count, chunk_size):
+                    size = min(chunk_size, count - start)
+                    cursor.execute(
+                        "SELECT nextval(pg_get_serial_sequence('proso_models_variable', 'id')) FROM generate_series(1, %s)",
+                        [size])
+                    ids[start:start + size] = [row[0] for row in cursor.fetchall()]
+                return ids
+            # the variables are written immediately, so nothing can take the
+            # ids in the meantime
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM proso_models_variable')
+            last_id = cursor.fetchone()[0]
+            return range(last_id + 1, last_id + count + 1)
+
+    def _convert_to_prefetched(self, ids):
+        """
+        Turn the variables (the variables kept in the memory go first) to
+        prefetched variables with the given ids.
+
+        Returns:
+            iterator: the converted variables in the format of
+            :meth:`export_values`, they are not affected by the following
+            changes of the environment
+        """
+        ids = map(int, ids)
+        data = self._data
+        for (key, user, item_primary, item_secondary, permanent, time, answer, value), variable_id in zip(InMemoryEnvironment.export_values(self), ids):
+            self._prefetched[user][key, item_primary, item_secondary] = (time, value, variable_id)
+        self._data = defaultdict(lambda: defaultdict(lambda: defaultdict(dict)))
+        spilled = None if self._spill is None else self._spill.convert_to_prefetched(ids)
+
+        def _values():
+            for key, users in data.items():
+                for user, primaries in users.items():
+                    for item_primary, secondaries in primaries.items():
+                        for item_secondary, (permanent, time, answer, value) in secondaries.items():
+                            yield (key, user, item_primary, item_secondary, permanent, time, answer, value)
+            if spilled is not None:
+                for values in spilled.variables():
+                    yield values
+                spilled.close()
+        return _values()
+
+    def _save_arrays(self):
+        arrays = InMemoryEnvironment._save_arrays(self)
+        arrays.update(encode_rows(list(self._iter_prefetched()), self.PREFETCHED_COLUMNS, 'prefetched_'))
+        arrays['to_delete'] = numpy.array(self._to_delete, dtype=numpy.int64)
+        return arrays
+
+    def _load_arrays(self, arrays):
+        InMemoryEnvironment._load_arrays(self, arrays)
+        for key, user, item_primary, item_secondary, time, value, variable_id in decode_rows(arrays, self.PREFETCHED_COLUMNS, 'prefetched_'):
+            self._touch(user)
+            self._prefetched[user][key, item_primary, item_secondary] = (time, value, variable_id)
+            self._resize(user, 1)
+            self._check_memory()
+        self._to_delete += arrays['to_delete'].tolist()
+        self._deleted.update(self._to_delete)
+
+    def _iter_prefetched(self):
+        for user, user_prefetched in self._prefetched.items():
+            for (key, item_primary, item_secondary), (time, value, variable_id) in user_prefetched.items():
+                yield (key, user, item_primary, item_secondary, time, value, variable_id)
+        if self._spill is not None:
+            for prefetched in self._spill.prefetched():
+                yield prefetched
+
     def _get_prefetched(self, key, user, item, item_secondary, symmetric):
-        return self._prefetched.get(self._prefetched_key(key, user, item, item_secondary, symmetric))
+        user_prefetched = self._prefetched.get(user)
+        if user_prefetched is None:
+            return None
+        return user_prefetched.get(self._prefetched_key(key, item, item_secondary, symmetric))
 
-    def _prefetched_key(self, key, user, item, item_secondary, symmetric):
+    def _prefetched_key(self, key, item, item_secondary, symmetric):
         items = [item_secondary, item]
         if symmetric and item is not None and item_secondary is not None:
             items.sort()
-        return (key, user, items[1], items[0])
+        return (key, items[1], items[0])
+
+    def _touch(self, user):
+        """
+        Mark the user as the most recently used one and load the variables
+        of the user if they have been spilled.
+        """
+        if self._max_variables is None or user is None:
+            return
+        if user in self._user_sizes:
+            self._user_sizes.move_to_end(user)
+        elif self._spill is not None and user in self._spill.users:
+            self._load_user(user)
+        else:
+            self._user_sizes[user] = 0
+
+    def _resize(self, user, difference):
+        if self._max_variables is None or user is None:
+            return
+        self._user_sizes[user] += difference
+        self._size += difference
+
+    def disable_spilling(self):
+        """
+        Load the spilled variables back to the memory and keep all variables
+        in the memory from now on.
+        """
+        self._max_variables = None
+        if self._spill is not None:
+            for user in list(self._spill.users):
+                self._load_user(user)
+            self._spill = None
+        self._user_sizes = OrderedDict()
+        self._size = 0
+
+    def _check_memory(self):
+        if self._max_variables is None or self._size <= self._max_variables:
+            return
+        if self._spill is None:
+            self._spill = _SpillStore()
+        # the most recently used user stays in the memory
+        while self._size > self.SPILL_RATIO * self._max_variables and len(self._user_sizes) > 1:
+            user, size = self._user_sizes.popitem(last=False)
+            self._spill_user(user)
+            self._size -= size
+
+    def _spill_user(self, user):
+        variables = []
+        for key, users in self._data.items():
+            primaries = users.pop(user, None)
+            if primaries is None:
+                continue
+            for item_primary, secondaries in primaries.items():
+                for item_secondary, (permanent, time, answer, value) in secondaries.items():
+                    variables.append((key, item_primary, item_secondary, permanent, time, answer, value))
+        prefetched = [k + v for k, v in self._prefetched.pop(user, {}).items()]
+        if len(variables) > 0 or len(prefetched) > 0:
+            self._spill.save(user, variables, prefetched)
+
+    def _load_user(self, user):
+        variables, prefetched = self._spill.load(user)
+        for key, item_primary, item_secondary, permanent, time, answer, value in variables:
+            self._data[key][user][item_primary][item_secondary] = (permanent, time, answer, value)
+        user_prefetched = self._prefetched[user]
+        for key, item_primary, item_secondary, time, value, variable_id in prefetched:
+            user_prefetched[key, item_primary, item_secondary] = (time, value, variable_id)
+        self._user_sizes[user] = len(variables) + len(prefetched)
+        self._size += len(variables) + len(prefetched)
+        self._check_memory()
+
+
+class Flush:
+
+    """
+    Flush of variables running in a background thread (with its own
+    database connection) or finished immediately.
+    """
+
+    def __init__(self, function, background=True):
+        self._error = None
+        self._thread = None
+        if background:
+            self._thread = threading.Thread(target=self._run, args=(function,))
+            self._thread.start()
+        else:
+            function()
+
+    def wait(self):
+        """
+        Wait until the flush is finished and raise its error if there is any.
+        """
+        if self._thread is not None:
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self, function):
+        try:
+            function()
+        except Exception as e:
+            LOGGER.exception('Flush of variables failed')
+            self._error = e
+        finally:
+            connection.close()
+
+
+class _CopyBuffer:
+
+    """
+    File-like object serializing the given rows for COPY on demand, so the
+    rows are never written to a file nor kept as text in the memory.
+    """
+
+    def __init__(self, rows):
+        self._lines = (','.join(map(str, row)) + '\n' for row in rows)
+        self._rest = ''
+
+    def read(self, size=-1):
+        chunks = [self._rest]
+        length = len(self._rest)
+        while size < 0 or length < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            chunks.append(line)
+            length += len(line)
+        data = ''.join(chunks)
+        if size < 0:
+            self._rest = ''
+            return data
+        self._rest = data[size:]
+        return data[:size]
+
+    def readline(self, size=-1):
+        if not self._rest:
+            self._rest = next(self._lines, '')
+        end = self._rest.find('\n') + 1 or len(self._rest)
+        line, self._rest = self._rest[:end], self._rest[end:]
+        return line
+
+
+class _SpillStore:
+
+    """
+    Variables of users spilled from the memory kept in a temporary SQLite
+    database, the database is removed when the connection is closed.
+    """
+
+    EPOCH = datetime(1970, 1, 1)
+    MICROSECOND = timedelta(microseconds=1)
+
+    def __init__(self, check_same_thread=True):
+        # an empty file name stands for a private temporary database on disk
+        self._connection = sqlite3.connect('', check_same_thread=check_same_thread)
+        self._connection.execute('''
+            CREATE TABLE variable (
+                user INTEGER, key TEXT, item_primary INTEGER, item_secondary INTEGER,
+                permanent INTEGER, time INTEGER, answer INTEGER, value REAL
+            )''')
+        self._connection.execute('''
+            CREATE TABLE prefetched (
+                user INTEGER, key TEXT, item_primary INTEGER, item_secondary INTEGER,
+                time INTEGER, value REAL, id INTEGER
+            )''')
+        self._connection.execute('CREATE INDEX variable_user ON variable (user)')
+        self._connection.execute('CREATE INDEX prefetched_user ON prefetched (user)')
+        self.users = set()
+
+    def __deepcopy__(self, memo):
+        """
+        The connection can't be copied, the copy gets its own temporary
+        database with the same content.
+        """
+        copied = _SpillStore()
+        for table, placeholders in [('variable', 8), ('prefetched', 7)]:
+            copied._connection.executemany(
+                'INSERT INTO ' + table + ' VALUES (' + ', '.join(['?'] * placeholders) + ')',
+                self._connection.execute('SELECT * FROM ' + table + ' ORDER BY rowid'))
+        copied.users = set(self.users)
+        memo[id(self)] = copied
+        return copied
+
+    def save(self, user, variables, prefetched):
+        self._connection.executemany(
+            'INSERT INTO variable VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [(user, k, i_p, i_s, p, self._encode_time(t), a, v) for (k, i_p, i_s, p, t, a, v) in variables])
+        self._connection.executemany(
+            'INSERT INTO prefetched VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(user, k, i_p, i_s, self._encode_time(t), v, i) for (k, i_p, i_s, t, v, i) in prefetched])
+        self.users.add(user)
+
+    def load(self, user):
+        """
+        Remove variables of the given user from the store and return them.
+        """
+        variables = [
+            (k, i_p, i_s, bool(p), self._decode_time(t), a, v)
+            for (k, i_p, i_s, p, t, a, v) in self._connection.execute(
+                'SELECT key, item_primary, item_secondary, permanent, time, answer, value FROM variable WHERE user = ?', [user])
+        ]
+        prefetched = [
+            (k, i_p, i_s, self._decode_time(t), v, i)
+            for (k, i_p, i_s, t, v, i) in self._connection.execute(
+                'SELECT key, item_primary, item_secondary, time, value, id FROM prefetched WHERE user = ?', [user])
+        ]
+        self._connection.execute('DELETE FROM variable WHERE user = ?', [user])
+        self._connection.execute('DELETE FROM prefetched WHERE user = ?', [user])
+        self.users.discard(user)
+        return variables, prefetched
+
+    def variables(self):
+        """
+        Returns:
+            iterator: tuples (key, user, item primary, item secondary,
+            permanent, time, answer, value)
+        """
+        for (u, k, i_p, i_s, p, t, a, v) in self._connection.execute('SELECT * FROM variable ORDER BY rowid'):
+            yield (k, u, i_p, i_s, bool(p), self._decode_time(t), a, v)
+
+    def count_variables(self):
+        return self._connection.execute('SELECT COUNT(*) FROM variable').fetchone()[0]
+
+    def convert_to_prefetched(self, ids):
+        """
+        Turn all variables to prefetched variables with the given ids, the
+        ids are assigned in the order given by :meth:`variables`.
+
+        Returns:
+            _SpillStore: store with the converted variables, it can be used
+            (and has to be closed) by another thread
+        """
+        converted = _SpillStore(check_same_thread=False)
+        converted._connection.executemany(
+            'INSERT INTO variable VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            self._connection.execute('SELECT * FROM variable ORDER BY rowid'))
+        rows = self._connection.execute('SELECT user, key, item_primary, item_secondary, time, value FROM variable ORDER BY rowid')
+        self._connection.executemany(
+            'INSERT INTO prefetched VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (row + (variable_id,) for row, variable_id in zip(rows, ids)))
+        self._connection.execute('DELETE FROM variable')
+        return converted
+
+    def close(self):
+        self._connection.close()
+
+    def prefetched(self):
+        """
+        Returns:
+            iterator: tuples (key, user, item primary, item secondary, time,
+            value, id)
+        """
+        for (u, k, i_p, i_s, t, v, i) in self._connection.execute('SELECT * FROM prefetched'):
+            yield (k, u, i_p, i_s, self._decode_time(t), v, i)
+
+    def _encode_time(self, time):
+        return None if time is None else (time - self.EPOCH) // self.MICROSECOND
+
+    def _decode_time(self, time):
+        return None if time is None else self.EPOCH + time * self.MICROSECOND
 
 
 class DatabaseEnvironment(CommonEnvironment):
 
+    CONFUSING_FACTOR_CACHE_PREFIX = 'database_environment__confusing_factor'
+
+    # columns of the unique index used to upsert postponed writes, NULLs are
+    # replaced to make them comparable
+    UPSERT_INDEX = 'info_id, key, COALESCE(user_id, 0), COALESCE(item_primary_id, 0), COALESCE(item_secondary_id, 0)'
+
     def __init__(self, info_id=None):
         CommonEnvironment.__init__(self)
         self._before_answer = None
         self._info_id = info_id
+        # (key, user, item_primary, item_secondary) -> (value, time, answer)
+        self._pending = None
+
+    def postpone_writes(self):
+        """
+        Collect writes of variables which are not permanent and write them at
+        once by :meth:`flush`. The postponed values are visible to reads from
+        this environment.
+        """
+        if self._info_id is None:
+            raise Exception('Writes can be postponed only in environment with info.')
+        if self._pending is None:
+            self._pending = {}
+
+    def flush(self):
+        if not self._pending:
+            return
+        rows = [
+            (key, user, item_primary, item_secondary, value, time, answer, False, self._info_id)
+            for (key, user, item_primary, item_secondary), (value, time, answer)
+            # consistent order of rows prevents deadlocks of concurrent flushes
+            in sorted(self._pending.items(), key=lambda identity_value: [(x is None, x) for x in identity_value[0]])
+        ]
+        self._pending = {}
+        columns = '(key, user_id, item_primary_id, item_secondary_id, value, updated, answer_id, permanent, info_id)'
+        with closing(connection.cursor()) as cursor:
+            if is_on_postgresql():
+                cursor.execute(
+                    'INSERT INTO proso_models_variable ' + columns + ' VALUES ' +
+                    ', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s, %s)' for row in rows]) +
+                    '''
+                    ON CONFLICT (''' + self.UPSERT_INDEX + ''')
+                    DO UPDATE SET value = EXCLUDED.value, updated = EXCLUDED.updated, answer_id = EXCLUDED.answer_id
+                    WHERE proso_models_variable.value <> EXCLUDED.value
+                    ''', [x for row in rows for x in row])
+                return
+            identity = 'info_id = %s AND key = %s AND user_id IS %s AND item_primary_id IS %s AND item_secondary_id IS %s'
+            cursor.executemany(
+                'UPDATE proso_models_variable SET value = %s, updated = %s, answer_id = %s WHERE value <> %s AND ' + identity,
+                [(v, t, a, v, info, k, u, i_p, i_s) for (k, u, i_p, i_s, v, t, a, p, info) in rows])
+            cursor.executemany(
+                'INSERT INTO proso_models_variable ' + columns +
+                ' SELECT %s, %s, %s, %s, %s, %s, %s, %s, %s WHERE NOT EXISTS (SELECT 1 FROM proso_models_variable WHERE ' + identity + ')',
+                [row + (row[8], row[0], row[1], row[2], row[3]) for row in rows])
+
+    def _get_pending(self, key, user, item, item_secondary, symmetric):
+        if not self._pending or not isinstance(key, str):
+            return None
+        items = [item_secondary, item]
+        if symmetric and item is not None and item_secondary is not None:
+            items = self._sorted(items)
+        return self._pending.get((key, user, items[1], items[0]))
+
+    def _flush_pending(self, keys):
+        """
+        Write the postponed values of the given keys before they are read by
+        a query.
+        """
+        if not self._pending:
+            return
+        keys = {keys} if isinstance(keys, str) else set(keys)
+        if any(key in keys for (key, _, _, _) in self._pending):
+            self.flush()
 
     def process_answer(self, user, item, asked, answered, time, answer_id, response_time, guess, **kwargs):
         answer = Answer(
@@ -155,6 +744,7 @@ class DatabaseEnvironment(CommonEnvironment):
         answer.save()
 
     def get_items_with_values(self, key, item, user=None):
+        self._flush_pending(key)
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where_single(
                 key, user, item, None, force_null=False, symmetric=False)
@@ -171,6 +761,7 @@ class DatabaseEnvironment(CommonEnvironment):
 
     @timeit()
     def get_items_with_values_more_items(self, key, items, user=None):
+        self._flush_pending(key)
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where_more_items(
                 key, items, user, None, force_null=['user_id'], symmetric=False)
@@ -190,23 +781,39 @@ class DatabaseEnvironment(CommonEnvironment):
             return result
 
     def read(self, key, user=None, item=None, item_secondary=None, default=None, symmetric=True):
+        pending = self._get_pending(key, user, item, item_secondary, symmetric)
+        if pending is not None:
+            return pending[0]
+        value = self._memoized(
+            self._variables_memo(key), ('read', user, item, item_secondary, symmetric),
+            lambda: self._read(key, user, item, item_secondary, symmetric))
+        return default if value is None else value
+
+    def _read(self, key, user, item, item_secondary, symmetric):
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where_single(key, user, item, item_secondary, symmetric=symmetric)
             cursor.execute(
                 'SELECT value FROM proso_models_variable WHERE ' + where,
                 where_params)
             fetched = cursor.fetchone()
-            return default if fetched is None else fetched[0]
+            return None if fetched is None else fetched[0]
 
     @timeit()
     def read_more_items(self, key, items, user=None, item=None, default=None, symmetric=True):
+        self._flush_pending(key)
+        found = self._memoized_more_items(
+            self._variables_memo(key), ('read_more_items', user, item, symmetric), items,
+            lambda to_find: self._read_more_items(key, to_find, user, item, symmetric))
+        return {i: default if value is None else value for i, value in found.items()}
+
+    def _read_more_items(self, key, items, user, item, symmetric):
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where_more_items(key, items, user, item, symmetric=symmetric)
             cursor.execute(
                 'SELECT item_primary_id, item_secondary_id, value FROM proso_models_variable WHERE '
                 + where,
                 where_params)
-            result = {i: default for i in items}
+            result = {i: None for i in items}
             if item is None:
                 result.update({x_y_z[0]: x_y_z[2] for x_y_z in cursor})
             else:
@@ -215,6 +822,7 @@ class DatabaseEnvironment(CommonEnvironment):
 
     @timeit()
     def read_more_keys(self, keys, user=None, item=None, item_secondary=None, default=None, symmetric=True):
+        self._flush_pending(keys)
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where_single(keys, user, item, item_secondary, symmetric=symmetric)
             cursor.execute(
@@ -226,8 +834,39 @@ class DatabaseEnvironment(CommonEnvironment):
                 result[k] = v
             return result
 
+    @timeit()
+    def read_more_keys_more_items(self, queries):
+        results = [{i: default for i in items} for key, items, user, default in queries]
+        # (key, user) -> [(items, result)]
+        found_by = defaultdict(list)
+        conditions = []
+        params = []
+        for (key, items, user, default), result in zip(queries, results):
+            if len(items) == 0:
+                continue
+            found_by[key, user].append((set(items), result))
+            # the list with None only would match all items
+            where, where_params = self._where_more_items(
+                key, items if any(i is not None for i in items) else None, user)
+            conditions.append('(' + where + ')')
+            params += where_params
+        if len(conditions) == 0:
+            return results
+        self._flush_pending([key for key, _, _, _ in queries])
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(
+                'SELECT key, user_id, item_primary_id, value FROM proso_models_variable WHERE '
+                + ' OR '.join(conditions),
+                params)
+            for key, user, item, value in cursor:
+                for items, result in found_by[key, user]:
+                    if item in items:
+                        result[item] = value
+        return results
+
     @timeit()
     def read_all_with_key(self, key):
+        self._flush_pending(key)
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where({'key': key})
             cursor.execute(
@@ -237,6 +876,9 @@ class DatabaseEnvironment(CommonEnvironment):
             return cursor.fetchall()
 
     def time(self, key, user=None, item=None, item_secondary=None, symmetric=True):
+        pending = self._get_pending(key, user, item, item_secondary, symmetric)
+        if pending is not None:
+            return pending[1]
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where_single(key, user, item, item_secondary, symmetric=symmetric)
             cursor.execute(
@@ -247,6 +889,7 @@ class DatabaseEnvironment(CommonEnvironment):
 
     @timeit()
     def time_more_items(self, key, items, user=None, item=None, symmetric=True):
+        self._flush_pending(key)
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where_more_items(key, items, user, item, symmetric=symmetric)
             cursor.execute(
@@ -274,6 +917,20 @@ class DatabaseEnvironment(CommonEnvironment):
             'item_secondary_id': items[0],
             'key': key,
         }
+        self._forget_variables(key)
+        if self._pending is not None and not permanent:
+            identity = (key, user, items[1], items[0])
+            pending = self._pending.get(identity)
+            if pending is not None and pending[0] == value:
+                return
+            previous_value = None
+            if self.has_write_hooks():
+                previous_value = self.read(key, user=user, item=items[1], item_secondary=items[0], symmetric=False)
+                if previous_value == value:
+                    return
+            self._pending[identity] = (value, datetime.now() if time is None else time, answer)
+            self.call_write_hooks(key, value, user, item, item_secondary, time, previous_value, answer)
+            return
         if not permanent:
             data['info_id'] = self._info_id
         # HACK: There is a race condition creating more variables, so it is
@@ -317,6 +974,7 @@ class DatabaseEnvironment(CommonEnvironment):
             'item_secondary_id': items[0],
             'key': key
         }
+        self._forget_variables(key)
         try:
             variable = Variable.objects.get(**data)
             if not variable.permanent:
@@ -328,20 +986,22 @@ class DatabaseEnvironment(CommonEnvironment):
     def number_of_answers(self, user=None, item=None, context=None):
         if item is not None and context is not None:
             raise Exception('Either item or context has to be unspecified')
-        with closing(connection.cursor()) as cursor:
-            where, where_params = self._where({'user_id': user, 'item_id': item, 'context_id': context}, False, for_answers=True)
-            cursor.execute(
-                'SELECT COUNT(id) FROM proso_models_answer WHERE '
-                + where, where_params)
-            return cursor.fetchone()[0]
+        return self._memoized(
+            self._answers_memo(), ('number_of_answers', user, item, context, self._before_answer),
+            lambda: self._number_of_answers(user, item, context, ''))
 
     def number_of_correct_answers(self, user=None, item=None, context=None):
         if item is not None and context is not None:
             raise Exception('Either item or context has to be unspecified')
+        return self._memoized(
+            self._answers_memo(), ('number_of_correct_answers', user, item, context, self._before_answer),
+            lambda: self._number_of_answers(user, item, context, 'item_asked_id = item_answered_id AND '))
+
+    def _number_of_answers(self, user, item, context, condition):
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where({'user_id': user, 'item_id': item, 'context_id': context}, False, for_answers=True)
             cursor.execute(
-                'SELECT COUNT(id) FROM proso_models_answer WHERE item_asked_id = item_answered_id AND '
+                'SELECT COUNT(id) FROM proso_models_answer WHERE ' + condition
                 + where, where_params)
             return cursor.fetchone()[0]
 
@@ -370,6 +1030,14 @@ class DatabaseEnvironment(CommonEnvironment):
 
     @timeit()
     def number_of_answers_more_items(self, items, user=None):
+        return self._memoized_more_items(
+            self._answers_memo(), ('number_of_answers_more_items', user, self._before_answer), items,
+            lambda to_find: self._number_of_answers_more_items(to_find, user))
+
+    def _number_of_answers_more_items(self, items, user):
+        aggregated = self._aggregated_more_items(items, user, 'SUM(number_of_answers)', 0)
+        if aggregated is not None:
+            return aggregated
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where({'user_id': user, 'item_id': items}, False, for_answers=True)
             cursor.execute(
@@ -383,6 +1051,14 @@ class DatabaseEnvironment(CommonEnvironment):
 
     @timeit()
     def number_of_correct_answers_more_items(self, items, user=None):
+        return self._memoized_more_items(
+            self._answers_memo(), ('number_of_correct_answers_more_items', user, self._before_answer), items,
+            lambda to_find: self._number_of_correct_answers_more_items(to_find, user))
+
+    def _number_of_correct_answers_more_items(self, items, user):
+        aggregated = self._aggregated_more_items(items, user, 'SUM(number_of_correct_answers)', 0)
+        if aggregated is not None:
+            return aggregated
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where({'user_id': user, 'item_id': items}, False, for_answers=True)
             cursor.execute(
@@ -396,6 +1072,9 @@ class DatabaseEnvironment(CommonEnvironment):
 
     @timeit()
     def number_of_first_answers_more_items(self, items, user=None):
+        aggregated = self._aggregated_more_items(items, user, 'COUNT(1)', 0)
+        if aggregated is not None:
+            return aggregated
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where({'user_id': user, 'item_id': items}, False, for_answers=True)
             cursor.execute(
@@ -409,37 +1088,40 @@ class DatabaseEnvironment(CommonEnvironment):
 
     @timeit()
     def has_answer_more_items(self, items, user=None):
-        cached_all = {}
-        answer_cache = cache.get('database_environment__has_answer', {})
-        for item in items:
-            cache_key = '{}_{}'.format(item, user)
-            found = answer_cache.get(cache_key)
-            if found:
-                cached_all[item] = True
-        to_find = [i for i in items if i not in set(cached_all.keys())]
+        answer_cache = HasAnswerCache(
+            cache, prefix='database_environment__has_answer',
+            expiration=get_config('proso_models', 'having_answers.cache_expiration', default=30 * 24 * 60 * 60))
+        cached_all = answer_cache.answered(items, user=user)
+        to_find = [i for i in items if i not in cached_all]
         if len(cached_all) != 0:
             LOGGER.debug('cache hit for having answers, items {} and user {}'.format(len(cached_all), user))
         if len(to_find) != 0:
             LOGGER.debug('cache miss for having answers, items {} and user {}'.format(len(to_find), user))
-            with closing(connection.cursor()) as cursor:
-                where, where_params = self._where({'user_id': user, 'item_id': to_find}, False, for_answers=True)
-                cursor.execute(
-                    'SELECT item_id, 1 FROM proso_models_answer WHERE '
-                    + where + ' GROUP BY item_id',
-                    where_params)
-                for i, _ in cursor:
-                    cached_all[i] = True
-                cache_expiration = get_config('proso_models', 'having_answers.cache_expiration', default=30 * 24 * 60 * 60)
-                # trying to decrease probability of race condition
-                answer_cache = cache.get('database_environment__has_answer', {})
-                for item in cached_all.keys():
-                    cache_key = '{}_{}'.format(item, user)
-                    answer_cache[cache_key] = True
-                cache.set('database_environment__has_answer', answer_cache, cache_expiration)
-        return {i: cached_all.get(i, False) for i in items}
+            aggregated = self._aggregated_more_items(to_find, user, 'COUNT(1)', 0)
+            if aggregated is None:
+                with closing(connection.cursor()) as cursor:
+                    where, where_params = self._where({'user_id': user, 'item_id': to_find}, False, for_answers=True)
+                    cursor.execute(
+                        'SELECT item_id, 1 FROM proso_models_answer WHERE '
+                        + where + ' GROUP BY item_id',
+                        where_params)
+                    found = {i for i, _ in cursor}
+            else:
+                found = {i for i, count in aggregated.items() if count > 0}
+            answer_cache.add(found, user=user)
+            cached_all |= found
+        return {i: i in cached_all for i in items}
 
     @timeit()
     def last_answer_time_more_items(self, items, user=None):
+        return self._memoized_more_items(
+            self._answers_memo(), ('last_answer_time_more_items', user, self._before_answer), items,
+            lambda to_find: self._last_answer_time_more_items(to_find, user))
+
+    def _last_answer_time_more_items(self, items, user):
+        aggregated = self._aggregated_more_items(items, user, 'MAX(last_answer_time)', None)
+        if aggregated is not None:
+            return {i: self._ensure_is_datetime(t) for i, t in aggregated.items()}
         with closing(connection.cursor()) as cursor:
             where, where_params = self._where({'user_id': user, 'item_id': items}, False, for_answers=True)
             cursor.execute(
@@ -477,55 +1159,219 @@ class DatabaseEnvironment(CommonEnvironment):
     def confusing_factor(self, item, item_secondary, user=None):
         return self.confusing_factor_more_items(item, [item_secondary], user=user)[0]
 
-    @timeit()
     def confusing_factor_more_items(self, item, items, user=None):
-        cached_all = {}
-        confusing_factor_cache = cache.get('database_environment__confusing_factor', {})
-        for item_secondary in items:
-            _items = self._sorted([item, item_secondary])
-            cache_key = '{}_{}_{}'.format(_items[0], _items[1], user)
-            cached_item = confusing_factor_cache.get(cache_key)
-            if cached_item:
-                cached_all[item_secondary] = int(cached_item)
-        to_find = [i for i in items if i not in list(cached_all.keys())]
-        if len(cached_all) != 0:
-            LOGGER.debug('cache hit for confusing factor, item {}, {} other items and user {}'.format(item, len(cached_all), user))
+        return self.confusing_factor_more_pairs({item: items}, user=user)[item]
+
+    @timeit()
+    def confusing_factor_more_pairs(self, items_with_options, user=None):
+        """
+        The confusing factor of a pair (item, secondary item) is the number
+        of open answers to the item answered by the secondary item. It is not
+        symmetric, the factors of (a, b) and (b, a) are counted from
+        different answers and cached in the shards of a and b respectively
+        (the cache keyed by sorted pairs used before made the result depend
+        on which of them was computed first).
+        """
+        confusing_factor_cache = self._confusing_factor_cache()
+        shards = confusing_factor_cache.get_many(list(items_with_options.keys()), user=user)
+        to_find = {}
+        for item, items in items_with_options.items():
+            item_to_find = [i for i in items if not ItemShardCache.contains(shards.get(item), i)]
+            if len(item_to_find) != 0:
+                to_find[item] = item_to_find
+        cache_hits = sum(len(items) for items in items_with_options.values()) - sum(len(items) for items in to_find.values())
+        if cache_hits != 0:
+            LOGGER.debug('cache hit for confusing factor, {} items, {} pairs and user {}'.format(len(items_with_options), cache_hits, user))
         if len(to_find) != 0:
-            LOGGER.debug('cache miss for confusing factor, item {}, {} other items and user {}'.format(item, len(to_find), user))
-            where, where_params = self._where({
-                'item_answered_id': to_find,
-                'item_asked_id': to_find,
-            }, force_null=False, for_answers=True, conjuction=False)
-            user_where, user_params = self._column_comparison('user_id', user, force_null=False)
-            with closing(connection.cursor()) as cursor:
-                cursor.execute(
-                    '''
-                    SELECT
-                        item_asked_id,
-                        item_answered_id,
-                        COUNT(id) AS confusing_factor
-                    FROM
-                        proso_models_answer
-                    WHERE guess = 0 AND (item_asked_id = %s OR item_asked_id = %s) AND
-                    ''' + user_where + ' AND (' + where + ') GROUP BY item_asked_id, item_answered_id', [item, item] + user_params + where_params)
-                found = {}
-                for item_asked, item_answered, count in cursor:
-                    if item_asked == item:
-                        found[item_answered] = found.get(item_answered, 0) + count
-                    else:
-                        found[item_asked] = found.get(item_asked, 0) + count
-                for i in to_find:
-                    found[i] = found.get(i, 0)
-                cache_expiration = get_config('proso_models', 'confusing_factor.cache_expiration', default=24 * 60 * 60)
-                # trying to decrease probability of race condition
-                confusing_factor_cache = cache.get('database_environment__confusing_factor', {})
-                for item_secondary, count in found.items():
-                    _items = self._sorted([item, item_secondary])
-                    cache_key = '{}_{}_{}'.format(_items[0], _items[1], user)
-                    confusing_factor_cache[cache_key] = count
-                    cached_all[item_secondary] = count
-                cache.set('database_environment__confusing_factor', confusing_factor_cache, cache_expiration)
-        return [cached_all[i] for i in items]
+            LOGGER.debug('cache miss for confusing factor, {} items, {} pairs and user {}'.format(len(to_find), sum(len(items) for items in to_find.values()), user))
+            versions = confusing_factor_cache.versions(list(to_find.keys()), user=user)
+            shards.update(confusing_factor_cache.add(self._find_confusing_factors(to_find, user), versions, user=user))
+        return {item: [self._confusing_factor_from_shard(shards[item], i) for i in items] for item, items in items_with_options.items()}
+
+    def update_confusing_factors(self, answer):
+        """
+        Update the cached confusing factors by the given (just saved) answer.
+        The cached shards of the asked item are updated in place instead of
+        being invalidated, the shards which are not cached are left to be
+        computed when they are needed. A shard updated concurrently by
+        another answer is invalidated (see
+        :class:`proso.models.answer_cache.ItemShardCache`).
+        """
+        if answer.guess != 0 or answer.item_answered_id is None:
+            return
+
+        def _increment(item, user, shard):
+            if not ItemShardCache.contains(shard, answer.item_answered_id):
+                return None
+            shard['entries'][answer.item_answered_id] = shard['entries'].get(answer.item_answered_id, 0) + 1
+            return shard
+        self._confusing_factor_cache().update([(answer.item_asked_id, None), (answer.item_asked_id, answer.user_id)], _increment)
+
+    def warm_up_confusing_factors(self, user=None):
+        """
+        Compute the confusing factors of all pairs of items for the given user
+        (all users by default) by one query and put them to the cache.
+
+        Returns:
+            int: number of cached shards
+        """
+        confusing_factor_cache = self._confusing_factor_cache()
+        versions = confusing_factor_cache.versions(self._asked_items(user), user=user)
+        user_where, user_params = self._column_comparison('user_id', user, force_null=False)
+        shards = defaultdict(lambda: ItemShardCache.shard({}, complete=True))
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(
+                '''
+                SELECT
+                    item_asked_id,
+                    item_answered_id,
+                    COUNT(id) AS confusing_factor
+                FROM
+                    proso_models_answer
+                WHERE guess = 0 AND item_answered_id IS NOT NULL AND
+                ''' + user_where + ' GROUP BY item_asked_id, item_answered_id', user_params)
+            for item_asked, item_answered, count in cursor:
+                if item_asked in versions:
+                    shards[item_asked]['entries'][item_answered] = count
+        confusing_factor_cache.set_many(dict(shards), versions, user=user)
+        return len(shards)
+
+    def _asked_items(self, user):
+        """
+        Get the items asked by the given user (all users by default). The
+        versions of the confusing factor shards of these items are read
+        before the shards are computed by a warm-up, the items asked for the
+        first time during the warm-up are left to be computed when they are
+        needed.
+        """
+        user_where, user_params = self._column_comparison('user_id', user, force_null=False)
+        with closing(connection.cursor()) as cursor:
+            cursor.execute('SELECT DISTINCT item_asked_id FROM proso_models_answer WHERE ' + user_where, user_params)
+            return [item for (item,) in cursor]
+
+    def _confusing_factor_cache(self):
+        return ItemShardCache(
+            cache, self.CONFUSING_FACTOR_CACHE_PREFIX,
+            expiration=get_config('proso_models', 'confusing_factor.cache_expiration', default=24 * 60 * 60))
+
+    def _find_confusing_factors(self, to_find, user):
+        """
+        Compute the confusing factors of the given pairs.
+
+        Args:
+            to_find (dict): item -> secondary items
+            user (int): user, all users by default
+
+        Returns:
+            dict: item -> shard for :class:`proso.models.answer_cache.ItemShardCache`
+        """
+        where, where_params = self._where({
+            'item_asked_id': list(to_find.keys()),
+            'item_answered_id': list({i for items in to_find.values() for i in items}),
+        }, force_null=False, for_answers=True)
+        user_where, user_params = self._column_comparison('user_id', user, force_null=False)
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(
+                '''
+                SELECT
+                    item_asked_id,
+                    item_answered_id,
+                    COUNT(id) AS confusing_factor
+                FROM
+                    proso_models_answer
+                WHERE guess = 0 AND
+                ''' + user_where + ' AND (' + where + ') GROUP BY item_asked_id, item_answered_id', user_params + where_params)
+            found = {(item_asked, item_answered): count for item_asked, item_answered, count in cursor}
+        return {
+            item: ItemShardCache.shard({i: found.get((item, i), 0) for i in items})
+            for item, items in to_find.items()
+        }
+
+    def _confusing_factor_from_shard(self, shard, item_secondary):
+        return shard['entries'].get(item_secondary, 0)
+
+    def _aggregated_more_items(self, items, user, aggregation, default):
+        """
+        Compute the answer statistics from the answer aggregates (see
+        :class:`proso_models.models.AnswerAggregate`).
+
+        Args:
+            items (list): items to compute the statistics for
+            user (int): user whose answers are aggregated, all users by default
+            aggregation (str): SQL expression aggregating the aggregates of
+                one item
+            default: value for items without answers
+
+        Returns:
+            dict: item -> value, or None if the aggregates are disabled or
+            they contain the answers after the answer given to
+            :meth:`shift_answers`
+        """
+        if not get_config('proso_models', 'answer_aggregates.enabled', default=False):
+            return None
+        user_where, user_params = self._column_comparison('user_id', user, force_null=False)
+        items_where, items_params = self._column_comparison('item_id', items, force_null=False)
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(
+                'SELECT item_id, ' + aggregation + ', MAX(last_answer_id) FROM proso_models_answeraggregate WHERE '
+                + user_where + ' AND ' + items_where + ' GROUP BY item_id',
+                user_params + items_params)
+            rows = cursor.fetchall()
+        if self._before_answer is not None and any(last_answer_id >= self._before_answer for _, _, last_answer_id in rows):
+            return None
+        result = {i: default for i in items}
+        result.update({i: value for i, value, _ in rows})
+        return result
+
+    def _variables_memo(self, key):
+        memo = get_request_memo()
+        return None if memo is None else memo['variables'][self._info_id, key]
+
+    def _answers_memo(self):
+        memo = get_request_memo()
+        return None if memo is None else memo['answers']
+
+    def _forget_variables(self, key):
+        memo = get_request_memo()
+        if memo is not None:
+            memo['variables'].pop((self._info_id, key), None)
+
+    def _memoized(self, memo, memo_key, compute):
+        if memo is None:
+            return compute()
+        value = memo.get(memo_key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            memo[memo_key] = value
+        return value
+
+    def _memoized_more_items(self, memo, memo_key, items, compute):
+        """
+        Compute values for the items which are not in the memo yet.
+
+        Args:
+            memo (dict): memo of the current request, or None
+            memo_key (tuple): arguments identifying the computed values
+            items (list): items to find values for
+            compute (function): function taking a list of items and returning
+                a dictionary item -> value
+        """
+        if memo is None:
+            return compute(items)
+        found = {}
+        to_find = []
+        for i in items:
+            value = memo.get(memo_key + (i,), _MISSING)
+            if value is _MISSING:
+                to_find.append(i)
+            else:
+                found[i] = value
+        if len(to_find) > 0:
+            computed = compute(to_find)
+            for i, value in computed.items():
+                memo[memo_key + (i,)] = value
+            found.update(computed)
+        return {i: found[i] for i in items}
 
     def export_values():
         pass
@@ -567,56 +1413,67 @@ class DatabaseEnvironment(CommonEnvironment):
         }, force_null=force_null, for_answers=for_answers)
 
     def _where(self, condition, force_null=True, top_most=True, for_answers=False, conjuction=True):
+        """
+        Translate the condition to SQL. The SQL depends only on the shape of
+        the condition (columns, kinds of the compared values, flags), so it is
+        compiled once per shape and lists of values are bound as one
+        parameter, see :meth:`_column_comparison`.
+
+        Returns:
+            tuple: SQL and its parameters
+        """
+        shape, params = self._condition_shape(condition, force_null)
+        with_info = top_most and not for_answers and self._info_id is not None
+        if with_info:
+            params = params + [self._info_id]
+        before_answer = top_most and bool(self._before_answer) and for_answers
+        if before_answer:
+            params = params + [self._before_answer]
+        return _compile_where(shape, conjuction, with_info, before_answer), params
+
+    def _column_comparison(self, column, value, force_null=True):
+        shape, params = self._column_shape(column, value, force_null)
+        return _compile_column(shape), params
+
+    def _condition_shape(self, condition, force_null):
         if isinstance(condition, tuple):
-            result_cond, result_params = self._column_comparison(
-                condition[0], condition[1], force_null=force_null)
+            return self._column_shape(condition[0], condition[1], force_null)
         elif isinstance(condition, dict):
-            conds, params = list(zip(*[self._where(x, force_null, top_most=False, for_answers=for_answers) for x in list(condition.items())]))
-            params = [p for ps in params for p in ps]
-            operator = ' AND ' if conjuction else ' OR '
-            if any([isinstance(x, dict) for x in condition]):
-                operator = ' OR '
-            result_cond, result_params = operator.join(conds), params
+            shapes, params = [], []
+            for column, value in condition.items():
+                if isinstance(value, dict):
+                    shape, value_params = self._condition_shape(value, force_null)
+                else:
+                    shape, value_params = self._column_shape(column, value, force_null)
+                shapes.append(shape)
+                params += value_params
+            return ('condition', tuple(shapes), any(isinstance(v, dict) for v in condition.values())), params
         else:
             raise Exception("Unsupported type of condition:" + str(type(condition)))
-        if top_most and not for_answers and self._info_id is not None:
-            result_cond = ('(%s) AND (info_id = ? OR info_id IS NULL)' % result_cond)
-            result_params = result_params + [self._info_id]
-        if top_most and self._before_answer and for_answers:
-            result_cond = ('(%s) AND id < ?' % result_cond)
-            result_params = result_params + [self._before_answer]
-        result_cond = result_cond.replace('?', '%s')
-        return result_cond, result_params
 
-    def _column_comparison(self, column, value, force_null=True):
+    def _column_shape(self, column, value, force_null):
         if isinstance(value, list):
             value = list(set(value))
             contains_null = any([x is None for x in value])
             if contains_null:
                 value = [x for x in value if x is not None]
-            null_contains_return = (column + ' IS NULL OR ') if contains_null else ''
-            if len(value) > 0:
-                sorted_values = self._sorted(value)
-                if is_on_postgresql():
-                    return '({} {} = ANY(VALUES {}))'.format(
-                        null_contains_return,
-                        column,
-                        ','.join(['(%s)' for i in value])
-                    ), sorted_values
-                else:
-                    return '({} {} IN ({}))'.format(
-                        null_contains_return,
-                        column,
-                        ','.join(['%s' for i in value])
-                    ), sorted_values
-            else:
-                return '(' + null_contains_return + DATABASE_TRUE + ')', []
+            if len(value) == 0:
+                return ('empty', column, contains_null), []
+            sorted_values = self._sorted(value)
+            if is_on_postgresql():
+                return ('array', column, contains_null), [sorted_values]
+            if connection.vendor == 'sqlite' and _is_json_each_supported():
+                return ('json', column, contains_null), [json.dumps(sorted_values, default=int)]
+            # the length is a part of the compiled shape, pad it to a power of
+            # two by repeating the last value to keep the number of shapes low
+            padded = 1 << (len(sorted_values) - 1).bit_length()
+            return ('in', column, contains_null, padded), sorted_values + sorted_values[-1:] * (padded - len(sorted_values))
         elif value is not None:
-            return column + ' = %s', [value]
+            return ('eq', column), [value]
         elif (isinstance(force_null, bool) and force_null) or (isinstance(force_null, list) and column in force_null):
-            return column + ' IS NULL', []
+            return ('null', column), []
         else:
-            return DATABASE_TRUE, []
+            return ('any', column), []
 
     def _ensure_is_datetime(self, value):
         if value is None:
@@ -632,3 +1489,92 @@ class DatabaseEnvironment(CommonEnvironment):
     def _sorted(self, xs):
         inter = sorted([x for x in xs if x is not None])
         return [None] * (len(xs) - len(inter)) + inter
+
+
+# compiled conditions are cached per shape, the number of shapes is small in
+# practice, but it is not bounded (e.g. lengths of lists of values)
+SQL_SHAPE_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=SQL_SHAPE_CACHE_SIZE)
+def _compile_where(shape, conjuction, with_info, before_answer):
+    result = _compile_condition(shape, conjuction)
+    if with_info:
+        result = '({}) AND (info_id = %s OR info_id IS NULL)'.format(result)
+    if before_answer:
+        result = '({}) AND id < %s'.format(result)
+    return result
+
+
+def _compile_condition(shape, conjuction=True):
+    if shape[0] != 'condition':
+        return _compile_column(shape)
+    _, shapes, nested = shape
+    operator = ' AND ' if conjuction and not nested else ' OR '
+    return operator.join(
+        '({})'.format(_compile_condition(s)) if s[0] == 'condition' else _compile_column(s)
+        for s in shapes)
+
+
+@lru_cache(maxsize=SQL_SHAPE_CACHE_SIZE)
+def _compile_column(shape):
+    kind, column = shape[0], shape[1]
+    if kind == 'eq':
+        return column + ' = %s'
+    if kind == 'null':
+        return column + ' IS NULL'
+    if kind == 'any':
+        return DATABASE_TRUE
+    null_contains_return = (column + ' IS NULL OR ') if shape[2] else ''
+    if kind == 'empty':
+        return '(' + null_contains_return + DATABASE_TRUE + ')'
+    if kind == 'array':
+        return '({} {} = ANY(%s))'.format(null_contains_return, column)
+    if kind == 'json':
+        return '({} {} IN (SELECT value FROM json_each(%s)))'.format(null_contains_return, column)
+    return '({} {} IN ({}))'.format(null_contains_return, column, ','.join(['%s'] * shape[3]))
+
+
+@lru_cache(maxsize=None)
+def _is_json_each_supported():
+    """
+    Check whether SQLite is compiled with the JSON functions, lists of values
+    are passed to it as one JSON parameter then.
+    """
+    try:
+        sqlite3.connect(':memory:').execute("SELECT value FROM json_each('[]')")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+_MISSING = object()
+
+
+def get_request_memo():
+    """
+    Memo of variables and answer statistics read by database environments
+    during the current request, None outside of a request. The memo is not
+    used by tests, since they run outside and inside of requests in the same
+    thread.
+    """
+    if getattr(settings, 'TESTING', False) or not is_cache_prepared():
+        return None
+    try:
+        memo = get_from_request_permenent_cache(REQUEST_MEMO_KEY)
+    except KeyError:
+        # the current thread does not serve any request
+        return None
+    if memo is None:
+        memo = {'variables': defaultdict(dict), 'answers': {}}
+        set_to_request_permanent_cache(REQUEST_MEMO_KEY, memo)
+    return memo
+
+
+def forget_answers():
+    """
+    Forget the memoized answer statistics, e.g., when a new answer is saved.
+    """
+    memo = get_request_memo()
+    if memo is not None:
+        memo['answers'].clear()
@@ -1,9 +1,18 @@
-from .environment import DatabaseEnvironment
-from .models import Item
+from .environment import DatabaseEnvironment, InMemoryDatabaseFlushEnvironment
+from .models import Answer, AnswerAggregate, EnvironmentInfo, Item, Variable
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache as django_cache
+from django.core.management import call_command
+from mock import patch
+from proso.django.cache import RequestCacheMiddleware
+from proso_common.models import Config
+from threading import currentThread
+import copy
 import datetime
 import django.test as test
+import proso.django.config as config
+import proso.django.cache as cache
 import proso.models.environment as environment
 
 
@@ -48,3 +57,251 @@ class DatabaseEnvironmentTest(test.TestCase, environment.TestCommonEnvironment):
             diff += 1
         self.assertEqual(env.rolling_success(user_1), 1.0)
         self.assertEqual(env.rolling_success(user_2), 0.0)
+
+    def test_stable_statements(self):
+        env = self.generate_environment()
+        where, params = env._where_more_items('key', [1, 2], user=1)
+        other_where, other_params = env._where_more_items('key', [3, 2, 1], user=2)
+        self.assertEqual(where, other_where)
+        self.assertEqual(len(params), len(other_params))
+
+    def test_padded_statements(self):
+        env = self.generate_environment()
+        with patch('proso_models.environment.is_on_postgresql', return_value=False), patch('proso_models.environment._is_json_each_supported', return_value=False):
+            where, params = env._where_more_items('key', [1, 2, 3], user=1)
+            other_where, other_params = env._where_more_items('key', [4, 3, 2, 1], user=1)
+        self.assertEqual(where, other_where)
+        self.assertEqual(len(params), len(other_params))
+        self.assertEqual(params.count(3), 2)
+
+
+class WriteBehindDatabaseEnvironmentTest(DatabaseEnvironmentTest):
+
+    _info = None
+
+    def generate_environment(self):
+        if self._info is None:
+            self._info = EnvironmentInfo.objects.create(config=Config.objects.from_content({}), revision=0)
+        env = DatabaseEnvironment(self._info.id)
+        env.postpone_writes()
+        return env
+
+    def test_flush(self):
+        env = self.generate_environment()
+        user = self.generate_user()
+        items = [self.generate_item() for i in range(3)]
+        env.write('key', 1, user=user, item=items[0])
+        env.write('key', 2, item=items[1], item_secondary=items[0])
+        env.write('key', 3)
+        fresh = DatabaseEnvironment(self._info.id)
+        self.assertIsNone(fresh.read('key', user=user, item=items[0]))
+        self.assertEqual(1, env.read('key', user=user, item=items[0]))
+        self.assertEqual(2, env.read('key', item=items[0], item_secondary=items[1]))
+        env.flush()
+        self.assertEqual(1, fresh.read('key', user=user, item=items[0]))
+        self.assertEqual(2, fresh.read('key', item=items[0], item_secondary=items[1]))
+        self.assertEqual(3, fresh.read('key'))
+        env.write('key', 4)
+        env.write('key', 5, item=items[2])
+        self.assertEqual({items[1]: None, items[2]: 5}, env.read_more_items('key', items=items[1:]))
+        env.flush()
+        self.assertEqual(4, fresh.read('key'))
+        self.assertEqual(1, Variable.objects.filter(key='key', user_id=None, item_primary_id=None).count())
+
+
+class AnswerAggregateTest(test.TestCase):
+
+    def setUp(self):
+        config.override('proso_models.answer_aggregates.maintained', True)
+        env = DatabaseEnvironment()
+        self._users = [User.objects.create(username=str(i)).id for i in range(2)]
+        self._items = [Item.objects.create().id for i in range(3)]
+        for i in range(7):
+            item = self._items[i % 2]
+            env.process_answer(self._users[i % 2], item, item, item if i % 3 else None, datetime.datetime(2016, 1, 1, i), None, 1000, 0)
+
+    def tearDown(self):
+        config.reset_overridden()
+
+    def statistics(self, env):
+        return [
+            env.number_of_answers_more_items(self._items),
+            env.number_of_correct_answers_more_items(self._items, user=self._users[0]),
+            env.number_of_first_answers_more_items(self._items),
+            env.last_answer_time_more_items(self._items, user=self._users[1]),
+            env.has_answer_more_items(self._items, user=self._users[0]),
+        ]
+
+    def test_statistics(self):
+        expected = self.statistics(DatabaseEnvironment())
+        config.override('proso_models.answer_aggregates.enabled', True)
+        self.assertEqual(expected, self.statistics(DatabaseEnvironment()))
+        rows = sorted(AnswerAggregate.objects.values_list('user_id', 'item_id', 'number_of_answers', 'number_of_correct_answers', 'last_answer_id'))
+        call_command('backfill_answer_aggregates')
+        self.assertEqual(rows, sorted(AnswerAggregate.objects.values_list('user_id', 'item_id', 'number_of_answers', 'number_of_correct_answers', 'last_answer_id')))
+        self.assertEqual(expected, self.statistics(DatabaseEnvironment()))
+
+    def test_not_maintained(self):
+        config.reset_overridden()
+        count = AnswerAggregate.objects.count()
+        DatabaseEnvironment().process_answer(self._users[0], self._items[2], self._items[2], None, datetime.datetime(2016, 1, 2), None, 1000, 0)
+        self.assertEqual(count, AnswerAggregate.objects.count())
+
+    def test_shifted_answers(self):
+        config.override('proso_models.answer_aggregates.enabled', True)
+        env = DatabaseEnvironment()
+        env.shift_answers(Answer.objects.order_by('-id').values_list('id', flat=True)[0])
+        self.assertEqual({self._items[0]: 3, self._items[1]: 3, self._items[2]: 0}, env.number_of_answers_more_items(self._items))
+
+
+class ConfusingFactorCacheTest(test.TestCase):
+
+    def setUp(self):
+        # ids of items are reused by tests
+        django_cache.clear()
+        self._env = DatabaseEnvironment()
+        self._user = User.objects.create(username='user').id
+        self._items = [Item.objects.create().id for i in range(3)]
+
+    def answer(self, answered):
+        self._env.process_answer(self._user, self._items[0], self._items[0], answered, datetime.datetime.now(), None, 1000, 0)
+
+    def confusing_factors(self):
+        return [
+            self._env.confusing_factor_more_items(self._items[0], self._items[1:]),
+            self._env.confusing_factor_more_items(self._items[0], self._items[1:], user=self._user),
+        ]
+
+    def test_incremental_update(self):
+        self.answer(self._items[1])
+        self.assertEqual([[1, 0], [1, 0]], self.confusing_factors())
+        self.answer(self._items[1])
+        self.answer(self._items[2])
+        self.assertEqual([[2, 1], [2, 1]], self.confusing_factors())
+
+    def test_asymmetric(self):
+        self.answer(self._items[1])
+        self.assertEqual([0], self._env.confusing_factor_more_items(self._items[1], [self._items[0]]))
+        self.assertEqual([1], self._env.confusing_factor_more_items(self._items[0], [self._items[1]]))
+        self.assertEqual([0], self._env.confusing_factor_more_items(self._items[1], [self._items[0]]))
+
+    def test_warm_up(self):
+        self.answer(self._items[1])
+        self.assertEqual(1, self._env.warm_up_confusing_factors())
+        self.assertEqual([[1, 0], [1, 0]], self.confusing_factors())
+        self.answer(self._items[2])
+        self.assertEqual([[1, 1], [1, 1]], self.confusing_factors())
+
+
+@test.override_settings(TESTING=False)
+class RequestMemoDatabaseEnvironmentTest(test.TestCase):
+
+    def setUp(self):
+        RequestCacheMiddleware().process_request(None)
+        self._info = EnvironmentInfo.objects.create(config=Config.objects.from_content({}), revision=0)
+        self._user = User.objects.create(username='memo').id
+        self._items = [Item.objects.create().id for i in range(3)]
+
+    def tearDown(self):
+        # the thread does not serve a request anymore
+        cache._request_permanent_cache.pop(currentThread(), None)
+
+    def test_variables(self):
+        env = DatabaseEnvironment(self._info.id)
+        env.write('key', 1, user=self._user, item=self._items[0])
+        self.assertEqual(1, env.read('key', user=self._user, item=self._items[0]))
+        self.assertEqual({self._items[0]: 1, self._items[1]: 0}, env.read_more_items('key', self._items[:2], user=self._user, default=0))
+        Variable.objects.filter(key='key').update(value=2)
+        other = DatabaseEnvironment(self._info.id)
+        self.assertEqual(1, other.read('key', user=self._user, item=self._items[0]))
+        self.assertEqual({self._items[0]: 1, self._items[1]: 0}, other.read_more_items('key', self._items[:2], user=self._user, default=0))
+        env.write('key', 3, user=self._user, item=self._items[1])
+        self.assertEqual(2, other.read('key', user=self._user, item=self._items[0]))
+        self.assertEqual({self._items[0]: 2, self._items[1]: 3}, other.read_more_items('key', self._items[:2], user=self._user, default=0))
+
+    def test_answers(self):
+        env = DatabaseEnvironment(self._info.id)
+        self.assertEqual({i: 0 for i in self._items}, env.number_of_answers_more_items(self._items, user=self._user))
+        env.process_answer(self._user, self._items[0], self._items[0], self._items[0], datetime.datetime.now(), None, 1000, 0)
+        self.assertEqual(1, env.number_of_answers(user=self._user))
+        self.assertEqual(1, env.number_of_correct_answers(user=self._user))
+        self.assertEqual({self._items[0]: 1, self._items[1]: 0}, env.number_of_answers_more_items(self._items[:2], user=self._user))
+        self.assertIsNotNone(env.last_answer_time_more_items(self._items, user=self._user)[self._items[0]])
+
+
+class SpillingInMemoryDatabaseFlushEnvironmentTest(test.TestCase, environment.TestCommonEnvironment):
+
+    _user = 0
+    _item = 0
+    _answer = 0
+
+    def generate_item(self):
+        self._item += 1
+        return self._item
+
+    def generate_user(self):
+        self._user += 1
+        return self._user
+
+    def generate_answer_id(self):
+        self._answer += 1
+        return self._answer
+
+    def generate_environment(self):
+        # the tiny memory makes the environment spill almost all users
+        return InMemoryDatabaseFlushEnvironment(EnvironmentInfo(), max_variables=3)
+
+
+class InMemoryDatabaseFlushEnvironmentTest(test.TestCase):
+
+    def setUp(self):
+        self._info = EnvironmentInfo.objects.create(config=Config.objects.from_content({}), revision=0)
+        self._users = [User.objects.create(username=str(i)).id for i in range(2)]
+        self._items = [Item.objects.create().id for i in range(3)]
+
+    def test_flush_in_background(self):
+        env = InMemoryDatabaseFlushEnvironment(self._info)
+        expected = InMemoryDatabaseFlushEnvironment(self._info)
+        for i in range(12):
+            user = self._users[i % len(self._users)]
+            item = self._items[i % len(self._items)]
+            for e in [env, expected]:
+                e.process_answer(user, item, item, item, datetime.datetime.now(), None, 1000, 0)
+                e.write('rating', i, user=user, item=item)
+            if i % 4 == 3:
+                env.flush_in_background(clean=False).wait()
+        env.flush_in_background(clean=False).wait()
+        flushed = DatabaseEnvironment(self._info.id)
+        for user in self._users:
+            for item in self._items:
+                for key in ['rating', environment.InMemoryEnvironment.NUMBER_OF_ANSWERS]:
+                    self.assertEqual(expected.read(key, user=user, item=item), flushed.read(key, user=user, item=item))
+                    self.assertEqual(expected.read(key, user=user, item=item), env.read(key, user=user, item=item))
+
+    def test_prefetch_keys(self):
+        database = DatabaseEnvironment(self._info.id)
+        user, item = self._users[0], self._items[0]
+        database.write('skill', 1, user=user, item=item)
+        database.write('other', 2, user=user, item=item)
+        database.write('skill', 3, user=self._users[1], item=item)
+        env = InMemoryDatabaseFlushEnvironment(self._info)
+        env.prefetch([user], [item], keys={'skill'})
+        self.assertEqual(1, env.read('skill', user=user, item=item))
+        self.assertIsNone(env.read('other', user=user, item=item))
+        self.assertIsNone(env.read('skill', user=self._users[1], item=item))
+        env.prefetch([user], [item])
+        self.assertEqual(2, env.read('other', user=user, item=item))
+
+    def test_deepcopy_spilled(self):
+        env = InMemoryDatabaseFlushEnvironment(self._info, max_variables=3)
+        for i, user in enumerate(self._users):
+            for item in self._items:
+                env.write('rating', i, user=user, item=item)
+        copied = copy.deepcopy(env)
+        for user in self._users:
+            for item in self._items:
+                copied.write('rating', 10, user=user, item=item)
+        for i, user in enumerate(self._users):
+            for item in self._items:
+                self.assertEqual(i, env.read('rating', user=user, item=item))
+                self.assertEqual(10, copied.read('rating', user=user, item=item))
@@ -0,0 +1,37 @@
+from contextlib import closing
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db import transaction
+from proso.django.db import is_on_postgresql
+from proso.time import timer
+
+
+class Command(BaseCommand):
+
+    help = "aggregate all answers, the aggregates are used by the environment when 'proso_models.answer_aggregates.enabled' is set, 'proso_models.answer_aggregates.maintained' has to be set before the backfill to keep them up to date"
+
+    def handle(self, *args, **options):
+        timer('backfill_answer_aggregates')
+        with transaction.atomic():
+            with closing(connection.cursor()) as cursor:
+                if is_on_postgresql():
+                    # new answers wait until the aggregates are computed
+                    cursor.execute('LOCK TABLE proso_models_answer IN SHARE MODE')
+                cursor.execute('DELETE FROM proso_models_answeraggregate')
+                cursor.execute(
+                    '''
+                    INSERT INTO proso_models_answeraggregate
+                        (user_id, item_id, number_of_answers, number_of_correct_answers, first_answer_time, last_answer_time, last_answer_id)
+                    SELECT
+                        user_id,
+                        item_id,
+                        COUNT(id),
+                        SUM(CASE WHEN item_asked_id = item_answered_id THEN 1 ELSE 0 END),
+                        MIN(time),
+                        MAX(time),
+                        MAX(id)
+                    FROM proso_models_answer
+                    GROUP BY user_id, item_id
+                    ''')
+                aggregates = cursor.rowcount
+        print(' -- aggregating answers, time:', timer('backfill_answer_aggregates'), 'seconds,', aggregates, 'aggregates')
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from proso.django.db import is_on_postgresql
+from proso.time import timer
+from proso_models.models import EnvironmentInfo
+from proso_models.partitions import is_partitioned, partition_variables
+
+
+class Command(BaseCommand):
+
+    help = 'move variables to partitions by environment info, so garbage collection of old environments only drops partitions'
+
+    def handle(self, *args, **options):
+        if not is_on_postgresql():
+            raise CommandError('Partitioning of variables is supported only on PostgreSQL.')
+        if is_partitioned():
+            print(' -- variables are already partitioned')
+            return
+        timer('partition_variables')
+        with transaction.atomic():
+            partition_variables(EnvironmentInfo.objects.values_list('id', flat=True))
+        print(' -- partitioning variables, time:', timer('partition_variables'), 'seconds')
@@ -1,5 +1,5 @@
 from clint.textui import progress
-from contextlib import closing
+from contextlib import closing, ExitStack
 from django.conf import settings
 from django.core.cache import cache
 from django.core.management.base import BaseCommand, CommandError
@@ -10,15 +10,22 @@ from proso.list import flatten
 from proso_models.models import instantiate_from_config, get_config, Item
 from proso.django.config import set_default_config_name
 from proso.django.db import is_on_postgresql
-from proso.models.environment import InMemoryEnvironment
+from proso.models.metrics import Metrics
 from proso.time import timer
 from proso_common.models import Config
 from proso_models.models import EnvironmentInfo, ENVIRONMENT_INFO_CACHE_KEY
 from proso_models.models import get_predictive_model
+from proso_models.partitions import drop_partition, is_partitioned
+from proso_models.replay import AnswerReader, answer_id_at_position
+from proso.django.config import instantiate_from_json
+from functools import partial
+import copy
+import itertools
 import json
-import math
 import matplotlib.pyplot as plt
+import multiprocessing
 import numpy
+import os
 import sys
 
 
@@ -40,6 +47,12 @@ class Command(BaseCommand):
             dest='batch_size',
             type=int,
             default=100000),
+        make_option(
+            '--batches',
+            dest='batches',
+            type=int,
+            default=1,
+            help='number of batches processed in one run, each batch is flushed in its own transaction while the following one is replayed'),
         make_option(
             '--cancel',
             dest='cancel',
@@ -55,6 +68,12 @@ class Command(BaseCommand):
             dest='finish',
             action='store_true',
             default=False),
+        make_option(
+            '--catch-up',
+            dest='catch_up',
+            type=int,
+            default=None,
+            help='with --finish, replay the answers arrived during the recomputation until at most the given number of them remains, the rest is replayed while saving of new answers is blocked'),
         make_option(
             '--validate',
             dest='validate',
@@ -65,6 +84,30 @@ class Command(BaseCommand):
             dest='dry',
             action='store_true',
             default=False),
+        make_option(
+            '--configs',
+            dest='configs',
+            type=str,
+            default=None,
+            help='JSON file with predictive model configs evaluated by --dry, lists of parameter values are expanded to a grid; the variables are kept in the memory, spilling of the recompute environment is disabled'),
+        make_option(
+            '--workers',
+            dest='workers',
+            type=int,
+            default=None,
+            help='number of processes evaluating the configs given by --configs'),
+        make_option(
+            '--checkpoint-every',
+            dest='checkpoint_every',
+            type=int,
+            default=None,
+            help='save a checkpoint of the environment after the given number of answers'),
+        make_option(
+            '--resume',
+            dest='resume',
+            action='store_true',
+            default=False,
+            help='continue from the latest checkpoint of the loading environment'),
         make_option(
             '--limit',
             dest='limit',
@@ -78,7 +121,9 @@ class Command(BaseCommand):
     )
 
     def handle(self, *args, **options):
-        with transaction.atomic():
+        # with more batches each flushed batch is committed together with
+        # the progress of loading, catching up commits each round
+        with self.transaction(options) if options['catch_up'] is None else ExitStack():
             if options['cancel']:
                 self.handle_cancel(options)
             elif options['garbage_collector']:
@@ -112,63 +157,60 @@ class Command(BaseCommand):
 
     def handle_dry(self, options):
         info = self.load_environment_info(options['initial'], options['config_name'], True)
-        environment = InMemoryEnvironment()
         environment = self.load_environment(info)
-        users, items = self.load_user_and_item_ids(info, options['batch_size'])
-        items += list(set(flatten(Item.objects.get_reachable_parents(items).values())))
-        environment.prefetch(users, items)
+        reader = AnswerReader(options['batch_size'], limit=options['limit'])
+        if options['configs'] is not None:
+            self.handle_dry_configs(environment, reader, options)
+            return
         predictive_model = get_predictive_model(info.to_json())
-        with closing(connection.cursor()) as cursor:
-            cursor.execute('SELECT COUNT(*) FROM proso_models_answer')
-            answers_total = cursor.fetchone()[0]
-            if options['limit'] is not None:
-                answers_total = min(answers_total, options['limit'])
-            print('total:', answers_total)
-            processed = 0
-            prediction = numpy.empty(answers_total)
-            correct = numpy.empty(answers_total)
-            while processed < answers_total:
-                cursor.execute(
-                    '''
-                    SELECT
-                        id,
-                        user_id,
-                        item_id,
-                        item_asked_id,
-                        item_answered_id,
-                        time,
-                        response_time,
-                        guess
-                    FROM proso_models_answer
-                    ORDER BY id
-                    OFFSET %s LIMIT %s
-                    ''', [processed, options['batch_size']])
-                for (answer_id, user, item, asked, answered, time, response_time, guess) in cursor:
-                    correct[processed] = asked == answered
-                    prediction[processed] = predictive_model.predict_and_update(
-                        environment,
-                        user,
-                        item,
-                        asked == answered,
-                        time,
-                        item_answered=answered,
-                        item_asked=asked,
-                        guess=guess,
-                        answer_id=answer_id,
-                        response_time=response_time,
-                    )
-                    environment.process_answer(user, item, asked, answered, time, answer_id, response_time, guess)
-                    processed += 1
-                    if processed >= answers_total:
-                        break
-                print('processed:', processed)
+        metrics = Metrics()
+        for batch in reader:
+            if reader.read == len(batch):
+                # variables are prefetched only for the first batch, the
+                # following prefetch would overwrite already updated values
+                self.prefetch(environment, [batch], [predictive_model])
+            metrics.update(replay_batch(predictive_model, environment, batch), batch.correct)
+            print('processed:', reader.read)
         filename = settings.DATA_DIR + '/recompute_model_report_{}.json'.format(predictive_model.__class__.__name__)
-        model_report = report(prediction, correct)
+        model_report = metrics.report()
         with open(filename, 'w') as outfile:
             json.dump(model_report, outfile)
         print('Saving report to:', filename)
         brier_graphs(model_report['brier'], predictive_model)
 
+    def handle_dry_configs(self, environment, reader, options):
+        with open(options['configs'], 'r') as config_file:
+            configs = expand_configs(json.load(config_file))
+        if len(configs) == 0:
+            raise CommandError("There is no predictive model config in {}.".format(options['configs']))
+        # the spilled variables would be kept in a database shared by the
+        # forked workers, each config needs its own copy of the environment
+        if hasattr(environment, 'disable_spilling'):
+            environment.disable_spilling()
+        batches = []
+        for batch in reader:
+            batches.append(batch)
+            print('loaded:', reader.read)
+        self.prefetch(environment, batches, [instantiate_from_json(config) for config in configs])
+        workers = min(len(configs), options['workers'] or multiprocessing.cpu_count())
+        print(' -- evaluating', len(configs), 'configs in', workers, 'processes')
+        timer('recompute_dry_configs')
+        # the environment and the answers are inherited by forked workers, so
+        # they are neither pickled nor loaded from the database again
+        with multiprocessing.get_context('fork').Pool(workers, initializer=_init_dry_worker, initargs=(environment, batches)) as pool:
+            results = []
+            for result in pool.imap_unordered(_evaluate_config, list(enumerate(configs))):
+                print(' -- evaluated config {}/{}, time: {:.2f} seconds, rmse: {:.5f}'.format(
+                    len(results) + 1, len(configs), result['time'], result['rmse']))
+                results.append(result)
+        results = sorted(results, key=lambda r: r['rmse'])
+        print(' -- evaluation phase, time:', timer('recompute_dry_configs'), 'seconds')
+        print(comparative_table(results))
+        filename = settings.DATA_DIR + '/recompute_model_report_configs.json'
+        with open(filename, 'w') as outfile:
+            json.dump(results, outfile)
+        print('Saving report to:', filename)
+
     def handle_gc(self, options):
         timer('recompute_gc')
         print(' -- collecting garbage')
@@ -177,12 +219,18 @@ class Command(BaseCommand):
             print(' -- no environment info to collect')
             return
         to_gc_str = ','.join(to_gc)
+        partitioned = is_partitioned()
+        if partitioned:
+            dropped = len([info_id for info_id in to_gc if drop_partition(info_id)])
+            print(' -- dropped', dropped, 'partitions of variables')
         with closing(connection.cursor()) as cursor:
+            # with partitions only the variables left in the default
+            # partition created by the previous versions are deleted
             cursor.execute('DELETE FROM proso_models_variable WHERE info_id IN (%s)' % to_gc_str)
             variables = cursor.rowcount
             cursor.execute('DELETE FROM proso_models_environmentinfo WHERE id IN (%s)' % to_gc_str)
             infos = cursor.rowcount
-            if is_on_postgresql():
+            if is_on_postgresql() and not partitioned:
                 timer('recompute_vacuum')
                 cursor.execute('VACUUM FULL ANALYZE VERBOSE proso_models_variable')
                 print(' -- vacuum phase, time:', timer('recompute_vacuum'), 'seconds')
@@ -193,67 +241,121 @@ class Command(BaseCommand):
         print(' -- cancelling')
         info.status = EnvironmentInfo.STATUS_DISABLED
         info.save()
+        transaction.on_commit(lambda: self.remove_checkpoint(info))
 
     def handle_recompute(self, options):
         timer('recompute_all')
         info = self.load_environment_info(options['initial'], options['config_name'], False)
-        if options['finish']:
-            to_process = self.number_of_answers_to_process(info)
-            if self.number_of_answers_to_process(info) >= options['batch_size'] and not options['force']:
+        if options['finish'] and options['catch_up'] is not None:
+            self.catch_up(info, options)
+        elif options['finish']:
+            to_process = AnswerReader(options['batch_size'], last_id=self.load_last_answer_id(info)).number_of_remaining_answers()
+            if to_process >= options['batch_size'] * options['batches'] and not options['force']:
                 raise CommandError("There is more then allowed number of answers (%s) to process." % to_process)
             self.recompute(info, options)
         else:
             self.recompute(info, options)
         print(' -- total time of recomputation:', timer('recompute_all'), 'seconds')
 
-    def recompute(self, info, options):
+    def catch_up(self, info, options):
+        """
+        Replay the answers saved while the environment was being recomputed
+        until the number of remaining answers is at most the given threshold.
+        The remaining answers are replayed and the environment is activated
+        in one transaction while saving of new answers is blocked, so the
+        activated environment does not miss any answer.
+
+        Answers are read in the order of ids, but an answer can be committed
+        after an answer with greater id. The rounds before the blocking one
+        therefore replay only the answers below :meth:`committed_answer_id`,
+        so no answer committed late is skipped.
+        """
+        remaining = AnswerReader(options['batch_size'], last_id=self.load_last_answer_id(info)).number_of_remaining_answers()
+        while remaining > options['catch_up']:
+            print(' -- catching up, remaining answers:', remaining)
+            max_answer_id = self.committed_answer_id()
+            with self.transaction(options):
+                self.recompute(info, dict(options, finish=False), max_answer_id=max_answer_id)
+            previous, remaining = remaining, AnswerReader(options['batch_size'], last_id=self.load_last_answer_id(info)).number_of_remaining_answers()
+            if remaining >= previous:
+                raise CommandError("The answers are saved faster than they are replayed ({} remaining), increase the batch size or the number of batches.".format(remaining))
+        with transaction.atomic():
+            timer('recompute_lock')
+            if is_on_postgresql():
+                # writers wait for the lock, readers are not affected
+                with closing(connection.cursor()) as cursor:
+                    cursor.execute('LOCK TABLE proso_models_answer IN SHARE MODE')
+            remaining = AnswerReader(options['batch_size'], last_id=self.load_last_answer_id(info)).number_of_remaining_answers()
+            print(' -- catching up with blocked answers, remaining answers:', remaining)
+            self.recompute(info, dict(options, batches=1, batch_size=max(remaining, 1)))
+            print(' -- answers blocked for:', timer('recompute_lock'), 'seconds')
+
+    def committed_answer_id(self):
+        """
+        Get the greatest id of answers such that all answers with lower or
+        equal ids are committed. On PostgreSQL the answers are briefly
+        locked, so the transactions saving answers are waited for (answers
+        saved afterwards get greater ids).
+        """
+        with transaction.atomic():
+            with closing(connection.cursor()) as cursor:
+                if is_on_postgresql():
+                    cursor.execute('LOCK TABLE proso_models_answer IN SHARE MODE')
+                cursor.execute('SELECT COALESCE(MAX(id), 0) FROM proso_models_answer')
+                return cursor.fetchone()[0]
+
+    def transaction(self, options):
+        return transaction.atomic() if options['batches'] == 1 else ExitStack()
+
+    def recompute(self, info, options, max_answer_id=None):
         print(' -- preparing phase')
         timer('recompute_prepare')
         environment = self.load_environment(info)
-        users, items = self.load_user_and_item_ids(info, options['batch_size'])
-        items += list(set(flatten(Item.objects.get_reachable_parents(items).values())))
-        environment.prefetch(users, items)
+        base_answer_id = self.load_last_answer_id(info)
+        checkpoint = self.load_checkpoint(info, environment) if options['resume'] else None
+        if checkpoint is None:
+            replayed = 0
+            last_answer_id = base_answer_id
+        else:
+            # the answers replayed before the checkpoint are part of the batch
+            replayed = checkpoint['replayed']
+            last_answer_id = checkpoint['last_answer_id']
         predictive_model = get_predictive_model(info.to_json())
         print(' -- preparing phase, time:', timer('recompute_prepare'), 'seconds')
-        timer('recompute_model')
-        print(' -- model phase')
-        with closing(connection.cursor()) as cursor:
-            cursor.execute(
-                '''
-                SELECT
-                    id,
-                    user_id,
-                    item_id,
-                    item_asked_id,
-                    item_answered_id,
-                    time,
-                    response_time,
-                    guess
-                FROM proso_models_answer
-                ORDER BY id
-                OFFSET %s LIMIT %s
-                ''', [info.load_progress, options['batch_size']])
-            progress_bar = progress.bar(cursor, every=max(1, cursor.rowcount // 100), expected_size=cursor.rowcount)
-            info.load_progress += cursor.rowcount
-            for (answer_id, user, item, asked, answered, time, response_time, guess) in progress_bar:
-                predictive_model.predict_and_update(
-                    environment,
-                    user,
-                    item,
-                    asked == answered,
-                    time,
-                    item_answered=answered,
-                    item_asked=asked,
-                    guess=guess,
-                    answer_id=answer_id,
-                    response_time=response_time,
-                )
-                environment.process_answer(user, item, asked, answered, time, answer_id, response_time, guess)
-        print(' -- model phase, time:', timer('recompute_model'), 'seconds')
-        timer('recompute_flush')
-        print(' -- flushing phase')
-        environment.flush(clean=options['finish'])
-        print(' -- flushing phase, time:', timer('recompute_flush'), 'seconds, total number of answers:', info.load_progress)
+        flush = None
+        for batch_number in range(options['batches']):
+            reader = AnswerReader(max(options['batch_size'] - replayed, 0), last_id=last_answer_id, max_id=max_answer_id)
+            batch = reader.read_batch()
+            if batch_number > 0 and len(batch) == 0:
+                break
+            last = batch_number == options['batches'] - 1 or len(batch) < reader.batch_size
+            self.prefetch(environment, [batch], [predictive_model])
+            timer('recompute_model')
+            print(' -- model phase')
+            replayed = self.replay(info, environment, predictive_model, batch, base_answer_id, replayed, options)
+            info.load_progress += replayed
+            info.load_last_answer_id = last_answer_id = reader.last_id
+            print(' -- model phase, time:', timer('recompute_model'), 'seconds')
+            timer('recompute_flush')
+            if options['batches'] == 1:
+                print(' -- flushing phase')
+                environment.flush(clean=options['finish'])
+                print(' -- flushing phase, time:', timer('recompute_flush'), 'seconds, total number of answers:', info.load_progress)
+            else:
+                if flush is not None:
+                    flush.wait()
+                print(' -- flushing phase in background, waiting for the previous one:', timer('recompute_flush'), 'seconds, total number of answers:', info.load_progress)
+                flush = environment.flush_in_background(
+                    clean=options['finish'] and last,
+                    callback=partial(save_progress, info.id, info.load_progress, info.load_last_answer_id))
+            base_answer_id = last_answer_id
+            replayed = 0
+            if last:
+                break
+        if flush is not None:
+            timer('recompute_flush')
+            flush.wait()
+            print(' -- waiting for the last flushing phase:', timer('recompute_flush'), 'seconds')
         if options['finish']:
             timer('recompute_finish')
             print(' -- finishing phase')
@@ -267,6 +369,34 @@ class Command(BaseCommand):
             info.status = EnvironmentInfo.STATUS_ACTIVE
             print(' -- finishing phase, time:', timer('recompute_finish'), 'seconds')
         info.save()
+        # the checkpoint is superseded by the flushed environment
+        transaction.on_commit(lambda: self.remove_checkpoint(info))
+
+    def replay(self, info, environment, predictive_model, batch, base_answer_id, replayed, options):
+        """
+        Replay the batch and save checkpoints if they are requested.
+
+        Returns:
+            int: number of replayed answers including the answers replayed
+            before the checkpoint the batch continues from
+        """
+        if options['checkpoint_every'] is None:
+            replay_batch(predictive_model, environment, batch, show_progress=True)
+            return replayed + len(batch)
+        if not hasattr(environment, 'save'):
+            raise CommandError("The environment {} can't be saved to a checkpoint.".format(environment.__class__.__name__))
+        for start in range(0, len(batch), options['checkpoint_every']):
+            chunk = batch.slice(start, start + options['checkpoint_every'])
+            replay_batch(predictive_model, environment, chunk, show_progress=True)
+            replayed += len(chunk)
+            self.save_checkpoint(info, environment, {
+                'info_id': info.id,
+                'base_answer_id': base_answer_id,
+                'last_answer_id': chunk.answer_ids[-1],
+                'replayed': replayed,
+                'load_progress': info.load_progress + replayed,
+            })
+        return replayed
 
     def load_environment_info(self, initial, config_name, dry):
         set_default_config_name(config_name)
@@ -295,77 +425,187 @@ class Command(BaseCommand):
             default_class='proso_models.environment.InMemoryDatabaseFlushEnvironment',
             pass_parameters=[info])
 
-    def load_user_and_item_ids(self, info, batch_size):
-        with closing(connection.cursor()) as cursor:
-            cursor.execute(
-                '''
-                SELECT
-                    user_id,
-                    item_id,
-                    item_asked_id,
-                    item_answered_id
-                FROM proso_models_answer
-                ORDER BY id
-                OFFSET %s LIMIT %s
-                ''', [info.load_progress, batch_size])
-            unzipped = list(zip(*cursor.fetchall()))
-            if len(unzipped) == 0:
-                return [], []
-            else:
-                return list(set(unzipped[0])), [x for x in list(set(unzipped[1]) | set(unzipped[2]) | set(unzipped[3])) if x is not None]
+    def load_last_answer_id(self, info):
+        if info.load_last_answer_id is None:
+            # environments which started loading before the id of the last
+            # loaded answer was stored know only the number of loaded answers
+            info.load_last_answer_id = answer_id_at_position(info.load_progress)
+        return info.load_last_answer_id
 
-    def number_of_answers_to_process(self, info):
-        with closing(connection.cursor()) as cursor:
-            cursor.execute(
-                '''
-                SELECT COUNT(id)
-                FROM proso_models_answer
-                OFFSET %s
-                ''', [info.load_progress])
-            fetched = cursor.fetchone()
-            if fetched is None:
-                return 0
-            else:
-                return fetched[0]
-
-
-def report(predictions, real):
-    return {
-        'rmse': rmse(predictions, real),
-        'brier': brier(predictions, real),
-    }
-
-
-def rmse(predictions, real):
-    return math.sqrt(numpy.mean((predictions - real) ** 2))
-
-
-def brier(predictions, real, bins=20):
-    counts = numpy.zeros(bins)
-    correct = numpy.zeros(bins)
-    prediction = numpy.zeros(bins)
-    for p, r in zip(predictions, real):
-        bin = min(int(p * bins), bins - 1)
-        counts[bin] += 1
-        correct[bin] += r
-        prediction[bin] += p
-    prediction_means = prediction / counts
-    prediction_means[numpy.isnan(prediction_means)] = ((numpy.arange(bins) + 0.5) / bins)[numpy.isnan(prediction_means)]
-    correct_means = correct / counts
-    correct_means[numpy.isnan(correct_means)] = 0
-    size = len(predictions)
-    answer_mean = sum(correct) / size
-    return {
-        "reliability": sum(counts * (correct_means - prediction_means) ** 2) / size,
-        "resolution": sum(counts * (correct_means - answer_mean) ** 2) / size,
-        "uncertainty": answer_mean * (1 - answer_mean),
-        "detail": {
-            "bin_count": bins,
-            "bin_counts": list(counts),
-            "bin_prediction_means": list(prediction_means),
-            "bin_correct_means": list(correct_means),
-        }
-    }
+    def checkpoint_filename(self, info):
+        return os.path.join(settings.DATA_DIR, 'recompute_model_checkpoint_{}.json'.format(info.id))
+
+    def read_checkpoint(self, info):
+        filename = self.checkpoint_filename(info)
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'r') as checkpoint_file:
+            return json.load(checkpoint_file)
+
+    def save_checkpoint(self, info, environment, checkpoint):
+        """
+        Save the environment and the progress of loading. The environment is
+        saved to a new file first and the description of the checkpoint
+        pointing to it is replaced afterwards, so the latest checkpoint is
+        always consistent.
+        """
+        timer('recompute_checkpoint')
+        filename = self.checkpoint_filename(info)
+        checkpoint = dict(checkpoint, environment='{}_{}.npz'.format(os.path.splitext(filename)[0], checkpoint['last_answer_id']))
+        environment.save(checkpoint['environment'])
+        previous = self.read_checkpoint(info)
+        with open(filename + '.tmp', 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+        os.replace(filename + '.tmp', filename)
+        if previous is not None and previous['environment'] != checkpoint['environment'] and os.path.exists(previous['environment']):
+            os.remove(previous['environment'])
+        print(' -- checkpoint after answer', checkpoint['last_answer_id'], 'time:', timer('recompute_checkpoint'), 'seconds')
+
+    def load_checkpoint(self, info, environment):
+        checkpoint = self.read_checkpoint(info)
+        if checkpoint is None:
+            print(' -- there is no checkpoint, starting from answer', info.load_last_answer_id)
+            return None
+        if checkpoint['info_id'] != info.id or checkpoint['base_answer_id'] != info.load_last_answer_id:
+            raise CommandError(
+                "The checkpoint continues from answer {}, but the environment is loaded up to answer {}.".format(
+                    checkpoint['base_answer_id'], info.load_last_answer_id))
+        environment.load(checkpoint['environment'])
+        print(' -- resuming from the checkpoint after answer', checkpoint['last_answer_id'])
+        return checkpoint
+
+    def remove_checkpoint(self, info):
+        checkpoint = self.read_checkpoint(info)
+        if checkpoint is None:
+            return
+        if os.path.exists(checkpoint['environment']):
+            os.remove(checkpoint['environment'])
+        os.remove(self.checkpoint_filename(info))
+
+    def prefetch(self, environment, batches, predictive_models):
+        """
+        Prefetch the variables of users and items from the batches, only the
+        keys read by the given predictive models are loaded if all of them
+        know their keys.
+        """
+        keys = set()
+        for predictive_model in predictive_models:
+            model_keys = predictive_model.variable_keys()
+            if model_keys is None:
+                keys = None
+                break
+            keys |= model_keys
+        users = set()
+        items = set()
+        for batch in batches:
+            users |= batch.user_ids()
+            items |= batch.item_ids()
+        items = list(items)
+        items += list(set(flatten(Item.objects.get_reachable_parents(items).values())))
+        environment.prefetch(list(users), items, keys=keys)
+
+
+def save_progress(info_id, load_progress, load_last_answer_id):
+    EnvironmentInfo.objects.filter(id=info_id).update(load_progress=load_progress, load_last_answer_id=load_last_answer_id)
+
+
+def replay_batch(predictive_model, environment, batch, show_progress=False):
+    """
+    Predict and update the model for the given batch of answers and process
+    them in the environment. The replay kernel of the model is used when the
+    model and the environment support it.
+
+    Returns:
+        numpy.ndarray: predictions of the given answers
+    """
+    kernel = predictive_model.replay_kernel(environment)
+    if kernel is not None:
+        if show_progress:
+            print(' -- replaying', len(batch), 'answers by', kernel.__class__.__name__)
+        return kernel.replay(batch)
+    predictions = numpy.empty(len(batch))
+    rows = batch.rows()
+    if show_progress:
+        rows = progress.bar(rows, every=max(1, len(batch) // 100), expected_size=len(batch))
+    for j, (user, item, asked, answered, time, answer_id, response_time, guess) in enumerate(rows):
+        predictions[j] = predictive_model.predict_and_update(
+            environment,
+            user,
+            item,
+            asked == answered,
+            time,
+            item_answered=answered,
+            item_asked=asked,
+            guess=guess,
+            answer_id=answer_id,
+            response_time=response_time,
+        )
+        environment.process_answer(user, item, asked, answered, time, answer_id, response_time, guess)
+    return predictions
+
+
+def expand_configs(configs):
+    """
+    Expand the given predictive model configs to the list of configs. A
+    config is a dictionary with keys 'class' and 'parameters', a list of
+    values of a parameter is expanded to the grid of configs, e.g.,
+    ``{"class": "...", "parameters": {"time_shift": [40, 80], "pfae_good": 3.4}}``
+    is expanded to two configs.
+
+    Args:
+        configs (dict|list): config or list of configs
+
+    Returns:
+        list: configs without lists of parameter values
+    """
+    if not isinstance(configs, list):
+        configs = [configs]
+    expanded = []
+    for config in configs:
+        parameters = config.get('parameters', {})
+        names = sorted(parameters.keys())
+        values = [parameters[name] if isinstance(parameters[name], list) else [parameters[name]] for name in names]
+        for combination in itertools.product(*values):
+            expanded_config = dict(config)
+            expanded_config['parameters'] = dict(zip(names, combination))
+            expanded.append(expanded_config)
+    return expanded
+
+
+_DRY_ENVIRONMENT = None
+_DRY_BATCHES = None
+
+
+def _init_dry_worker(environment, batches):
+    global _DRY_ENVIRONMENT, _DRY_BATCHES
+    _DRY_ENVIRONMENT = environment
+    _DRY_BATCHES = batches
+
+
+def _evaluate_config(index_config):
+    index, config = index_config
+    timer('recompute_dry_config_{}'.format(index))
+    # each config is evaluated in its own copy of the prefetched environment
+    environment = copy.deepcopy(_DRY_ENVIRONMENT)
+    predictive_model = instantiate_from_json(config)
+    metrics = Metrics()
+    for batch in _DRY_BATCHES:
+        metrics.update(replay_batch(predictive_model, environment, batch), batch.correct)
+    result = metrics.report()
+    result['config'] = config
+    result['answers'] = metrics.size()
+    result['time'] = timer('recompute_dry_config_{}'.format(index))
+    return result
+
+
+def comparative_table(results):
+    lines = ['{:>4} {:>10} {:>12} {:>12} {:>10} {:>8} {:>10}  {}'.format('', 'rmse', 'reliability', 'resolution', 'log-loss', 'auc', 'time [s]', 'config')]
+    for position, result in enumerate(results):
+        lines.append('{:>4} {:>10.5f} {:>12.6f} {:>12.6f} {:>10.5f} {:>8} {:>10.2f}  {}'.format(
+            position + 1, result['rmse'], result['brier']['reliability'], result['brier']['resolution'],
+            result['log_loss'], '-' if result['auc'] is None else '{:.4f}'.format(result['auc']),
+            result['time'], json.dumps(result['config'], sort_keys=True)))
+    return '\n'.join(lines)
 
 
 def brier_graphs(brier, model):
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from proso.time import timer
+from proso_models.models import get_environment
+
+
+class Command(BaseCommand):
+
+    help = "compute confusing factors of all items for all users and put them to the cache"
+
+    def handle(self, *args, **options):
+        timer('warm_up_confusing_factors')
+        shards = get_environment().warm_up_confusing_factors()
+        print(' -- computing confusing factors, time:', timer('warm_up_confusing_factors'), 'seconds,', shards, 'items')
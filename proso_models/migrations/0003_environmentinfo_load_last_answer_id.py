@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('proso_models', '0002_auto_remove_audit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='environmentinfo',
+            name='load_last_answer_id',
+            field=models.IntegerField(blank=True, default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from contextlib import closing
+from django.db import migrations
+
+
+# The index is built concurrently, so saving of variables is not blocked.
+# Django before 1.10 runs migrations on PostgreSQL in a transaction where the
+# index can't be built concurrently and the table would be locked for the
+# whole build. On large tables the duplicates should be deleted and the index
+# built by hand before the deploy (the migration skips both if the index
+# exists):
+#
+#   DELETE FROM proso_models_variable AS variable ... (see below)
+#   CREATE UNIQUE INDEX CONCURRENTLY proso_models_variable_upsert ON proso_models_variable
+#   (info_id, key, COALESCE(user_id, 0), COALESCE(item_primary_id, 0), COALESCE(item_secondary_id, 0));
+#
+# A failed concurrent build leaves an invalid index, drop it before trying
+# again.
+
+
+def create_upsert_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with closing(schema_editor.connection.cursor()) as cursor:
+        cursor.execute("SELECT 1 FROM pg_indexes WHERE indexname = 'proso_models_variable_upsert'")
+        if cursor.fetchone() is not None:
+            return
+    # the index can't be created while there are duplicate variables, the
+    # latest of them is kept
+    schema_editor.execute(
+        '''
+        DELETE FROM proso_models_variable AS variable
+        USING proso_models_variable AS duplicate
+        WHERE
+            variable.info_id = duplicate.info_id AND
+            variable.key = duplicate.key AND
+            variable.user_id IS NOT DISTINCT FROM duplicate.user_id AND
+            variable.item_primary_id IS NOT DISTINCT FROM duplicate.item_primary_id AND
+            variable.item_secondary_id IS NOT DISTINCT FROM duplicate.item_secondary_id AND
+            variable.id < duplicate.id
+        ''')
+    concurrently = '' if schema_editor.connection.in_atomic_block else 'CONCURRENTLY'
+    schema_editor.execute(
+        '''
+        CREATE UNIQUE INDEX ''' + concurrently + ''' proso_models_variable_upsert ON proso_models_variable
+        (info_id, key, COALESCE(user_id, 0), COALESCE(item_primary_id, 0), COALESCE(item_secondary_id, 0))
+        ''')
+
+
+def drop_upsert_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS proso_models_variable_upsert')
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('proso_models', '0003_environmentinfo_load_last_answer_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_upsert_index, drop_upsert_index),
+    ]
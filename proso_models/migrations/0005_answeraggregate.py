@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('proso_models', '0004_variable_upsert_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnswerAggregate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number_of_answers', models.IntegerField(default=0)),
+                ('number_of_correct_answers', models.IntegerField(default=0)),
+                ('first_answer_time', models.DateTimeField()),
+                ('last_answer_time', models.DateTimeField()),
+                ('last_answer_id', models.IntegerField()),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='item_answer_aggregates', to='proso_models.Item')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='answeraggregate',
+            unique_together=set([('user', 'item')]),
+        ),
+    ]
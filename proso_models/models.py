@@ -13,6 +13,7 @@ from functools import reduce
 from proso.django.cache import cache_pure
 from proso.django.cache import get_request_cache, is_cache_prepared, get_from_request_permenent_cache, set_to_request_permanent_cache
 from proso.django.config import instantiate_from_json
+from proso.django.db import is_on_postgresql
 from proso.django.models import ModelDiffMixin, disable_for_loaddata
 from proso.django.request import load_query_json, get_time
 from proso.django.response import HttpError
@@ -22,6 +23,7 @@ from proso.models.item_selection import TestWrapperItemSelection
 from proso.time import timeit
 from proso_common.models import Config, instantiate_from_config, instantiate_from_config_list, get_global_config, get_config, add_custom_config_filter, get_events_logger, instantiate_from_config_lazy
 from proso_common.models import IntegrityCheck, CustomConfig
+from proso_models.partitions import create_partition
 from proso_user.models import Session
 from threading import currentThread
 import django.apps
@@ -199,6 +201,7 @@ class EnvironmentInfo(models.Model):
     revision = models.IntegerField()
     config = models.ForeignKey(Config)
     load_progress = models.IntegerField(default=0)
+    load_last_answer_id = models.IntegerField(null=True, blank=True, default=None)
     updated = models.DateTimeField(auto_now=True)
     created = models.DateTimeField(auto_now_add=True)
 
@@ -1087,6 +1090,36 @@ class Answer(models.Model):
         return result
 
 
+class AnswerAggregate(models.Model):
+
+    """
+    Answers of the user to the item aggregated to compute answer statistics
+    without scanning all answers. The environment uses them when
+    'proso_models.answer_aggregates.enabled' is set. The aggregates are
+    updated when a new answer is saved only if they are enabled or
+    'proso_models.answer_aggregates.maintained' is set, so the deployments
+    not using them do not pay for the writes.
+
+    To enable the aggregates, set 'proso_models.answer_aggregates.maintained',
+    aggregate the existing answers by the backfill_answer_aggregates command
+    (the answers saved meanwhile wait for it on PostgreSQL) and then set
+    'proso_models.answer_aggregates.enabled'. The aggregates left unmaintained
+    are stale, the backfill has to be run again before they are enabled.
+    """
+
+    user = models.ForeignKey(User)
+    item = models.ForeignKey(Item, related_name='item_answer_aggregates')
+    number_of_answers = models.IntegerField(default=0)
+    number_of_correct_answers = models.IntegerField(default=0)
+    first_answer_time = models.DateTimeField()
+    last_answer_time = models.DateTimeField()
+    last_answer_id = models.IntegerField()
+
+    class Meta:
+        app_label = 'proso_models'
+        unique_together = ('user', 'item')
+
+
 class Variable(models.Model):
 
     user = models.ForeignKey(User, null=True, blank=True, default=None)
@@ -1197,6 +1230,16 @@ def handle_response_time_bug(sender, instance, **kwargs):
         instance.response_time = -1
 
 
+@receiver(post_save, sender=EnvironmentInfo)
+@disable_for_loaddata
+def init_variable_partition(sender, instance, **kwargs):
+    # the partition is created before any variable of the environment can
+    # be saved, so attaching it does not scan anything (see
+    # proso_models.partitions)
+    if kwargs['created']:
+        create_partition(instance.id)
+
+
 @receiver(pre_save, sender=PracticeContext)
 @disable_for_loaddata
 def init_content_hash_practice_context(sender, instance, **kwargs):
@@ -1245,6 +1288,16 @@ def init_config(sender, instance, **kwargs):
         instance.config_id = Config.objects.from_content(get_global_config()).id
 
 
+@receiver(post_save)
+@disable_for_loaddata
+def forget_memoized_answers(sender, instance, **kwargs):
+    if not issubclass(sender, Answer) or not kwargs['created']:
+        return
+    # the environment module depends on this one
+    from proso_models.environment import forget_answers
+    forget_answers()
+
+
 @receiver(post_save)
 @disable_for_loaddata
 def update_predictive_model(sender, instance, **kwargs):
@@ -1254,6 +1307,8 @@ def update_predictive_model(sender, instance, **kwargs):
     # We want to make the prediction before the answer is saved,
     # but we need answer id to track it.
     environment.shift_answers(instance.pk)
+    # the variables updated by the model are written by one query
+    environment.postpone_writes()
     predictive_model = get_predictive_model()
     predictive_model.predict_and_update(
         environment,
@@ -1266,6 +1321,56 @@ def update_predictive_model(sender, instance, **kwargs):
         item_asked=instance.item_asked_id,
         response_time=instance.response_time,
     )
+    environment.flush()
+
+
+@receiver(post_save)
+@disable_for_loaddata
+def update_confusing_factors(sender, instance, **kwargs):
+    if not issubclass(sender, Answer) or not kwargs['created']:
+        return
+    get_environment().update_confusing_factors(instance)
+
+
+@receiver(post_save)
+@disable_for_loaddata
+def update_answer_aggregate(sender, instance, **kwargs):
+    # registered after update_predictive_model, so the model is updated with
+    # the aggregates not containing the answer yet
+    if not issubclass(sender, Answer) or not kwargs['created']:
+        return
+    if not get_config('proso_models', 'answer_aggregates.enabled', default=False) and not get_config('proso_models', 'answer_aggregates.maintained', default=False):
+        return
+    correct = 1 if instance.item_asked_id == instance.item_answered_id else 0
+    with closing(connection.cursor()) as cursor:
+        if is_on_postgresql():
+            cursor.execute(
+                '''
+                INSERT INTO proso_models_answeraggregate
+                    (user_id, item_id, number_of_answers, number_of_correct_answers, first_answer_time, last_answer_time, last_answer_id)
+                VALUES (%s, %s, 1, %s, %s, %s, %s)
+                ON CONFLICT (user_id, item_id) DO UPDATE SET
+                    number_of_answers = proso_models_answeraggregate.number_of_answers + 1,
+                    number_of_correct_answers = proso_models_answeraggregate.number_of_correct_answers + EXCLUDED.number_of_correct_answers,
+                    first_answer_time = LEAST(proso_models_answeraggregate.first_answer_time, EXCLUDED.first_answer_time),
+                    last_answer_time = GREATEST(proso_models_answeraggregate.last_answer_time, EXCLUDED.last_answer_time),
+                    last_answer_id = GREATEST(proso_models_answeraggregate.last_answer_id, EXCLUDED.last_answer_id)
+                ''', [instance.user_id, instance.item_id, correct, instance.time, instance.time, instance.pk])
+            return
+        cursor.execute(
+            '''
+            UPDATE proso_models_answeraggregate SET
+                number_of_answers = number_of_answers + 1,
+                number_of_correct_answers = number_of_correct_answers + %s,
+                first_answer_time = MIN(first_answer_time, %s),
+                last_answer_time = MAX(last_answer_time, %s),
+                last_answer_id = MAX(last_answer_id, %s)
+            WHERE user_id = %s AND item_id = %s
+            ''', [correct, instance.time, instance.time, instance.pk, instance.user_id, instance.item_id])
+        if cursor.rowcount == 0:
+            AnswerAggregate.objects.create(
+                user_id=instance.user_id, item_id=instance.item_id, number_of_answers=1, number_of_correct_answers=correct,
+                first_answer_time=instance.time, last_answer_time=instance.time, last_answer_id=instance.pk)
 
 
 @receiver(pre_save, sender=ItemRelation)
@@ -0,0 +1,136 @@
+"""
+Variables stored in PostgreSQL list partitions by the environment info, so
+the variables of an old environment can be removed by dropping its partition
+instead of deleting the rows from the (very large) table. Permanent variables
+without an environment info have their own partition. Partitioning requires
+PostgreSQL 11 or newer and it is enabled by the ``partition_variables``
+command, on other databases and on the tables which are not partitioned the
+functions in this module do nothing.
+
+The partition of an environment info is created together with the info, so
+no variable of the info can be saved before. There is no default partition:
+attaching a partition would have to lock the default one and scan it.
+Instead a partition is created as a standalone table with a check constraint
+matching its bound and then attached, so neither of them is scanned and
+attaching takes only the SHARE UPDATE EXCLUSIVE lock of the partitioned
+table on PostgreSQL 12 or newer (saving and reading of variables is not
+blocked), the ACCESS EXCLUSIVE lock on PostgreSQL 11. The default partition
+created by the previous versions should be detached and dropped after its
+variables are moved to their partitions.
+"""
+
+from contextlib import closing
+from django.db import connection
+from proso.django.db import is_on_postgresql
+import re
+
+
+TABLE = 'proso_models_variable'
+PERMANENT_PARTITION = TABLE + '_permanent'
+
+
+def partition_name(info_id):
+    return '{}_{}'.format(TABLE, int(info_id))
+
+
+def is_partitioned():
+    if not is_on_postgresql():
+        return False
+    with closing(connection.cursor()) as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s AND relkind IN ('r', 'p')", [TABLE])
+        found = cursor.fetchone()
+    return found is not None and found[0] == 'p'
+
+
+def create_partition(info_id):
+    """
+    Create the partition for variables of the given environment info if the
+    table is partitioned.
+    """
+    if not is_partitioned():
+        return
+    with closing(connection.cursor()) as cursor:
+        _create_partition(cursor, partition_name(info_id), int(info_id))
+
+
+def drop_partition(info_id):
+    """
+    Drop the partition with variables of the given environment info. Only
+    the metadata are changed, the table is not scanned.
+
+    Returns:
+        bool: True if the partition was dropped
+    """
+    if not is_partitioned():
+        return False
+    name = partition_name(info_id)
+    with closing(connection.cursor()) as cursor:
+        cursor.execute('SELECT 1 FROM pg_class WHERE relname = %s', [name])
+        if cursor.fetchone() is None:
+            return False
+        cursor.execute('ALTER TABLE {} DETACH PARTITION {}'.format(TABLE, name))
+        cursor.execute('DROP TABLE {}'.format(name))
+    return True
+
+
+def partition_variables(info_ids):
+    """
+    Move the variables to a new table partitioned by the environment info.
+    Indexes and foreign keys of the original table are recreated on the new
+    one, the primary key is created for each partition. It has to be run in
+    a transaction.
+
+    Args:
+        info_ids (list): ids of environment infos to create partitions for
+    """
+    if not is_on_postgresql():
+        raise Exception('Partitioning of variables is supported only on PostgreSQL.')
+    if is_partitioned():
+        raise Exception('The variables are already partitioned.')
+    old_table = TABLE + '_old'
+    with closing(connection.cursor()) as cursor:
+        cursor.execute('LOCK TABLE {} IN ACCESS EXCLUSIVE MODE'.format(TABLE))
+        cursor.execute('ALTER TABLE {} RENAME TO {}'.format(TABLE, old_table))
+        cursor.execute(
+            '''
+            SELECT indexname, indexdef FROM pg_indexes
+            WHERE tablename = %s AND indexname NOT IN (
+                SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p'
+            )
+            ''', [old_table, old_table])
+        indexes = [indexdef for _, indexdef in cursor.fetchall()]
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'",
+            [old_table])
+        foreign_keys = cursor.fetchall()
+        cursor.execute('CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS) PARTITION BY LIST (info_id)'.format(TABLE, old_table))
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [old_table])
+        sequence = cursor.fetchone()[0]
+        # the sequence would be dropped together with the original table
+        cursor.execute('ALTER SEQUENCE {} OWNED BY {}.id'.format(sequence, TABLE))
+        _create_partition(cursor, PERMANENT_PARTITION, None)
+        for info_id in info_ids:
+            _create_partition(cursor, partition_name(info_id), int(info_id))
+        cursor.execute('INSERT INTO {} SELECT * FROM {}'.format(TABLE, old_table))
+        cursor.execute('DROP TABLE {}'.format(old_table))
+        for indexdef in indexes:
+            cursor.execute(re.sub(r'\b{}\b'.format(old_table), TABLE, indexdef))
+        for name, definition in foreign_keys:
+            cursor.execute('ALTER TABLE {} ADD CONSTRAINT {} {}'.format(TABLE, name, definition))
+        cursor.execute('ANALYZE {}'.format(TABLE))
+
+
+def _create_partition(cursor, name, info_id):
+    cursor.execute('SELECT 1 FROM pg_class WHERE relname = %s', [name])
+    if cursor.fetchone() is not None:
+        return
+    if info_id is None:
+        bound, check = 'IN (NULL)', 'info_id IS NULL'
+    else:
+        bound, check = 'IN ({})'.format(info_id), 'info_id IS NOT NULL AND info_id = {}'.format(info_id)
+    cursor.execute('CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS)'.format(name, TABLE))
+    # the constraint implies the bound, so the partition is not scanned when
+    # it is attached
+    cursor.execute('ALTER TABLE {} ADD CONSTRAINT {}_bound CHECK ({})'.format(name, name, check))
+    cursor.execute('ALTER TABLE {} ADD PRIMARY KEY (id)'.format(name))
+    cursor.execute('ALTER TABLE {} ATTACH PARTITION {} FOR VALUES {}'.format(TABLE, name, bound))
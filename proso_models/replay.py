@@ -0,0 +1,98 @@
+from contextlib import closing
+from django.db import connection
+from proso.models.replay import AnswerBatch
+
+
+class AnswerReader:
+
+    """
+    Read answers ordered by id in batches. The answers are paginated by the
+    id of the last read answer (keyset pagination), so reading a batch does
+    not scan the answers read before.
+
+    Args:
+        batch_size (int): maximal number of answers in a batch
+        last_id (int): only answers with greater id are read, it is used to
+            resume reading
+        limit (int): maximal number of read answers, unlimited by default
+        max_id (int): only answers with lower or equal id are read,
+            unlimited by default
+    """
+
+    def __init__(self, batch_size, last_id=0, limit=None, max_id=None):
+        self.batch_size = batch_size
+        self.last_id = last_id
+        self.limit = limit
+        self.max_id = max_id
+        self.read = 0
+
+    def read_batch(self):
+        """
+        Read the following batch of answers and move behind it.
+
+        Returns:
+            proso.models.replay.AnswerBatch: answers, the batch is empty if
+            there are no more answers to read
+        """
+        size = self.batch_size if self.limit is None else min(self.batch_size, self.limit - self.read)
+        if size <= 0:
+            return AnswerBatch.from_rows([])
+        where, params = self._where()
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(
+                '''
+                SELECT
+                    id,
+                    user_id,
+                    item_id,
+                    item_asked_id,
+                    item_answered_id,
+                    time,
+                    response_time,
+                    guess
+                FROM proso_models_answer
+                WHERE ''' + where + '''
+                ORDER BY id
+                LIMIT %s
+                ''', params + [size])
+            rows = cursor.fetchall()
+        if len(rows) > 0:
+            self.last_id = rows[-1][0]
+            self.read += len(rows)
+        return AnswerBatch.from_rows(rows)
+
+    def number_of_remaining_answers(self):
+        with closing(connection.cursor()) as cursor:
+            where, params = self._where()
+            cursor.execute('SELECT COUNT(id) FROM proso_models_answer WHERE ' + where, params)
+            return cursor.fetchone()[0]
+
+    def _where(self):
+        if self.max_id is None:
+            return 'id > %s', [self.last_id]
+        return 'id > %s AND id <= %s', [self.last_id, self.max_id]
+
+    def __iter__(self):
+        while True:
+            batch = self.read_batch()
+            if len(batch) == 0:
+                return
+            yield batch
+
+
+def answer_id_at_position(position):
+    """
+    Get the id of the answer at the given position (counted from 1) in the
+    answers ordered by id, 0 for the position 0. It is used to resume
+    reading of answers when only the number of read answers is known.
+    """
+    if position == 0:
+        return 0
+    with closing(connection.cursor()) as cursor:
+        cursor.execute('SELECT id FROM proso_models_answer ORDER BY id LIMIT 1 OFFSET %s', [position - 1])
+        fetched = cursor.fetchone()
+    if fetched is None:
+        with closing(connection.cursor()) as cursor:
+            cursor.execute('SELECT MAX(id) FROM proso_models_answer')
+            fetched = cursor.fetchone()
+    return 0 if fetched[0] is None else fetched[0]
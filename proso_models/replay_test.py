@@ -0,0 +1,52 @@
+from .environment import DatabaseEnvironment
+from .models import Answer, Item
+from .replay import AnswerReader, answer_id_at_position
+from django.contrib.auth.models import User
+import datetime
+import django.test as test
+
+
+class AnswerReaderTest(test.TestCase):
+
+    def setUp(self):
+        environment = DatabaseEnvironment()
+        users = [User.objects.create(username=str(i)).id for i in range(2)]
+        items = [Item.objects.create().id for i in range(3)]
+        for i in range(7):
+            item = items[i % len(items)]
+            environment.process_answer(users[i % len(users)], item, item, item, datetime.datetime.now(), None, 1000, 0)
+        self._ids = sorted(Answer.objects.values_list('id', flat=True))
+        self._users = set(users)
+        self._items = set(items)
+
+    def test_read_all(self):
+        reader = AnswerReader(3)
+        batches = list(reader)
+        self.assertEqual([3, 3, 1], [len(batch) for batch in batches])
+        self.assertEqual(self._ids, [answer_id for batch in batches for answer_id in batch.answer_ids])
+        self.assertEqual(self._ids[-1], reader.last_id)
+        self.assertEqual(7, reader.read)
+        self.assertEqual(0, reader.number_of_remaining_answers())
+        self.assertEqual(self._users, set.union(*[batch.user_ids() for batch in batches]))
+        self.assertEqual(self._items, set.union(*[batch.item_ids() for batch in batches]))
+
+    def test_resume(self):
+        reader = AnswerReader(3, last_id=self._ids[3])
+        self.assertEqual(3, reader.number_of_remaining_answers())
+        self.assertEqual(self._ids[4:], list(reader.read_batch().answer_ids))
+        self.assertEqual(0, len(reader.read_batch()))
+
+    def test_limit(self):
+        reader = AnswerReader(3, limit=4)
+        self.assertEqual(self._ids[:4], [answer_id for batch in reader for answer_id in batch.answer_ids])
+
+    def test_max_id(self):
+        reader = AnswerReader(3, last_id=self._ids[0], max_id=self._ids[4])
+        self.assertEqual(4, reader.number_of_remaining_answers())
+        self.assertEqual(self._ids[1:5], [answer_id for batch in reader for answer_id in batch.answer_ids])
+
+    def test_answer_id_at_position(self):
+        self.assertEqual(0, answer_id_at_position(0))
+        self.assertEqual(self._ids[0], answer_id_at_position(1))
+        self.assertEqual(self._ids[3], answer_id_at_position(4))
+        self.assertEqual(self._ids[-1], answer_id_at_position(100))